@@ -0,0 +1,393 @@
+"""
+    Hardware free benchmarks of the waveform builders, the decoders and the
+    simulated link (utils/sim.py backend).
+
+        waves:  every utils/waves.py builder (and framing.wave_packet, converted
+                per sample and from the send.py templates) at several AO sample
+                rates and durations
+        demod:  recv.process_buf and the streaming decoders (demod, sync, framing
+                with each FEC) on synthetic captures pushed in recv.poll_step blocks, and
+                the equalizer against the highest symbol rate training may pick
+        link:   goodput (payload bytes per simulated second) and latency (AI scan
+                start to the first payload) of link.Link over a fixed corpus
+        imports: cold start of send, recv and link in a fresh interpreter, checked
+                against --import-budget, and the heavy modules they pulled in
+        devices: opening both boards through a new utils/registry.py registry, cold
+                (inventory scan) and warm (registry file), with the scans each needed
+
+    Results are written as JSON with the commit and environment. --compare
+    reports the timings that got slower than a previous results file by more
+    than --tolerance and exits with 1 if any did, or if a cold start is over budget.
+
+    usage: python -m benchmarks.bench [--quick] [--output FILE] [--compare OLD] [--tolerance 0.25]
+                                      [--import-budget 1.0]
+"""
+import os
+os.environ['MODRF_BACKEND'] = 'sim' # before utils.daq selects the backend
+
+from utils import daq, sim, waves, framing
+from utils.daq import ul
+from utils.counts import daq_converter
+from utils.demod import CharDemodulator
+from utils.sync import SyncDemodulator
+from utils.fec import make_fec
+from utils.lanes import MultiLaneReceiver
+from utils.lockin import LockIn
+from utils.preemphasis import LcFit, PreEmphasis
+from utils.equalizer import DecisionFeedbackEqualizer
+from utils.registry import DeviceRegistry
+from ctypes import cast, POINTER, c_ushort
+from typing import Callable, List
+import numpy as np
+import argparse, contextlib, io, json, platform, statistics, subprocess, sys, tempfile, time
+import recv, send, link
+
+RATES      = (10_000, 50_000, 100_000)
+DURATIONS  = (1, 2)
+AI_RATE    = 1000
+CORPUS     = (
+    b"Hello World",
+    b"The quick brown fox jumps over the lazy dog. 0123456789",
+    bytes(range(32, 127)) * 2,
+)
+REPO_DIR   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ('send', 'recv', 'link')
+BOARDS     = ('USB-3101FS', 'USB-202')
+HEAVY      = ('matplotlib', 'scipy') # only plots and optional receive/transmit stages need them
+IMPORT_PROBE = '''
+import json, sys, time
+t_start = time.perf_counter()
+import {module}
+print(json.dumps({{"import_s": time.perf_counter() - t_start,
+                   "heavy": sorted({{name.split(".")[0] for name in sys.modules}} & set({heavy!r}))}}))
+'''
+
+def measure(fn:Callable, repeat:int=5, number:int=1) -> dict:
+    ''' Best and median seconds per call of fn over repeat rounds of number calls. '''
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t_start) / number)
+    return {'best_s': min(times), 'median_s': statistics.median(times), 'repeat': repeat, 'number': number}
+
+def result(group:str, name:str, params:dict, stats:dict, **extra) -> dict:
+    return {'group': group, 'name': name, 'params': params, **stats, **extra}
+
+def result_key(entry:dict) -> str:
+    return f"{entry['name']} {json.dumps(entry['params'], sort_keys=True)}"
+
+def poll_block(mod_period:float) -> int:
+    ''' Samples per push at mod_period, as recv.receive_steps polls. '''
+    return int(recv.poll_step(mod_period) * AI_RATE)
+
+def push_blocks(decoder, samples:np.ndarray, block:int) -> bytes:
+    return b''.join(decoder.push(samples[i:i + block]) for i in range(0, len(samples), block))
+
+#__________________ Groups ____________________________________________________
+
+def bench_waves(rates, durations, repeat:int) -> List[dict]:
+    sim.reset(clock=sim.ManualClock(), seed=0)
+    usb_3101fs = daq.devices().acquire('USB-3101FS')
+    usb_3101fs.set_daq_ao_range(0, daq.DaqAO.AO_RANGE.value)
+    memhandle = ul.win_buf_alloc(max(rates) * max(durations))
+    buffer = cast(memhandle, POINTER(c_ushort))
+    volts = send.link_volts()
+    converter = daq_converter(usb_3101fs)
+    a_max, a_min = daq.LC.V_OFF.value, daq.LC.V_ON.value
+    frequency, mod_period = daq.LC.FREQ_LC.value, daq.Framing.MOD_PERIOD.value
+    packet = framing.packetize(b'x' * daq.Framing.MAX_PAYLOAD.value, daq.Framing.MAX_PAYLOAD.value)[0]
+    # Pre-emphasis from the exact step response of the simulated cell
+    lc = sim.lc_from_config(daq.config)
+    overdrives = (daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value)
+    drives = np.unique(np.concatenate((volts, overdrives)))
+    fit = LcFit(drives, lc.bv(drives), lc.tau_rise, lc.tau_fall, sigma=lc.noise)
+
+    results = []
+    try:
+        for rate in rates:
+            for duration in durations:
+                common = dict(daq=usb_3101fs, buffer=buffer, duration=duration, sample_rate=rate)
+                builders = {
+                    'waves.waveform[sine]': lambda: waves.waveform('sine', amplitude=1, frequency=frequency, **common),
+                    'waves.waveform[square]': lambda: waves.waveform('square', amplitude=1, frequency=frequency, **common),
+                    'waves.waveform_fast': lambda: waves.waveform_fast(
+                        a_max=a_max, a_min=a_min, frequency=frequency, mod_period=mod_period, **common),
+                    'waves.waveform_single_char': lambda: waves.waveform_single_char(
+                        a_max=a_max, a_min=a_min, frequency=frequency, mod_period=mod_period, character='H', **common),
+                    'waves.waveform_single_char_2': lambda: waves.waveform_single_char_2(
+                        a_max=a_max, a_min=a_min, frequency=frequency, mod_period=mod_period, character='H', **common),
+                    'waves.waveform_bvCurve': lambda: waves.waveform_bvCurve(
+                        a_max=6, frequency=frequency, mod_period=mod_period, **common),
+                    'waves.wave_symbols': lambda: waves.wave_symbols(
+                        duration, rate, a_max, a_min, frequency, mod_period, np.resize(volts, int(duration / mod_period))),
+                }
+                for name, fn in builders.items():
+                    stats = measure(fn, repeat)
+                    results.append(result('waves', name, {'rate': rate, 'duration': duration}, stats,
+                                          samples_per_s=rate * duration / stats['best_s']))
+            stats = measure(lambda: framing.wave_packet(packet, volts, rate, frequency, mod_period), repeat)
+            results.append(result('waves', 'framing.wave_packet', {'rate': rate, 'payload': len(packet)}, stats))
+            # Counts of the same burst, converted per sample and gathered from the send.py templates
+            stats = measure(lambda: converter.to_counts(framing.wave_packet(packet, volts, rate, frequency, mod_period)), repeat)
+            results.append(result('waves', 'to_counts(framing.wave_packet)', {'rate': rate, 'payload': len(packet)}, stats))
+            stats = measure(lambda: send.TEMPLATES.counts(
+                converter, volts, rate, frequency, framing.packet_index(packet, len(volts), rate, mod_period)), repeat)
+            results.append(result('waves', 'templates.TemplateCache.counts', {'rate': rate, 'payload': len(packet)}, stats))
+            emphasis = PreEmphasis(fit, *overdrives, rate)
+            stats = measure(lambda: framing.wave_packet(packet, volts, rate, frequency, mod_period, emphasis=emphasis), repeat)
+            results.append(result('waves', 'framing.wave_packet+PreEmphasis', {'rate': rate, 'payload': len(packet)}, stats))
+    finally:
+        ul.win_buf_free(memhandle)
+        usb_3101fs.release_device()
+    return results
+
+def bench_demod(repeat:int) -> List[dict]:
+    ao_rate = 10_000
+    frequency, mod_period = daq.LC.FREQ_LC.value, daq.Framing.MOD_PERIOD.value
+    a_max, a_min = daq.LC.V_OFF.value, daq.LC.V_ON.value
+    message = CORPUS[1]
+    block = poll_block(mod_period)
+    results = []
+
+    # One character per 1 s frame (recv.process_buf, CharDemodulator, SyncDemodulator)
+    # after an idle lead-in; the frame after the message lets the last one be tracked
+    lead = int(0.25 * ao_rate)
+    chars = np.concatenate([np.zeros(lead)] + [
+        waves.wave_single_char_2(1, ao_rate, a_max, a_min, frequency, 0.080, chr(c)) for c in message + b' '
+    ])
+    x = sim.detector_samples(chars, ao_rate, AI_RATE, seed=0)
+    frame_offset = lead * AI_RATE // ao_rate
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = measure(lambda: recv.process_buf(x[frame_offset:frame_offset + AI_RATE]), repeat, number=20)
+    results.append(result('demod', 'recv.process_buf', {'samples': AI_RATE}, stats))
+
+    decoders = {
+        'demod.CharDemodulator': lambda: CharDemodulator(AI_RATE, recv.BIT_THRESH, frame_offset=frame_offset),
+        'sync.SyncDemodulator': lambda: SyncDemodulator(AI_RATE, recv.BIT_THRESH),
+    }
+    for name, make in decoders.items():
+        out = []
+        stats = measure(lambda: out.append(push_blocks(make(), x, poll_block(0.080))), repeat)
+        results.append(result('demod', name, {'samples': len(x), 'block': poll_block(0.080)}, stats,
+                              samples_per_s=len(x) / stats['best_s'], correct=out[-1][:len(message)] == message))
+
+    # Packet bursts (framing.PacketDemodulator) with each FEC, then integrate-and-dump decisions
+    volts = send.link_volts()
+    thresholds = recv.make_receiver(1).demods[0].thresholds # binary or PAM, as configured
+    for fec_name, decision in (('none', 'sample'), ('hamming74', 'sample'), ('rs', 'sample'), ('none', 'integrate')):
+        fec = make_fec(fec_name, daq.Framing.RS_NSYM.value, daq.Framing.RS_BLOCK.value)
+        packets = framing.packetize(message, daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value)
+        wave = np.concatenate([np.zeros(int(0.25 * ao_rate))] + [
+            framing.wave_packet(packet, volts, ao_rate, frequency, mod_period, fec) for packet in packets
+        ])
+        x = sim.detector_samples(wave, ao_rate, AI_RATE, seed=0)
+        make = lambda: framing.PacketDemodulator(
+            AI_RATE, thresholds, mod_period, daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value, fec,
+            decision=decision, guard=daq.DaqAI.DECISION_GUARD.value)
+        out = []
+        stats = measure(lambda: out.append(push_blocks(make(), x, block)), repeat)
+        params = {'fec': fec_name, 'samples': len(x), 'block': block}
+        if decision != 'sample':
+            params['decision'] = decision # keys of the sample runs stay comparable with older results
+        results.append(result('demod', 'framing.PacketDemodulator', params,
+                              stats, samples_per_s=len(x) / stats['best_s'], correct=out[-1] == message))
+
+    # The same bursts behind the lock-in front-end (baseband envelope, decimated by 5)
+    packets = framing.packetize(message, daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value)
+    wave = np.concatenate([np.zeros(int(0.25 * ao_rate))] + [
+        framing.wave_packet(packet, volts, ao_rate, frequency, mod_period) for packet in packets
+    ])
+    x = sim.detector_samples(wave, ao_rate, AI_RATE, seed=0)
+    make = lambda: MultiLaneReceiver(
+        [framing.PacketDemodulator(AI_RATE // 5, thresholds, mod_period, daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value)],
+        front_ends=[LockIn(AI_RATE, frequency, harmonic=0, cutoff=25.0, decimation=5)])
+    out = []
+    stats = measure(lambda: out.append(push_blocks(make(), x, block)), repeat)
+    results.append(result('demod', 'lockin.LockIn+PacketDemodulator', {'fec': 'none', 'samples': len(x), 'block': block},
+                          stats, samples_per_s=len(x) / stats['best_s'], correct=out[-1] == message))
+
+    # The same bursts decided by the decision-feedback equalizer
+    make = lambda: framing.PacketDemodulator(
+        AI_RATE, thresholds, mod_period, daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value,
+        decision='integrate', guard=daq.DaqAI.DECISION_GUARD.value,
+        equalizer=DecisionFeedbackEqualizer(len(thresholds) + 1))
+    out = []
+    stats = measure(lambda: out.append(push_blocks(make(), x, block)), repeat)
+    results.append(result('demod', 'equalizer.DecisionFeedbackEqualizer+PacketDemodulator',
+                          {'fec': 'none', 'samples': len(x), 'block': block}, stats,
+                          samples_per_s=len(x) / stats['best_s'], correct=out[-1] == message))
+
+    # Equalizer alone on packets of binary symbols with a one symbol LC tail, against the
+    # symbol rate of the shortest period link training may choose
+    rng = np.random.default_rng(0)
+    n_train, n_data, n_packets = 12, 300, 20
+    known = rng.integers(0, 2, (n_packets, n_train + n_data)).astype(float)
+    soft = 1.0 + 0.5 * known + 0.15 * np.roll(known, 1, axis=1) + rng.normal(0, 0.03, known.shape)
+    def equalize_packets():
+        dfe = DecisionFeedbackEqualizer(2)
+        for r, k in zip(soft, known):
+            dfe.equalize(r[n_train:], r[:n_train], k[:n_train])
+        return dfe
+    out = []
+    stats = measure(lambda: out.append(equalize_packets()), repeat)
+    symbols_per_s = n_packets * n_data / stats['best_s']
+    results.append(result('demod', 'equalizer.DecisionFeedbackEqualizer', {'symbols': n_packets * n_data, 'packet': n_data},
+                          stats, symbols_per_s=symbols_per_s,
+                          realtime_factor=symbols_per_s * float(daq.Training.MIN_PERIOD.value),
+                          mse=out[-1].metrics.mse))
+    return results
+
+def bench_link(corpus, speed:float) -> List[dict]:
+    results = []
+    sim.reset(clock=sim.RealtimeClock(speed), seed=0)
+    link_ = link.Link()
+    try:
+        link_.open()
+        for message in corpus:
+            with contextlib.redirect_stdout(io.StringIO()):
+                received = link_.run(message)
+            metrics = link_.metrics
+            duration = metrics.duration * speed # simulated seconds
+            results.append(result('link', 'link.Link.run', {'bytes': len(message), 'speed': speed}, {
+                'goodput_Bps': len(received) / duration,
+                'latency_s':   None if metrics.latency is None else metrics.latency * speed,
+                'duration_s':  duration,
+                'wall_s':      metrics.duration,
+                'correct':     received == message,
+            }))
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            link_.close()
+    return results
+
+def bench_imports(repeat:int, budget:float) -> List[dict]:
+    '''
+        Cold start of every entry point, each run in a new interpreter (sim backend,
+        config of the working directory): import time and whole process time.
+    '''
+    results = []
+    env = {**os.environ, 'MODRF_BACKEND': 'sim',
+           'PYTHONPATH': os.pathsep.join(filter(None, (REPO_DIR, os.environ.get('PYTHONPATH'))))}
+    for module in ENTRY_POINTS:
+        imports, processes, probe = [], [], None
+        for _ in range(repeat):
+            t_start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module, heavy=HEAVY)],
+                                 env=env, capture_output=True, text=True, check=True).stdout
+            processes.append(time.perf_counter() - t_start)
+            probe = json.loads(out.strip().splitlines()[-1])
+            imports.append(probe['import_s'])
+        stats = {'best_s': min(imports), 'median_s': statistics.median(imports), 'repeat': repeat, 'number': 1}
+        results.append(result('imports', f'import {module}', {'module': module}, stats,
+                              process_s=min(processes), budget_s=budget, within_budget=min(processes) <= budget,
+                              heavy_modules=probe['heavy']))
+    return results
+
+def bench_devices(repeat:int) -> List[dict]:
+    '''
+        Acquire and release both boards through a new DeviceRegistry: cold removes the
+        registry file first, warm starts from the one the cold run wrote.
+    '''
+    results = []
+    sim.reset(clock=sim.ManualClock(), seed=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'device_registry.json')
+        for start in ('cold', 'warm'):
+            metrics = []
+            def open_boards():
+                if start == 'cold' and os.path.exists(path):
+                    os.remove(path)
+                registry = DeviceRegistry(path)
+                for handle in registry.acquire(*BOARDS):
+                    handle.release_device()
+                metrics.append(registry.metrics)
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = measure(open_boards, repeat, number=20)
+            results.append(result('devices', 'registry.DeviceRegistry.acquire', {'start': start, 'boards': len(BOARDS)},
+                                  stats, enumerations=metrics[-1].enumerations))
+    return results
+
+#__________________ Results ___________________________________________________
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit':   commit,
+        'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':   platform.python_version(),
+        'numpy':    np.__version__,
+        'platform': platform.platform(),
+        'machine':  platform.machine(),
+    }
+
+def compare(new:List[dict], old:List[dict], tolerance:float) -> List[str]:
+    '''
+        Regressions of new against old: timings slower by more than tolerance,
+        goodput lower by more than tolerance and decoders that stopped decoding.
+    '''
+    old = {result_key(entry): entry for entry in old}
+    regressions = []
+    for entry in new:
+        before = old.get(result_key(entry))
+        if before is None:
+            continue
+        key = result_key(entry)
+        if 'best_s' in entry and entry['best_s'] > before['best_s'] * (1 + tolerance):
+            regressions.append(f"{key}: {before['best_s'] * 1e3:.3f} ms -> {entry['best_s'] * 1e3:.3f} ms")
+        if 'goodput_Bps' in entry and entry['goodput_Bps'] < before['goodput_Bps'] * (1 - tolerance):
+            regressions.append(f"{key}: {before['goodput_Bps']:.2f} B/s -> {entry['goodput_Bps']:.2f} B/s")
+        if before.get('correct') and entry.get('correct') is False:
+            regressions.append(f"{key}: no longer decodes correctly")
+    return regressions
+
+def main(argv:List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description="Hardware free ModRF benchmarks.")
+    parser.add_argument('--quick', action='store_true', help="one rate and duration, fewer repeats")
+    parser.add_argument('--groups', default='waves,demod,link,imports,devices', help="comma separated groups to run")
+    parser.add_argument('--speed', type=float, default=20.0, help="simulated clock speed of the link group")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help="previous results file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown (0.25 = 25 %%)")
+    parser.add_argument('--import-budget', type=float, default=1.0, help="allowed cold start (s) of send, recv and link")
+    args = parser.parse_args(argv)
+
+    groups = args.groups.split(',')
+    repeat = 3 if args.quick else 7
+    results = []
+    if 'waves' in groups:
+        results += bench_waves(RATES[:1] if args.quick else RATES, DURATIONS[:1] if args.quick else DURATIONS, repeat)
+    if 'demod' in groups:
+        results += bench_demod(repeat)
+    if 'link' in groups:
+        results += bench_link(CORPUS[:1] if args.quick else CORPUS, args.speed)
+    if 'imports' in groups:
+        results += bench_imports(repeat, args.import_budget)
+    if 'devices' in groups:
+        results += bench_devices(repeat)
+
+    with open(args.output, 'w') as out:
+        json.dump({'environment': environment(), 'results': results}, out, indent=2)
+    for entry in results:
+        value = f"{entry['best_s'] * 1e3:9.3f} ms" if 'best_s' in entry else f"{entry['goodput_Bps']:9.2f} B/s"
+        print(f"[bench] {entry['group']:5} {value}  {result_key(entry)}")
+    print(f"[bench] Results written to {args.output}")
+
+    over_budget = [entry for entry in results if entry.get('within_budget') is False]
+    for entry in over_budget:
+        print(f"[bench] OVER BUDGET {result_key(entry)}: cold start {entry['process_s']:.3f} s > {entry['budget_s']} s"
+              f" (heavy modules: {', '.join(entry['heavy_modules']) or 'none'})")
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for line in regressions:
+            print(f"[bench] REGRESSION {line}")
+    return 1 if regressions or over_budget else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
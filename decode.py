@@ -0,0 +1,151 @@
+"""
+    Offline batch decoder of recorded captures (utils/capture.py).
+
+    Every capture of a directory goes through the recv.py receiver (threshold,
+    sync, slicing, FEC and framing) with the current daq_config.ini. The files
+    are split into one chunk per worker of a process pool. Each file is scored
+    against the AO symbols recorded with it:
+
+        frame errors: packets sent that did not pass the CRC
+        bit errors:   coded bits of every frame whose header names a sent packet
+                      against the bits sent (channel BER, before FEC)
+
+    usage: python decode.py <capture dir> [--workers N] [--format json|csv] [--output FILE]
+"""
+from utils.capture import Capture
+from utils.pam import symbols_to_bits
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+import argparse, configparser, csv, glob, json, os, sys, time
+import recv
+
+CSV_FIELDS = (
+    'file', 'packets_sent', 'packets_ok', 'frame_errors', 'fer', 'frames', 'bits_compared',
+    'bit_errors', 'ber', 'crc_errors', 'bad_headers', 'fec_corrected', 'fec_uncorrectable',
+    'samples_lost', 'payload', 'payload_hex', 'decode_time', 'error'
+)
+
+def sent_bits(capture:Capture) -> dict:
+    ''' (lane, seq) -> coded bits of every packet sent, levels as configured when recording. '''
+    config = configparser.ConfigParser()
+    config.read_string(capture.header['config'])
+    bits_per_symbol = int(config.get('LC', 'bits_per_symbol', fallback='1'))
+    return {
+        (lane, seq): symbols_to_bits(np.asarray(symbols), bits_per_symbol)
+        for lane, seq, symbols in capture.symbols()
+    }
+
+def score_frames(demods, sent:dict) -> dict:
+    '''
+        Frame and bit errors of the lane demodulators (frame_log enabled) against
+        the coded bits sent, keyed by (lane, seq) as sent_bits.
+    '''
+    delivered = set()
+    frames = bits_compared = bit_errors = 0
+    for lane, lane_demod in enumerate(demods):
+        for seq, bits, ok in lane_demod.frame_log:
+            frames += 1
+            if ok:
+                delivered.add((lane, seq))
+            reference = sent.get((lane, seq))
+            if reference is None:
+                continue # header too corrupted to tell which packet it was
+            n = min(len(bits), len(reference))
+            bits_compared += n
+            bit_errors += int(np.count_nonzero(bits[:n] != reference[:n]))
+    packets_ok = len(delivered & sent.keys())
+    return {
+        'packets_sent':  len(sent),
+        'packets_ok':    packets_ok,
+        'frame_errors':  len(sent) - packets_ok,
+        'fer':           (len(sent) - packets_ok) / len(sent) if sent else None,
+        'frames':        frames,
+        'bits_compared': bits_compared,
+        'bit_errors':    bit_errors,
+        'ber':           bit_errors / bits_compared if bits_compared else None,
+    }
+
+def score_capture(path:str) -> dict:
+    ''' Decoded payload and error statistics of one capture. '''
+    t_start = time.perf_counter()
+    capture = Capture(path)
+    received, reader, demod = recv.decode_capture(capture, frame_log=True)
+    scores = score_frames(demod.demods, sent_bits(capture))
+    metrics = [lane_demod.framing for lane_demod in demod.demods]
+    capture.close()
+    return {
+        'file':              os.path.basename(path),
+        **scores,
+        'crc_errors':        sum(m.crc_errors for m in metrics),
+        'bad_headers':       sum(m.bad_headers for m in metrics),
+        'fec_corrected':     sum(m.fec_corrected for m in metrics),
+        'fec_uncorrectable': sum(m.fec_uncorrectable for m in metrics),
+        'samples_lost':      reader.metrics.samples_lost,
+        'payload':           received.decode(errors='replace'),
+        'payload_hex':       received.hex(),
+        'decode_time':       time.perf_counter() - t_start,
+        'error':             None,
+    }
+
+def score_chunk(paths:List[str]) -> List[dict]:
+    ''' Worker: score every capture of a chunk, a broken file does not stop the others. '''
+    results = []
+    for path in paths:
+        try:
+            results.append(score_capture(path))
+        except Exception as e:
+            results.append({'file': os.path.basename(path), 'error': str(e)})
+    return results
+
+def totals(results:List[dict]) -> dict:
+    ''' Error statistics summed over every scored file. '''
+    scored = [r for r in results if r.get('error') is None]
+    sums = {key: sum(r[key] for r in scored) for key in ('packets_sent', 'frame_errors', 'bits_compared', 'bit_errors')}
+    sums['files'] = len(results)
+    sums['failed_files'] = len(results) - len(scored)
+    sums['fer'] = sums['frame_errors'] / sums['packets_sent'] if sums['packets_sent'] else None
+    sums['ber'] = sums['bit_errors'] / sums['bits_compared'] if sums['bits_compared'] else None
+    return sums
+
+def decode_dir(directory:str, workers:int=None, pattern:str='*.modrf') -> List[dict]:
+    ''' Score every capture of directory, one chunk of files per worker process. '''
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    if not paths:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    chunks = [list(chunk) for chunk in np.array_split(np.array(paths), workers)]
+    if workers == 1:
+        return score_chunk(chunks[0])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [result for chunk in pool.map(score_chunk, chunks) for result in chunk]
+
+def write_results(results:List[dict], fmt:str, out):
+    if fmt == 'json':
+        json.dump({'files': results, 'totals': totals(results)}, out, indent=2)
+        out.write('\n')
+    else:
+        writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+def main(argv:List[str]=None):
+    parser = argparse.ArgumentParser(description="Decode and score a directory of ModRF captures.")
+    parser.add_argument('directory', help="directory of capture files")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--pattern', default='*.modrf', help="capture file name pattern")
+    parser.add_argument('--format', choices=('json', 'csv'), default='json')
+    parser.add_argument('--output', default=None, help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    t_start = time.perf_counter()
+    results = decode_dir(args.directory, args.workers, args.pattern)
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write_results(results, args.format, out)
+    else:
+        write_results(results, args.format, sys.stdout)
+    print(f"[decode.py] {len(results)} captures in {time.perf_counter() - t_start:.1f} s", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
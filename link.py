@@ -0,0 +1,250 @@
+"""
+    Single process link: both DAQs are opened once and the AO transmitter and the
+    AI receiver run as concurrent asyncio tasks. Replaces recv.py starting send.py
+    as a subprocess and the ZMQ REQ/REP handshake between the two.
+
+    With [Training] mode = startup the link first sends the training sequence of
+    utils/training.py on every lane and adopts the symbol period and thresholds
+    it measures (saved for send.py, recv.py and mode = saved).
+
+    Both scans are started back to back from the same task, so the start-of-link
+    skew is a couple of driver calls. Every driver call used here returns
+    immediately (background scans, get_status, buffer copies), so the tasks only
+    yield to each other while they wait for the next poll.
+"""
+from utils import daq
+from utils.daq import ul, sleep, async_sleep
+from utils.ao_stream import AoStreamer
+from utils.ai_stream import AiRingReader, ai_buf_alloc, ai_scan_options
+from utils.counts import daq_converter, write_buffer
+from utils.capture import CaptureRecorder, capture_header, capture_path
+from utils import lanes, training
+from mcculw.enums import ScanOptions, FunctionType
+from ctypes import cast, POINTER, c_ushort
+import numpy as np
+import asyncio, itertools, time
+import send, recv
+
+class LinkMetrics():
+    ''' Timings (s) reported by Link. '''
+    def __init__(self):
+        self.open_time = None # device handles, ranges and buffers
+        self.skew      = None # AO scan start after the AI scan start
+        self.duration  = None # AI scan start to the end of the message
+        self.latency   = None # AI scan start to the first payload delivered
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class Link():
+    '''
+        Transmitter (USB-3101FS AO) and receiver (USB-202 AI) of one process.
+        open() then run() any number of messages, close() always.
+
+        Args:
+            profile: Config profile (utils/config.py) made active by open(), None
+                for the active one.
+    '''
+    def __init__(self, profile:str=None):
+        self.profile      = profile
+        self.metrics      = LinkMetrics()
+        self.usb_3101fs   = None
+        self.usb_202      = None
+        self.memhandle_ao = None
+        self.memhandle_ai = None
+        self.recorder     = None
+        self.training     = None # training.TrainingResult adopted by both ends
+        self._t_ai        = None
+        self._ao_running  = False
+        self._ai_running  = False
+
+    def open(self):
+        t_open = time.perf_counter()
+        if self.profile is not None:
+            daq.use_profile(self.profile)
+        self.usb_3101fs, self.usb_202 = daq.devices().acquire('USB-3101FS', 'USB-202')
+        for chan in range(daq.DaqAO.CHAN_LOW.value, daq.DaqAO.CHAN_HIG.value + 1):
+            self.usb_3101fs.set_daq_ao_range(chan, daq.DaqAO.AO_RANGE.value)
+        for chan in range(daq.DaqAI.CHAN_LOW.value, daq.DaqAI.CHAN_HIG.value + 1):
+            self.usb_202.set_daq_ai_range(chan, daq.DaqAI.AI_RANGE.value)
+
+        self.ao_chans = daq.DaqAO.NUM_CHANS.value
+        self.ai_chans = daq.DaqAI.NUM_CHANS.value
+        ao_size, ai_size = daq.profile().ao.buffer_size, daq.profile().ai.buffer_size
+        self.memhandle_ao = ul.win_buf_alloc(ao_size)
+        self.raw_ai = daq.DaqAI.ACQUISITION.value == 'raw'
+        self.memhandle_ai = ai_buf_alloc(ai_size, self.raw_ai)
+        self.ao_buffer = cast(self.memhandle_ao, POINTER(c_ushort))
+        self.streamer = AoStreamer(
+            daq=self.usb_3101fs,
+            buffer=self.ao_buffer,
+            buffer_size=ao_size,
+            rate=daq.DaqAO.FREQ_SAMPLE.value,
+            idle=daq_converter(self.usb_3101fs).to_counts(np.zeros(1)),
+            num_chans=self.ao_chans
+        )
+        self.reader = AiRingReader(self.usb_202, self.memhandle_ai, ai_size, self.ai_chans, self.raw_ai)
+        if daq.Training.MODE.value == 'startup':
+            self.training = self.train()
+            self.training.save(daq.Training.RESULT.value)
+            print(f"[link.py] Link training: {self.training.summary()}")
+            if not self.training.met:
+                print("[link.py] [WARNING] No candidate period reached the target margin, using the widest eye.")
+        else:
+            self.training = training.configured_training()
+        if daq.DaqAI.CAPTURE_DIR.value:
+            header = capture_header(self.usb_202, self.raw_ai, self.reader.scaler, self.training)
+            self.recorder = CaptureRecorder(capture_path(daq.DaqAI.CAPTURE_DIR.value), header)
+            self.reader.recorder = self.recorder
+        self.metrics.open_time = time.perf_counter() - t_open
+
+    async def _transmit(self):
+        await self.streamer.run_async()
+
+    async def _collect(self, points:int, blocks:list):
+        ''' Copy AI points (volts) until points were acquired. '''
+        acquired = 0
+        while acquired < points:
+            await async_sleep(recv.poll_step())
+            _, buf = self.reader.read_volts()
+            blocks.append(np.array(buf))
+            acquired += len(buf)
+
+    async def _train_async(self) -> list:
+        ''' Send the training sequence on every AO lane, return the AI points it was received in. '''
+        converter = daq_converter(self.usb_3101fs)
+        hold, repeats = daq.Training.HOLD.value, int(daq.Training.REPEATS.value)
+        wave = converter.to_counts(training.training_wave(
+            daq.LC.V_OFF.value, daq.LC.V_ON.value, daq.DaqAO.FREQ_SAMPLE.value, daq.LC.FREQ_LC.value, hold, repeats
+        ))
+        lead_in = np.resize(self.streamer.idle, int(0.25 * daq.DaqAO.FREQ_SAMPLE.value) * self.ao_chans)
+        self.streamer.prime(iter([lead_in, lanes.interleave([wave] * self.ao_chans, self.ao_chans, self.streamer.idle[0])]))
+        # Lead-in, sequence and a margin for the start skew and the LC settling
+        points = int((0.25 + training.training_duration(hold, repeats) + 0.2) * daq.DaqAI.FREQ_SAMPLE.value) * self.ai_chans
+        blocks = []
+        self._start_scans()
+        tasks = [asyncio.ensure_future(self._transmit()), asyncio.ensure_future(self._collect(points, blocks))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self._stop_scans_async()
+        return blocks
+
+    def train(self) -> training.TrainingResult:
+        ''' Measure every lane with the training sequence and select the link parameters. '''
+        blocks = asyncio.run(self._train_async())
+        if self.reader.metrics.samples_lost:
+            raise Exception("[ERROR] AI samples were lost during link training, lengthen [DaqAI] duration.")
+        return training.train(
+            lanes.deinterleave(np.concatenate(blocks), self.ai_chans),
+            daq.DaqAI.FREQ_SAMPLE.value,
+            hold=daq.Training.HOLD.value,
+            periods=training.configured_periods(),
+            target_margin=daq.Training.TARGET_MARGIN.value,
+            decision=daq.DaqAI.DECISION.value,
+            guard=daq.DaqAI.DECISION_GUARD.value
+        )
+
+    def _start_scans(self):
+        ''' AI first so the receiver sees the whole first burst, then AO right away. '''
+        self.reader.reset()
+        daq.daq_ai_scan(self.usb_202, self.memhandle_ai, ai_scan_options(self.raw_ai))
+        self._t_ai = time.perf_counter()
+        self._ai_running = True
+        daq.daq_ao_scan(self.usb_3101fs, self.memhandle_ao, ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS)
+        self.metrics.skew = time.perf_counter() - self._t_ai
+        self._ao_running = True
+
+    async def _receive(self, demod, received:bytearray, deadline:float):
+        for wait in recv.receive_steps(self.usb_202, self.reader, demod, received, deadline):
+            if received and self.metrics.latency is None:
+                self.metrics.latency = time.perf_counter() - self._t_ai
+            await async_sleep(wait)
+
+    async def run_async(self, messege:bytes) -> bytes:
+        ''' Send messege over the link and return what the receiver decoded. '''
+        # Idle lead-in gives the receiver the bright tail its preamble search expects
+        lead_in = np.resize(self.streamer.idle, int(0.25 * daq.DaqAO.FREQ_SAMPLE.value) * self.ao_chans)
+        mod_period = self.training.mod_period if self.training is not None else None
+        self.streamer.prime(itertools.chain([lead_in], send.packet_frames(self.usb_3101fs, messege, self.ao_chans, self.recorder, mod_period)))
+        self.demod = recv.make_receiver(self.ai_chans, self.training)
+        # Lead-in and bursts, with the silence that ends a message as margin for the start skew
+        deadline = 0.25 + send.message_duration(messege, self.ao_chans, mod_period) + 2 * recv.PACKET_TIMEOUT
+        self.metrics.latency = None
+        received = bytearray()
+
+        self._start_scans()
+
+        tasks = [asyncio.ensure_future(self._transmit()), asyncio.ensure_future(self._receive(self.demod, received, deadline))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self._stop_scans_async()
+        self.metrics.duration = time.perf_counter() - self._t_ai
+        return bytes(received)
+
+    def run(self, messege:bytes) -> bytes:
+        return asyncio.run(self.run_async(messege))
+
+    def _idle_ao(self) -> bool:
+        ''' 0 V on every channel before the scan stops holding the last sample. True if the AO scan runs. '''
+        if self._ao_running:
+            write_buffer(self.ao_buffer, np.resize(self.streamer.idle, self.streamer.buffer_size))
+        return self._ao_running
+
+    async def _stop_scans_async(self):
+        ''' _stop_scans for the coroutines, the idle output plays out without blocking the loop. '''
+        if self._idle_ao():
+            await async_sleep(0.3)
+        self._halt_scans()
+
+    def _stop_scans(self):
+        if self._idle_ao():
+            sleep(0.3)
+        self._halt_scans()
+
+    def _halt_scans(self):
+        if self._ao_running:
+            ul.stop_background(self.usb_3101fs.daq_board_num, FunctionType.AOFUNCTION)
+            self._ao_running = False
+        if self._ai_running:
+            ul.stop_background(self.usb_202.daq_board_num, FunctionType.AIFUNCTION)
+            self._ai_running = False
+
+    def close(self):
+        ''' Zero the AO output, stop both scans, free the buffers and release the boards. '''
+        try:
+            self._stop_scans()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+                print(f"[link.py] Capture saved to {self.recorder.path}")
+                self.recorder = None
+            for memhandle in (self.memhandle_ao, self.memhandle_ai):
+                if memhandle:
+                    ul.win_buf_free(memhandle)
+            self.memhandle_ao = self.memhandle_ai = None
+            for usb_daq in (self.usb_3101fs, self.usb_202):
+                if usb_daq is not None:
+                    usb_daq.release_device()
+            self.usb_3101fs = self.usb_202 = None
+
+def link(messege:str="Hello World", profile:str=None):
+    link = Link(profile)
+    try:
+        link.open()
+        received = link.run(messege.encode())
+        recv.print_metrics(received, link.reader, link.demod)
+        print(f"[link.py] AO stream metrics: {link.streamer.metrics.as_dict()}")
+        print(f"[link.py] Link metrics: {link.metrics.as_dict()}")
+    except KeyboardInterrupt:
+        print("[link.py] Exit through interrupt.")
+    finally:
+        link.close()
+
+if __name__ == "__main__":
+    link()
@@ -3,18 +3,35 @@
 """
 
 from utils import daq, waves
-from mcculw.enums import ScanOptions, FunctionType, Status
-from mcculw import ul
+from utils.daq import ul, sleep
+from utils.ai_stream import AiRingReader, ai_buf_alloc, ai_scan_options
+from utils.capture import Capture, CaptureReader, CaptureRecorder, capture_header, capture_path
+from utils.framing import PacketDemodulator
+from utils.lanes import MultiLaneReceiver
+from utils.fec import configured_fec
+from utils.pam import configured_levels
+from utils.threshold import AdaptiveThreshold
+from utils.matched import centred_means, integration_width
+from utils.lockin import LockIn
+from utils.equalizer import DecisionFeedbackEqualizer
+from utils.training import TrainingResult, configured_training
+from mcculw.enums import FunctionType, Status
 
-from time import sleep
-import subprocess, ctypes
+import subprocess, threading, sys
 import numpy as np
-import zmq
 
 # BIT_THRESH = daq.DaqAI.BIT_LOW.value + (daq.DaqAI.BIT_HIG.value - daq.DaqAI.BIT_LOW.value) / 2
 BIT_THRESH = 1.35
 
 def process_send():
+    if ul.name == 'sim':
+        # Simulated DAQs only exist inside this process, run send.py as a thread
+        import send
+        thread_s = threading.Thread(target=send.send, daemon=True)
+        thread_s.start()
+        print("[recv.py] Begin send.py thread (simulated DAQ).")
+        return thread_s
+
         # Begin subprocess to start recv script
     try:
         process_s = subprocess.Popen(
@@ -30,20 +47,160 @@ def process_send():
     # sleep(5)
     return process_s
 
-def process_buf(buf:np.array):
-    proc_buf = np.where(buf <= BIT_THRESH, 0, 1)
+def process_buf(buf:np.array, slicer:AdaptiveThreshold=None):
+    # Adaptive slicer follows the detector levels from buffer to buffer
+    thresh = slicer.update(buf)[0] if slicer is not None else BIT_THRESH
+    proc_buf = np.where(buf <= thresh, 0, 1)
     s_f = daq.DaqAI.FREQ_SAMPLE.value
-    b_str = b''
                     #  0     1     0     0     1     0     0     0 for H
     finite_window = [0.23, 0.31, 0.39, 0.46, 0.55, 0.63, 0.71, 0.79]
-    for t in finite_window:
-        b_str += b'1' if proc_buf[int(t*s_f)] == 1 else b'0'
+    centres = (np.array(finite_window) * s_f).astype(int)
+    if daq.DaqAI.DECISION.value == 'integrate':
+        # Mean of each guard trimmed symbol window instead of its centre sample
+        width = integration_width(daq.profile().ai_samples_per_symbol, daq.DaqAI.DECISION_GUARD.value)
+        bits = centred_means(buf, centres, width) > thresh
+    else:
+        bits = proc_buf[centres] == 1
+    b_str = b''.join(b'1' if bit else b'0' for bit in bits)
 
     print(f'Received: {b_str} | {chr(int(b_str, 2))}')
     return proc_buf
 
+PACKET_TIMEOUT = 2.0 # seconds without a preamble or packet end ending the message
+MESSAGE_TIMEOUT = 30.0 # seconds a receiver that does not know the message length listens at most
+
+def poll_step(mod_period:float=None) -> float:
+    ''' Seconds between AI polls: half a symbol period ([Framing] mod_period unless given). '''
+    if mod_period is None:
+        mod_period = daq.Framing.MOD_PERIOD.value
+    return mod_period / 2
+
+def make_front_ends(num_chans:int) -> list:
+    ''' Lock-in front-end of every lane ([DaqAI] front_end = lockin), else None. '''
+    if daq.DaqAI.FRONT_END.value == 'none':
+        return None
+    if daq.DaqAI.FRONT_END.value != 'lockin':
+        raise Exception(f"[ERROR] Unknown front_end '{daq.DaqAI.FRONT_END.value}', use none or lockin.")
+    return [
+        LockIn(
+            sample_rate=daq.DaqAI.FREQ_SAMPLE.value,
+            frequency=daq.LC.FREQ_LC.value,
+            harmonic=daq.DaqAI.LOCKIN_HARMONIC.value,
+            cutoff=daq.DaqAI.LOCKIN_CUTOFF.value,
+            decimation=daq.DaqAI.LOCKIN_DECIMATION.value
+        )
+        for _ in range(num_chans)
+    ]
+
+def make_equalizer():
+    ''' Decision-feedback equalizer of one lane ([DaqAI] equalizer = dfe), else None. '''
+    if daq.DaqAI.EQUALIZER.value == 'none':
+        return None
+    if daq.DaqAI.EQUALIZER.value != 'dfe':
+        raise Exception(f"[ERROR] Unknown equalizer '{daq.DaqAI.EQUALIZER.value}', use none or dfe.")
+    return DecisionFeedbackEqualizer(
+        num_levels=2 ** daq.LC.BITS_PER_SYMBOL.value,
+        ff_taps=daq.DaqAI.EQ_FF_TAPS.value,
+        fb_taps=daq.DaqAI.EQ_FB_TAPS.value,
+        step=daq.DaqAI.EQ_STEP.value,
+        block=daq.DaqAI.EQ_BLOCK.value
+    )
+
+def make_receiver(num_chans:int, training:TrainingResult=None) -> MultiLaneReceiver:
+    '''
+        Packet receiver of every lane (AI channel) configured in daq_config.ini.
+        A link training result replaces mod_period and, for binary symbols, the
+        threshold and starting levels of every lane.
+    '''
+    mod_period = daq.Framing.MOD_PERIOD.value if training is None else training.mod_period
+    levels = None
+    if daq.LC.BITS_PER_SYMBOL.value > 1:
+        # PAM: thresholds between the calibrated level intensities
+        pam_levels = configured_levels(mod_period)
+        threshold, levels = pam_levels.thresholds, pam_levels.intensity
+    else:
+        threshold = BIT_THRESH
+    thresholds, lane_levels = [threshold] * num_chans, [levels] * num_chans
+    if training is not None and daq.LC.BITS_PER_SYMBOL.value == 1:
+        if len(training.thresholds) != num_chans:
+            raise Exception(f"[ERROR] Link training has {len(training.thresholds)} lanes, the receiver {num_chans}.")
+        thresholds = training.thresholds
+        lane_levels = [[lane.dark, lane.bright] for lane in training.lanes]
+    adaptive = daq.DaqAI.THRESHOLD.value == 'adaptive'
+
+    front_ends = make_front_ends(num_chans)
+    rate = daq.DaqAI.FREQ_SAMPLE.value if front_ends is None else front_ends[0].out_rate
+    if front_ends is not None and front_ends[0].harmonic:
+        # Carrier amplitudes have no calibrated volts, learn the levels from the signal
+        if daq.LC.BITS_PER_SYMBOL.value > 1:
+            raise Exception("[ERROR] PAM needs lockin_harmonic = 0 (detector volts of the calibration).")
+        thresholds, lane_levels, adaptive = [np.nan] * num_chans, [None] * num_chans, True
+    return MultiLaneReceiver([
+        PacketDemodulator(
+            sample_rate=rate,
+            threshold=threshold,
+            mod_period=mod_period,
+            max_payload=daq.Framing.MAX_PAYLOAD.value,
+            crc_bits=daq.Framing.CRC_BITS.value,
+            fec=configured_fec(),
+            seq_step=num_chans,
+            first_seq=lane,
+            slicer=AdaptiveThreshold(
+                threshold, levels, rate, daq.DaqAI.THRESHOLD_TAU.value
+            ) if adaptive else None,
+            decision=daq.DaqAI.DECISION.value,
+            guard=daq.DaqAI.DECISION_GUARD.value,
+            equalizer=make_equalizer()
+        )
+        for lane, (threshold, levels) in enumerate(zip(thresholds, lane_levels))
+    ], front_ends=front_ends)
+
+def receive_steps(usb_daq:daq.McculwUsbDaq, reader:AiRingReader, demod:MultiLaneReceiver, received:bytearray,
+                  deadline:float=MESSAGE_TIMEOUT):
+    '''
+        Poll the AI scan and decode until the message ended, appending payloads to
+        received. Yields the seconds to wait before the next poll (sleep or await).
+
+        Args:
+            deadline: Seconds of acquisition after which the receiver gives up, e.g.
+                the expected message duration plus a margin.
+    '''
+    timeout = int(PACKET_TIMEOUT * daq.DaqAI.FREQ_SAMPLE.value)
+    # Symbol period the receiver was built for, training may have shortened it
+    poll = poll_step(demod.demods[0].bit_len / demod.demods[0].sample_rate)
+    last = int(deadline * daq.DaqAI.FREQ_SAMPLE.value)
+    status_ai = Status.RUNNING
+    start, buf = 0, []
+    # Stop once no preamble locked and no packet ended within PACKET_TIMEOUT, CRC
+    # failures included, or at the deadline
+    while status_ai != Status.IDLE and (start + len(buf)) // demod.num_lanes < last \
+            and (demod.locked or (start + len(buf)) // demod.num_lanes - demod.last_seen < timeout):
+        status_ai, _, _ = ul.get_status(usb_daq.daq_board_num, FunctionType.AIFUNCTION)
+        start, buf = reader.read_volts()
+        payload = demod.push(buf, start)
+        if payload:
+            print(f'Received: {payload}')
+            received += payload
+        yield poll
+    received += demod.flush()
+
+def print_metrics(received:bytes, reader:AiRingReader, demod:MultiLaneReceiver):
+    print(f"[recv.py] Message: {bytes(received).decode(errors='replace')}")
+    print(f"[recv.py] AI stream metrics: {reader.metrics.as_dict()}")
+    print(f"[recv.py] Lane metrics: {demod.metrics.as_dict()}")
+    for lane, lane_demod in enumerate(demod.demods):
+        print(f"[recv.py] Lane {lane} sync metrics: {lane_demod.metrics.as_dict()}")
+        print(f"[recv.py] Lane {lane} framing metrics: {lane_demod.framing.as_dict()}")
+        if lane_demod.slicer is not None:
+            print(f"[recv.py] Lane {lane} threshold metrics: {lane_demod.slicer.metrics.as_dict()}")
+        if lane_demod.equalizer is not None:
+            print(f"[recv.py] Lane {lane} equalizer metrics: {lane_demod.equalizer.metrics.as_dict()}")
+        if demod.front_ends:
+            print(f"[recv.py] Lane {lane} lock-in metrics: {demod.front_ends[lane].metrics.as_dict()}")
+
 def recv():
-    # Create a TCP/IP socket
+    # Create a TCP/IP socket (two process mode, link.py runs both ends in one process)
+    import zmq
     try:
         context = zmq.Context()
         recv_socket = context.socket(zmq.REP)
@@ -55,16 +212,18 @@ def recv():
         print("Interrupt.")
 
     # Initialize devices
-    devices = daq.configure_devices()
-    usb_202 = daq.McculwUsbDaq(devices['USB-202'])
+    usb_202 = daq.devices().acquire('USB-202')
 
     # Set AI Range equal to AO range of send DAQ
-    usb_202.set_daq_ai_range(0, daq.DaqAI.AI_RANGE.value)
+    NUM_CHANS = daq.DaqAI.NUM_CHANS.value
+    for chan in range(daq.DaqAI.CHAN_LOW.value, daq.DaqAI.CHAN_HIG.value + 1):
+        usb_202.set_daq_ai_range(chan, daq.DaqAI.AI_RANGE.value)
 
     # Allocate buffer size for AI ADC
-    memhandle_ai = ul.scaled_win_buf_alloc(daq.DaqAI.FREQ_SAMPLE.value)
-    buff_ai = (ctypes.c_double * daq.DaqAI.FREQ_SAMPLE.value)()
-    scan_options = (ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS | ScanOptions.SCALEDATA)
+    BUFFER_SIZE  = daq.profile().ai.buffer_size
+    RAW          = daq.DaqAI.ACQUISITION.value == 'raw'
+    memhandle_ai = ai_buf_alloc(BUFFER_SIZE, RAW)
+    scan_options = ai_scan_options(RAW)
 
     # Start background scan
     response = recv_socket.recv_string()
@@ -80,34 +239,66 @@ def recv():
     while status_ai == Status.IDLE:
         status_ai, _, _ = ul.get_status(usb_202.daq_board_num, FunctionType.AIFUNCTION)
 
+    reader = None
     try:
-        # Read buffer and parse for characters
-        num_buf_processed = 0
-        POINTS_TO_COPY = 0
-        buf = []
-        # messege = ['-', 'H', 'E', 'L', 'L', 'O', 'W']
-        messege = 12
-        while status_ai != Status.IDLE:
-            for c in range(messege):
-                # print(response)
-                status_ai, num_pts_scanned, curr_idx = ul.get_status(usb_202.daq_board_num, FunctionType.AIFUNCTION)
-                ul.scaled_win_buf_to_array(memhandle_ai, buff_ai, POINTS_TO_COPY, daq.DaqAI.FREQ_SAMPLE.value - POINTS_TO_COPY)
-                buf = np.copy(buff_ai)
-                buf = process_buf(buf)
-                sleep(1)
-            status_ai = Status.IDLE
-        
+        # Pull only newly acquired samples, lock on each packet preamble of every
+        # lane (AI channel) and deliver payloads that pass the CRC in sequence order
+        reader = AiRingReader(usb_202, memhandle_ai, BUFFER_SIZE, NUM_CHANS, RAW)
+        training = configured_training()
+        if daq.DaqAI.CAPTURE_DIR.value:
+            reader.recorder = CaptureRecorder(capture_path(daq.DaqAI.CAPTURE_DIR.value), capture_header(usb_202, RAW, reader.scaler, training))
+        demod  = make_receiver(NUM_CHANS, training)
+        received = bytearray()
+        for wait in receive_steps(usb_202, reader, demod, received):
+            sleep(wait)
+        print_metrics(received, reader, demod)
+
         ul.stop_background(usb_202.daq_board_num, FunctionType.AIFUNCTION)
     except Exception as e:
         print(f"[recv.py] [ERROR]: Exception {e}\n")
     except KeyboardInterrupt:
         print("[recv.py] Exit process through interrupt.")
     finally:
+        if reader is not None and reader.recorder is not None:
+            reader.recorder.close()
+            print(f"[recv.py] Capture saved to {reader.recorder.path}")
         sleep(0.500)
         ul.win_buf_free(memhandle_ai)
         ul.stop_background(usb_202.daq_board_num, FunctionType.AIFUNCTION)
         usb_202.release_device()
-        # waves.plot_bvCurve_buffer(f'BV Curve Sample LC ModRF', buf)
+        # viz.plot_bvCurve_buffer(f'BV Curve Sample LC ModRF', buf)
+
+def decode_capture(capture:Capture, frame_log:bool=False):
+    '''
+        Decode a capture offline with the same receiver as recv(). The decoder
+        settings come from the current daq_config.ini, the capture header holds
+        the snapshot of the one it was recorded with. The link training recorded
+        in the header, if any, is adopted as it was live.
+
+        Return:
+            (received payload bytes, CaptureReader, MultiLaneReceiver)
+    '''
+    reader = CaptureReader(capture)
+    training = capture.header.get('training')
+    demod = make_receiver(capture.num_chans, TrainingResult.from_dict(training) if training else None)
+    if frame_log:
+        for lane_demod in demod.demods:
+            lane_demod.frame_log = []
+    received = bytearray()
+    while not reader.done:
+        start, buf = reader.read_volts()
+        received += demod.push(buf, start)
+    received += demod.flush()
+    return bytes(received), reader, demod
+
+def replay(path:str) -> bytes:
+    ''' Decode a capture file and print the receiver metrics. '''
+    received, reader, demod = decode_capture(Capture(path))
+    print_metrics(received, reader, demod)
+    return received
 
 if __name__ == '__main__':
-    recv()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        replay(sys.argv[1])
+    else:
+        recv()
\ No newline at end of file
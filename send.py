@@ -2,11 +2,20 @@
     Script to send communication for recv.py to process. (subprocess for recv.py)
 """
 from utils import daq, waves
-from mcculw.ul import a_out_scan, win_buf_alloc, win_buf_free, stop_background
+from utils.daq import ul, sleep
+from utils.ao_stream import AoStreamer
+from utils.counts import daq_converter, write_buffer
+from utils.templates import TemplateCache
+from utils.pam import configured_levels
+from utils import framing, lanes
+from utils.fec import configured_fec
+from utils.training import configured_training
+from utils.preemphasis import configured_emphasis
+import numpy as np
+import itertools
 from mcculw.enums import ScanOptions, FunctionType
 from ctypes import cast, POINTER, c_ushort
-from time import sleep
-import sys, zmq
+import sys
 
 def daq_wf_ao_amplitude(usb_daq:daq.McculwUsbDaq, buffer, amplitude:float):
     ''' Handle function to change amplitude of a waveform ao buffer '''
@@ -19,18 +28,72 @@ def daq_wf_ao_amplitude(usb_daq:daq.McculwUsbDaq, buffer, amplitude:float):
         amplitude=amplitude,
         frequency=daq.LC.FREQ_LC.value
     )
-def daq_ao_waveform_single_char_2(usb_daq:daq.McculwUsbDaq, buffer, character:str):
-    waves.waveform_single_char_2(
-        daq=usb_daq,
-        buffer=buffer,
-        duration=daq.DaqAO.DURAION.value,
-        sample_rate=daq.DaqAO.FREQ_SAMPLE.value,
-        a_max=daq.LC.V_OFF.value,
-        a_min=daq.LC.V_ON.value,
-        frequency=daq.LC.FREQ_LC.value,
-        mod_period=0.080, #ms
-        character = character
+
+# Per level AO counts of the packet bursts, built once per link configuration
+TEMPLATES = TemplateCache()
+
+def link_volts(mod_period:float=None) -> np.ndarray:
+    ''' Drive amplitude of each symbol level, darkest first. PAM levels must settle within mod_period. '''
+    if daq.LC.BITS_PER_SYMBOL.value > 1:
+        return configured_levels(daq.Framing.MOD_PERIOD.value if mod_period is None else mod_period).volts
+    return np.array([daq.LC.V_OFF.value, daq.LC.V_ON.value])
+
+def message_duration(messege:bytes, num_lanes:int=1, mod_period:float=None) -> float:
+    ''' Seconds of the packet bursts packet_frames sends for messege, without a lead-in. '''
+    if mod_period is None:
+        mod_period = daq.Framing.MOD_PERIOD.value
+    fec = configured_fec()
+    packets = framing.packetize(
+        messege,
+        max_payload=daq.Framing.MAX_PAYLOAD.value,
+        crc_bits=daq.Framing.CRC_BITS.value
+    )
+    return sum(
+        max(framing.packet_duration(len(framing.packet_symbols(p, daq.LC.BITS_PER_SYMBOL.value, fec)), mod_period) for p in packet_round)
+        for packet_round in lanes.stripe(packets, num_lanes)
+    )
+
+def burst_counts(converter, packet:bytes, volts:np.ndarray, mod_period:float, fec, emphasis=None) -> np.ndarray:
+    ''' AO counts of one packet burst, gathered from TEMPLATES unless emphasis shapes it. '''
+    if emphasis is not None:
+        # The overdrive depends on the previous level, convert the shaped burst
+        return converter.to_counts(framing.wave_packet(
+            packet=packet,
+            volts=volts,
+            sample_rate=daq.DaqAO.FREQ_SAMPLE.value,
+            frequency=daq.LC.FREQ_LC.value,
+            mod_period=mod_period,
+            fec=fec,
+            emphasis=emphasis
+        ))
+    index = framing.packet_index(packet, len(volts), daq.DaqAO.FREQ_SAMPLE.value, mod_period, fec)
+    return TEMPLATES.counts(converter, volts, daq.DaqAO.FREQ_SAMPLE.value, daq.LC.FREQ_LC.value, index)
+
+def packet_frames(usb_daq:daq.McculwUsbDaq, messege:bytes, num_lanes:int=1, recorder=None, mod_period:float=None):
+    '''
+        Source of AO counts for AoStreamer. Packets are striped across num_lanes
+        AO channels, one round of simultaneous bursts per chunk (interleaved scans).
+        The symbols of every packet are written to recorder (capture.CaptureRecorder) if given.
+        mod_period (s) overrides [Framing] mod_period, e.g. the one chosen by link training.
+    '''
+    if mod_period is None:
+        mod_period = daq.Framing.MOD_PERIOD.value
+    converter = daq_converter(usb_daq)
+    idle = converter.to_counts(np.zeros(1))[0]
+    volts = link_volts(mod_period)
+    fec = configured_fec()
+    emphasis = configured_emphasis(daq.DaqAO.FREQ_SAMPLE.value)
+    packets = framing.packetize(
+        messege,
+        max_payload=daq.Framing.MAX_PAYLOAD.value,
+        crc_bits=daq.Framing.CRC_BITS.value
     )
+    for packet_round in lanes.stripe(packets, num_lanes):
+        if recorder is not None:
+            for lane, packet in enumerate(packet_round):
+                recorder.write_symbols(lane, packet[1], framing.packet_symbols(packet, int(np.log2(len(volts))), fec))
+        bursts = [burst_counts(converter, packet, volts, mod_period, fec, emphasis) for packet in packet_round]
+        yield lanes.interleave(bursts, num_lanes, idle)
 
 def daq_ao_waveform_bvCurve(usb_daq:daq.McculwUsbDaq, buffer):
     waves.waveform_bvCurve(
@@ -44,7 +107,8 @@ def daq_ao_waveform_bvCurve(usb_daq:daq.McculwUsbDaq, buffer):
     )
 
 def send():
-    # Create a TCP/IP socket
+    # Create a TCP/IP socket (two process mode, link.py runs both ends in one process)
+    import zmq
     try:
         context = zmq.Context()
         send_socket = context.socket(zmq.REQ)
@@ -54,18 +118,40 @@ def send():
         print(f"{e}")
 
     # Initialize devices
-    devices    = daq.configure_devices()
-    usb_3101fs = daq.McculwUsbDaq(devices['USB-3101FS'])
+    usb_3101fs = daq.devices().acquire('USB-3101FS')
     
     # Set AO range equal to AI range on read DAQ
-    usb_3101fs.set_daq_ao_range(0, daq.DaqAO.AO_RANGE.value)
+    for chan in range(daq.DaqAO.CHAN_LOW.value, daq.DaqAO.CHAN_HIG.value + 1):
+        usb_3101fs.set_daq_ao_range(chan, daq.DaqAO.AO_RANGE.value)
 
     # Initialize AO Buffer
-    NUM_CHANS    = daq.DaqAO.CHAN_HIG.value - daq.DaqAO.CHAN_LOW.value + 1
-    memhandle    = win_buf_alloc(daq.DaqAO.FREQ_SAMPLE.value * daq.DaqAO.DURAION.value * NUM_CHANS)
+    NUM_CHANS    = daq.DaqAO.NUM_CHANS.value
+    BUFFER_SIZE  = daq.profile().ao.buffer_size
+    memhandle    = ul.win_buf_alloc(BUFFER_SIZE)
     ao_buffer    = cast(memhandle, POINTER(c_ushort))
     scan_options = (ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS)
 
+    # messege = ['P', 'P']
+    # messege = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    messege = "Hello World"
+    # messege = " "
+
+    # Stream packet bursts back to back (one LC cell per AO channel), the buffer
+    # is primed before the scan starts
+    streamer = AoStreamer(
+        daq=usb_3101fs,
+        buffer=ao_buffer,
+        buffer_size=BUFFER_SIZE,
+        rate=daq.DaqAO.FREQ_SAMPLE.value,
+        idle=daq_converter(usb_3101fs).to_counts(np.zeros(1)),
+        num_chans=NUM_CHANS
+    )
+    # Idle lead-in gives the receiver the bright tail its preamble search expects
+    LEAD_IN = np.resize(streamer.idle, int(0.25 * daq.DaqAO.FREQ_SAMPLE.value) * NUM_CHANS)
+    training = configured_training()
+    mod_period = training.mod_period if training is not None else None
+    streamer.prime(itertools.chain([LEAD_IN], packet_frames(usb_3101fs, messege.encode(), NUM_CHANS, mod_period=mod_period)))
+
     send_socket.send_string('[send.py] Initialized AO. Begin AO scan.')
     try:
         daq.daq_ao_scan(usb_daq=usb_3101fs,
@@ -76,28 +162,19 @@ def send():
         print(f"[ERROR] [AO] {e_ao}\n")
     
     try:
-        SLEEP_STEP = 1
-        # messege = ['P', 'P']
-        # messege = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-        messege = "Hello World"
-        # messege = " "
-        for c in messege:
-            # daq_ao_waveform_single_char_2(usb_3101fs, ao_buffer, c)
-            daq_ao_waveform_single_char_2(usb_3101fs, ao_buffer, c)
-            sleep(SLEEP_STEP)
+        streamer.run()
+        print(f"[send.py] AO stream metrics: {streamer.metrics.as_dict()}")
 
-        daq_wf_ao_amplitude(usb_3101fs, ao_buffer, 0)
-        sleep(SLEEP_STEP)
-        
     except KeyboardInterrupt:
         print('Interrupt')
     except Exception as e:
         print(f'[ERROR]: {e}\n')
     finally:
-        daq_wf_ao_amplitude(usb_3101fs, ao_buffer, 0)
+        # 0 V on every channel of the interleaved buffer
+        write_buffer(ao_buffer, np.resize(streamer.idle, BUFFER_SIZE))
         sleep(0.3)
-        win_buf_free(memhandle)
-        stop_background(usb_3101fs.daq_board_num, FunctionType.AOFUNCTION)
+        ul.stop_background(usb_3101fs.daq_board_num, FunctionType.AOFUNCTION)
+        ul.win_buf_free(memhandle)
         usb_3101fs.release_device()
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+"""
+    Parameter sweep of the link operating point: BER, goodput and latency for
+    every combination of mod_period, freq_lc, V_ON/V_OFF, transmit pre-emphasis,
+    AI sample rate, threshold strategy, symbol decision, receive front-end and
+    equalizer, evaluated on a process pool.
+
+    Points are evaluated against
+
+        sim:       random packets through the LC model of [Sim] (sim.detector_samples),
+                   every parameter is swept
+        captures:  a directory of recorded captures (utils/capture.py), only the
+                   receive side (AI rate by decimation, threshold, decision, front-end,
+                   equalizer) can be swept
+
+    Symbols have the [LC] bits_per_symbol of the profile (sim) or of each
+    capture's config. PAM levels are the ones recv.make_receiver uses, picked
+    from the stored BV calibration, so V_ON/V_OFF are not swept for PAM.
+
+    Threshold strategies: fixed:<volts> (binary only), calibrated (between the
+    BV calibration intensities, PAM only), midpoint (between the settled LC model
+    intensities of the drive levels, sim only), levels (evenly spaced between the
+    5th and 95th percentile of the detector samples) and adaptive
+    (utils/threshold.py, from recv.BIT_THRESH or the calibrated PAM thresholds).
+    Decisions: sample or integrate (utils/matched.py, with the decision_guard of
+    daq_config.ini). Front-ends: none or lockin (utils/lockin.py,
+    as configured in [DaqAI]). Pre-emphasis: off or on (utils/preemphasis.py, with
+    the LC fit and overdrives of [LC], sim only). Equalizers: none or dfe
+    (utils/equalizer.py, with the taps, step and block of [DaqAI]).
+
+    The recommendation is the point with the highest goodput whose BER (coded
+    bits, before FEC) and frame error rate meet the targets.
+
+    usage: python sweep.py [--mod-period 0.04:0.12:0.02] [--v-on 1.38,1.40] ... [--target-ber 1e-3]
+"""
+from utils import daq, sim, framing
+from utils.capture import Capture
+from utils.fec import configured_fec, make_fec
+from utils.framing import PacketDemodulator
+from utils.lanes import deinterleave
+from utils.threshold import AdaptiveThreshold
+from utils.lockin import LockIn
+from utils.preemphasis import LcFit, PreEmphasis
+from utils.equalizer import DecisionFeedbackEqualizer
+from utils.pam import PamLevels, load_levels
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+import argparse, configparser, csv, glob, itertools, json, os, sys, time
+import decode, recv
+
+AO_RATE    = daq.DaqAO.FREQ_SAMPLE.value
+LEAD       = 0.25 # idle seconds before the first burst, as send.py
+CSV_FIELDS = (
+    'mod_period', 'bits_per_symbol', 'freq_lc', 'v_on', 'v_off', 'preemphasis', 'ai_rate', 'threshold', 'decision',
+    'front_end', 'equalizer', 'threshold_v', 'bit_rate', 'goodput_Bps', 'latency_s', 'ber', 'fer', 'bit_errors', 'bits_compared',
+    'packets_sent', 'packets_ok', 'meets_target', 'error'
+)
+
+def parse_values(text:str, cast=float) -> list:
+    ''' "start:stop:step" (stop included) or a comma separated list. '''
+    if ':' in text:
+        start, stop, step = (float(v) for v in text.split(':'))
+        return [cast(round(v, 9)) for v in np.arange(start, stop + step / 2, step)]
+    return [cast(v) for v in text.split(',')]
+
+def point_levels(bits_per_symbol:int, path:str) -> PamLevels:
+    ''' PAM levels of the BV calibration at path as recv.make_receiver picks them, None for binary symbols. '''
+    return load_levels(bits_per_symbol, path) if bits_per_symbol > 1 else None
+
+def resolve_threshold(strategy:str, samples:np.ndarray, num_levels:int=2, lc:sim.LcModel=None, volts=None,
+                      levels:PamLevels=None):
+    ''' Threshold of a strategy, a float for binary symbols, ascending thresholds for PAM. '''
+    if strategy.startswith('fixed:'):
+        if num_levels > 2:
+            raise Exception("[ERROR] Threshold 'fixed:<v>' is binary, sweep PAM with calibrated, midpoint, levels or adaptive.")
+        return float(strategy.split(':', 1)[1])
+    if strategy == 'calibrated':
+        if levels is None:
+            raise Exception("[ERROR] Threshold 'calibrated' needs PAM levels, sweep binary symbols with fixed:<v>.")
+        return levels.thresholds
+    if strategy == 'adaptive':
+        # Starting point of the slicer
+        return recv.BIT_THRESH if levels is None else levels.thresholds
+    if strategy == 'midpoint':
+        if lc is None:
+            raise Exception("[ERROR] Threshold 'midpoint' needs the LC model (sim sweeps only).")
+        intensity = np.sort(lc.bv(np.asarray(volts)))
+        thresholds = (intensity[1:] + intensity[:-1]) / 2
+    elif strategy == 'levels':
+        low, high = np.percentile(samples, [5, 95])
+        thresholds = low + (high - low) * (np.arange(num_levels - 1) + 0.5) / (num_levels - 1)
+    else:
+        raise Exception(f"[ERROR] Unknown threshold strategy '{strategy}', use fixed:<v>, calibrated, midpoint, levels or adaptive.")
+    return float(thresholds[0]) if num_levels == 2 else thresholds
+
+def make_slicer(strategy:str, threshold, sample_rate:int, levels:PamLevels=None) -> AdaptiveThreshold:
+    if strategy != 'adaptive':
+        return None
+    return AdaptiveThreshold(threshold, None if levels is None else levels.intensity, sample_rate=sample_rate,
+                             tau=daq.DaqAI.THRESHOLD_TAU.value)
+
+def make_front_ends(front_end:str, sample_rate:int, freq_lc:float, num_lanes:int) -> List[LockIn]:
+    ''' Lock-in front-end per lane as configured in [DaqAI] for 'lockin', None for 'none'. '''
+    if front_end == 'none':
+        return None
+    if front_end != 'lockin':
+        raise Exception(f"[ERROR] Unknown front end '{front_end}', use none or lockin.")
+    if daq.DaqAI.LOCKIN_HARMONIC.value:
+        raise Exception("[ERROR] The threshold strategies are in detector volts, sweep with lockin_harmonic = 0.")
+    return [
+        LockIn(sample_rate, freq_lc, daq.DaqAI.LOCKIN_HARMONIC.value, daq.DaqAI.LOCKIN_CUTOFF.value,
+               daq.DaqAI.LOCKIN_DECIMATION.value)
+        for _ in range(num_lanes)
+    ]
+
+def make_emphasis(mode:str) -> PreEmphasis:
+    ''' Transmit shaper at the AO rate for 'on' (LC fit and overdrives of [LC]), None for 'off'. '''
+    if mode == 'off':
+        return None
+    if mode != 'on':
+        raise Exception(f"[ERROR] Unknown preemphasis '{mode}', use off or on.")
+    return PreEmphasis(LcFit.load(daq.LC.LC_FIT.value), daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value, AO_RATE)
+
+def make_equalizer(mode:str, num_levels:int=2) -> DecisionFeedbackEqualizer:
+    ''' Decision-feedback equalizer as configured in [DaqAI] for 'dfe', None for 'none'. '''
+    if mode == 'none':
+        return None
+    if mode != 'dfe':
+        raise Exception(f"[ERROR] Unknown equalizer '{mode}', use none or dfe.")
+    return DecisionFeedbackEqualizer(num_levels, daq.DaqAI.EQ_FF_TAPS.value, daq.DaqAI.EQ_FB_TAPS.value,
+                                     daq.DaqAI.EQ_STEP.value, daq.DaqAI.EQ_BLOCK.value)
+
+def run_demods(demods:List[PacketDemodulator], blocks, front_ends:List[LockIn]=None) -> float:
+    '''
+        Push (start, interleaved samples) blocks through one demodulator per lane,
+        behind its lock-in front-end if given.
+
+        Return:
+            seconds of samples pushed until the first packet was delivered, None if none was.
+    '''
+    latency = None
+    num_lanes = len(demods)
+    for start, block in blocks:
+        lane_start = start // num_lanes
+        for lane, (demod, samples) in enumerate(zip(demods, deinterleave(block, num_lanes))):
+            demod_start = lane_start
+            if front_ends:
+                demod_start, samples = front_ends[lane].process(samples, lane_start)
+            if demod.push_packets(samples, demod_start) and latency is None:
+                latency = (demod_start + len(samples)) / demod.sample_rate
+    return latency
+
+#__________________ Simulated LC ______________________________________________
+
+def evaluate_sim(point:dict, num_bytes:int=64, repeats:int=1, seed:int=0) -> dict:
+    ''' Scores of one operating point on random messages through the LC model. '''
+    lc = sim.lc_from_config(daq.config)
+    fec = configured_fec()
+    max_payload, crc_bits = daq.Framing.MAX_PAYLOAD.value, daq.Framing.CRC_BITS.value
+    levels = point_levels(point['bits_per_symbol'], daq.LC.BV_CALIBRATION.value)
+    volts = np.array([point['v_off'], point['v_on']]) if levels is None else levels.volts
+    emphasis = make_emphasis(point['preemphasis'])
+    ai_rate = point['ai_rate']
+    block = max(int(recv.poll_step(point['mod_period']) * ai_rate), 1)
+
+    totals = dict.fromkeys(('bit_errors', 'bits_compared', 'packets_sent', 'packets_ok'), 0)
+    payload = air_time = 0
+    latencies, thresholds = [], []
+    for r in range(repeats):
+        rng = np.random.default_rng((seed, r))
+        packets = framing.packetize(rng.integers(0, 256, num_bytes, dtype=np.uint8).tobytes(), max_payload, crc_bits)
+        # The receiver reads one symbol past the last one, send.py idles after the message as well
+        tail = np.zeros(int(2 * point['mod_period'] * AO_RATE))
+        wave = np.concatenate([np.zeros(int(LEAD * AO_RATE))] + [
+            framing.wave_packet(packet, volts, AO_RATE, point['freq_lc'], point['mod_period'], fec, emphasis)
+            for packet in packets
+        ] + [tail])
+        x = sim.detector_samples(wave, AO_RATE, ai_rate, lc, seed=(seed, r))
+        threshold = resolve_threshold(point['threshold'], x, len(volts), lc, volts, levels)
+        front_ends = make_front_ends(point['front_end'], ai_rate, point['freq_lc'], 1)
+        rate = ai_rate if front_ends is None else front_ends[0].out_rate
+        demod = PacketDemodulator(rate, threshold, point['mod_period'], max_payload, crc_bits, fec,
+                                  slicer=make_slicer(point['threshold'], threshold, rate, levels),
+                                  decision=point['decision'], guard=daq.DaqAI.DECISION_GUARD.value,
+                                  equalizer=make_equalizer(point['equalizer'], len(volts)))
+        demod.frame_log = []
+        latency = run_demods([demod], ((i, x[i:i + block]) for i in range(0, len(x), block)), front_ends)
+
+        scores = decode.score_frames([demod], {(0, packet[1]): framing.packet_bits(packet, fec) for packet in packets})
+        for key in totals:
+            totals[key] += scores[key]
+        payload += demod.framing.bytes
+        air_time += (len(wave) - len(tail)) / AO_RATE - LEAD
+        thresholds.append(float(np.mean(demod.thresholds)))
+        if latency is not None:
+            latencies.append(latency - LEAD)
+    return finish(point, totals, payload, air_time, latencies, thresholds)
+
+#__________________ Recorded captures _________________________________________
+
+def capture_config(capture:Capture) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_string(capture.header['config'])
+    return config
+
+def decimated_blocks(capture:Capture, factor:int):
+    ''' AI records in volts keeping every factor-th channel scan, indices rescaled. '''
+    n = capture.num_chans
+    for start, points in capture.blocks():
+        scan = start // n
+        offset = -scan % factor
+        scans = capture.to_volts(points).reshape(-1, n)[offset::factor]
+        yield (scan + offset) // factor * n, scans.ravel()
+
+def evaluate_captures(point:dict, paths:List[str]) -> dict:
+    ''' Scores of one receive side operating point over every capture. '''
+    totals = dict.fromkeys(('bit_errors', 'bits_compared', 'packets_sent', 'packets_ok'), 0)
+    payload = air_time = 0
+    latencies, thresholds = [], []
+    for path in paths:
+        capture = Capture(path)
+        config = capture_config(capture)
+        framing_cfg = config['Framing']
+        rate = capture.header['ai']['rate']
+        factor = max(int(round(rate / point['ai_rate'])), 1)
+        fec = make_fec(framing_cfg.get('fec', 'none'), framing_cfg.getint('rs_nsym', 8), framing_cfg.getint('rs_block', 64))
+        samples = np.concatenate([block for _, block in decimated_blocks(capture, factor)])
+        # Levels as recorded, PAM thresholds from the calibration the capture was sent with
+        bits_per_symbol = config['LC'].getint('bits_per_symbol', 1)
+        levels = point_levels(bits_per_symbol, config['LC'].get('bv_calibration', ''))
+        threshold = resolve_threshold(point['threshold'], samples, 1 << bits_per_symbol, levels=levels)
+        front_ends = make_front_ends(point['front_end'], rate // factor, config['LC'].getint('freq_lc'), capture.num_chans)
+        demod_rate = rate // factor if front_ends is None else front_ends[0].out_rate
+        # The symbol period is a property of the recording, the trained one if the link was trained
+        training = capture.header.get('training')
+        mod_period = training['mod_period'] if training else framing_cfg.getfloat('mod_period', 0.080)
+        demods = [
+            PacketDemodulator(
+                demod_rate, threshold, mod_period, framing_cfg.getint('max_payload', 32),
+                framing_cfg.getint('crc_bits', 16), fec, seq_step=capture.num_chans, first_seq=lane,
+                slicer=make_slicer(point['threshold'], threshold, demod_rate, levels),
+                decision=point['decision'], guard=daq.DaqAI.DECISION_GUARD.value,
+                equalizer=make_equalizer(point['equalizer'], 1 << bits_per_symbol))
+            for lane in range(capture.num_chans)
+        ]
+        for demod in demods:
+            demod.frame_log = []
+        latency = run_demods(demods, decimated_blocks(capture, factor), front_ends)
+
+        scores = decode.score_frames(demods, decode.sent_bits(capture))
+        for key in totals:
+            totals[key] += scores[key]
+        payload += sum(demod.framing.bytes for demod in demods)
+        air_time += len(samples) / capture.num_chans / (rate // factor)
+        thresholds += [float(np.mean(demod.thresholds)) for demod in demods]
+        if latency is not None:
+            latencies.append(latency)
+        capture.close()
+    return finish(point, totals, payload, air_time, latencies, thresholds)
+
+#__________________ Sweep _____________________________________________________
+
+def finish(point:dict, totals:dict, payload:int, air_time:float, latencies:list, thresholds:list) -> dict:
+    sent, errors, compared = totals['packets_sent'], totals['bit_errors'], totals['bits_compared']
+    return {
+        **point,
+        **totals,
+        'threshold_v': float(np.mean(thresholds)) if thresholds else None,
+        'bit_rate':    point['bits_per_symbol'] / point['mod_period'] if 'mod_period' in point else None,
+        'goodput_Bps': payload / air_time if air_time else 0.0,
+        'latency_s':   float(np.median(latencies)) if latencies else None,
+        # Nothing decodable: count every coded bit as a coin toss
+        'ber':         errors / compared if compared else 0.5,
+        'fer':         (sent - totals['packets_ok']) / sent if sent else None,
+        'error':       None,
+    }
+
+def evaluate(args) -> dict:
+    ''' Worker: one point, failures are reported instead of stopping the sweep. '''
+    point, source, options = args
+    try:
+        if source == 'sim':
+            return evaluate_sim(point, **options)
+        return evaluate_captures(point, **options)
+    except Exception as e:
+        return {**point, 'error': str(e)}
+
+def grid(args) -> List[dict]:
+    '''
+        Every combination of the swept values, V_ON below V_OFF (bright level first).
+        PAM points take their levels from the BV calibration instead of V_ON/V_OFF.
+    '''
+    bits_per_symbol = daq.LC.BITS_PER_SYMBOL.value
+    if args.captures:
+        keys = ('ai_rate', 'threshold', 'decision', 'front_end', 'equalizer')
+        values = (parse_values(args.ai_rate, int), args.threshold.split(','), args.decision.split(','),
+                  args.front_end.split(','), args.equalizer.split(','))
+    elif bits_per_symbol > 1:
+        keys = ('mod_period', 'bits_per_symbol', 'freq_lc', 'preemphasis', 'ai_rate', 'threshold', 'decision',
+                'front_end', 'equalizer')
+        values = (
+            parse_values(args.mod_period), [bits_per_symbol], parse_values(args.freq_lc, int), args.preemphasis.split(','),
+            parse_values(args.ai_rate, int), args.threshold.split(','), args.decision.split(','),
+            args.front_end.split(','), args.equalizer.split(','),
+        )
+    else:
+        keys = ('mod_period', 'bits_per_symbol', 'freq_lc', 'v_on', 'v_off', 'preemphasis', 'ai_rate', 'threshold',
+                'decision', 'front_end', 'equalizer')
+        values = (
+            parse_values(args.mod_period), [bits_per_symbol], parse_values(args.freq_lc, int), parse_values(args.v_on),
+            parse_values(args.v_off), args.preemphasis.split(','), parse_values(args.ai_rate, int), args.threshold.split(','),
+            args.decision.split(','), args.front_end.split(','), args.equalizer.split(','),
+        )
+    points = [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+    return [p for p in points if 'v_on' not in p or p['v_on'] < p['v_off']]
+
+def recommend(results:List[dict], target_ber:float, target_fer:float) -> dict:
+    ''' Fastest point meeting the targets: highest goodput, then lowest latency. '''
+    for r in results:
+        r['meets_target'] = (r.get('error') is None and r['ber'] <= target_ber
+                             and r['fer'] is not None and r['fer'] <= target_fer)
+    passing = [r for r in results if r['meets_target']]
+    if not passing:
+        return None
+    return max(passing, key=lambda r: (r['goodput_Bps'], -(r['latency_s'] or np.inf)))
+
+def sweep(points:List[dict], source:str, options:dict, workers:int=None) -> List[dict]:
+    workers = workers or os.cpu_count() or 1
+    jobs = [(point, source, options) for point in points]
+    if workers == 1:
+        return [evaluate(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(evaluate, jobs, chunksize=max(len(jobs) // (4 * workers), 1)))
+
+def main(argv:List[str]=None):
+    parser = argparse.ArgumentParser(description="Sweep the ModRF link operating point.")
+    parser.add_argument('--mod-period', default=f"{daq.Framing.MOD_PERIOD.value}", help="seconds per symbol")
+    parser.add_argument('--freq-lc', default=f"{daq.LC.FREQ_LC.value}", help="LC carrier frequency (Hz)")
+    parser.add_argument('--v-on', default=None, help=f"bright drive amplitude (V, default {daq.LC.V_ON.value}), binary symbols only")
+    parser.add_argument('--v-off', default=None, help=f"dark drive amplitude (V, default {daq.LC.V_OFF.value}), binary symbols only")
+    parser.add_argument('--preemphasis', default=daq.LC.PREEMPHASIS.value, help="comma separated transmit shaping (off, on), sim only")
+    parser.add_argument('--ai-rate', default=f"{daq.DaqAI.FREQ_SAMPLE.value}", help="AI sample rate (Hz)")
+    parser.add_argument('--threshold', default=None, help="comma separated strategies (default: fixed:<recv.BIT_THRESH> "
+                        "or for PAM calibrated, then midpoint,levels,adaptive)")
+    parser.add_argument('--decision', default=daq.DaqAI.DECISION.value, help="comma separated symbol decisions (sample, integrate)")
+    parser.add_argument('--front-end', default=daq.DaqAI.FRONT_END.value, help="comma separated receive front-ends (none, lockin)")
+    parser.add_argument('--equalizer', default=daq.DaqAI.EQUALIZER.value, help="comma separated equalizers (none, dfe)")
+    parser.add_argument('--captures', default=None, help="sweep over the captures of this directory instead of the LC model")
+    parser.add_argument('--bytes', type=int, default=64, help="random payload bytes per message (sim)")
+    parser.add_argument('--repeats', type=int, default=2, help="messages per point (sim)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target-ber', type=float, default=1e-3)
+    parser.add_argument('--target-fer', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--format', choices=('json', 'csv'), default='json')
+    parser.add_argument('--output', default=None, help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+    pam = daq.LC.BITS_PER_SYMBOL.value > 1
+    if pam and not args.captures and (args.v_on or args.v_off):
+        parser.error("PAM levels come from the BV calibration, --v-on/--v-off only apply to binary symbols")
+    args.v_on = args.v_on or f"{daq.LC.V_ON.value}"
+    args.v_off = args.v_off or f"{daq.LC.V_OFF.value}"
+    if args.threshold is None:
+        first = 'calibrated' if pam else f"fixed:{recv.BIT_THRESH}"
+        args.threshold = first + ",midpoint,levels,adaptive"
+
+    if args.captures:
+        source, options = 'captures', {'paths': sorted(glob.glob(os.path.join(args.captures, '*.modrf')))}
+    else:
+        source, options = 'sim', {'num_bytes': args.bytes, 'repeats': args.repeats, 'seed': args.seed}
+    points = grid(args)
+    t_start = time.perf_counter()
+    results = sweep(points, source, options, args.workers)
+    best = recommend(results, args.target_ber, args.target_fer)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump({'source': source, 'target_ber': args.target_ber, 'target_fer': args.target_fer,
+                       'recommendation': best, 'points': results}, out, indent=2)
+            out.write('\n')
+        else:
+            writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"[sweep.py] {len(results)} points in {time.perf_counter() - t_start:.1f} s, "
+          f"{sum(r['meets_target'] for r in results)} meet BER <= {args.target_ber}", file=sys.stderr)
+    if best is None:
+        print("[sweep.py] No point meets the targets.", file=sys.stderr)
+    else:
+        chosen = {key: best[key] for key in ('mod_period', 'bits_per_symbol', 'freq_lc', 'v_on', 'v_off', 'preemphasis', 'ai_rate', 'threshold', 'decision', 'front_end', 'equalizer') if key in best}
+        print(f"[sweep.py] Recommended: {chosen} | goodput {best['goodput_Bps']:.2f} B/s, "
+              f"latency {best['latency_s']} s, BER {best['ber']:.2e}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
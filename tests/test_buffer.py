@@ -5,7 +5,7 @@
 from utils import daq
 import numpy as np
 import ctypes, time
-from mcculw import ul
+from utils.daq import ul
 from mcculw.enums import ScanOptions, FunctionType, Status
 
 # AI Configuration for USB DAQ
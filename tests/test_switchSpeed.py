@@ -3,8 +3,8 @@
     using Measurement Computing DAC and ADC (both are abbriviated general to DAQ).
 """
 from utils.daq import configure_devices, daq_ao_scan, daq_ai_scan, McculwUsbDaq, DaqAO, DaqAI, LC
-from utils import waves
-from mcculw import ul
+from utils import waves, viz
+from utils.daq import ul
 from mcculw.enums import ScanOptions, FunctionType, Status
 import ctypes
 from time import sleep
@@ -78,7 +78,8 @@ def bvCurve():
     if not memhandle_ai:
         raise Exception('[Error] [AI] Memory allocation.')
     
-    buff_ai = (ctypes.c_double * DaqAI.FREQ_SAMPLE.value)()
+    # Zero-copy view of the scaled AI buffer
+    ring_ai = np.ctypeslib.as_array(ctypes.cast(memhandle_ai, ctypes.POINTER(ctypes.c_double)), shape=(DaqAI.FREQ_SAMPLE.value,))
     buff_ao = ctypes.cast(memhandle_ao, ctypes.POINTER(ctypes.c_ushort))
 
     # Set device scan options to constantly scan for background
@@ -122,8 +123,7 @@ def bvCurve():
                 num_buf_processed += 1
                 if num_buf_processed == 2:
                     # Copy entire buffer into the AI buffer 
-                    ul.scaled_win_buf_to_array(memhandle_ai, buff_ai, POINTS_TO_COPY, DaqAI.FREQ_SAMPLE.value - POINTS_TO_COPY)
-                    buf = np.copy(buff_ai)
+                    buf = ring_ai[POINTS_TO_COPY:].copy()
                     print(len(buf))
                     status_ai = Status.IDLE
 
@@ -140,7 +140,7 @@ def bvCurve():
         sleep(0.1)
         usb_202.release_device()
         usb_3101fs.release_device()
-        waves.plot_ai_buffer(f'Switch Speed: Sample LC', buf, window=5)
+        viz.plot_ai_buffer(f'Switch Speed: Sample LC', buf, window=5)
     
 if __name__ == "__main__":
     bvCurve()
\ No newline at end of file
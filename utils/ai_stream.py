@@ -0,0 +1,128 @@
+"""
+    Incremental reads from a CONTINUOUS background AI scan.
+
+    get_status gives the total points acquired. The driver ring buffer is
+    exposed as a NumPy array (np.ctypeslib.as_array, no copy) and the points
+    acquired since the previous read are handed out as a view into it; only
+    reads that wrap around the end of the ring are joined into a new array.
+
+    In raw mode the scan writes 16 bit counts (win_buf_alloc, no SCALEDATA),
+    a quarter of the bytes of scaled doubles, and read_volts scales them with
+    one vectorized multiply-add.
+"""
+from utils.daq import McculwUsbDaq, ul
+from utils.counts import daq_scaler
+from mcculw.enums import FunctionType, ScanOptions
+from typing import Tuple
+import numpy as np
+import ctypes
+
+class AiStreamMetrics():
+    ''' Counters reported by AiRingReader. '''
+    def __init__(self):
+        self.reads          = 0
+        self.samples_read   = 0
+        self.overruns       = 0 # reads where the scan lapped the reader
+        self.samples_lost   = 0
+        self.max_backlog    = 0 # largest number of points waiting at a read
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+def ai_buf_alloc(num_points:int, raw:bool=False):
+    ''' Memhandle for an AI scan, 16 bit counts if raw else scaled doubles. '''
+    return ul.win_buf_alloc(num_points) if raw else ul.scaled_win_buf_alloc(num_points)
+
+def ai_scan_options(raw:bool=False) -> ScanOptions:
+    ''' CONTINUOUS background scan options matching ai_buf_alloc. '''
+    options = ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS
+    return options if raw else options | ScanOptions.SCALEDATA
+
+class AiRingReader():
+    '''
+        Reader of new samples from an AI ring buffer.
+
+        Args:
+            daq: AI DAQ running the scan.
+            memhandle: ai_buf_alloc handle the scan writes to.
+            buffer_size: Points in the AI buffer (all channels).
+            num_chans: Interleaved channels, reads always return whole channel scans.
+            raw: The scan writes counts (no SCALEDATA) instead of volts.
+            recorder: Optional capture.CaptureRecorder every read is written to.
+    '''
+    def __init__(self, daq:McculwUsbDaq, memhandle, buffer_size:int, num_chans:int=1, raw:bool=False, recorder=None):
+        self.daq          = daq
+        self.memhandle    = memhandle
+        self.buffer_size  = buffer_size
+        self.num_chans    = num_chans
+        self.raw          = raw
+        self.scaler       = daq_scaler(daq) if raw else None
+        self.recorder     = recorder
+        self.metrics      = AiStreamMetrics()
+        ctype = ctypes.c_ushort if raw else ctypes.c_double
+        self.ring         = np.ctypeslib.as_array(ctypes.cast(memhandle, ctypes.POINTER(ctype)), shape=(buffer_size,))
+        self._consumed    = 0 # points handed out (or skipped) so far
+        self._last_count  = None
+        self._acquired    = 0 # unwrapped cur_count
+
+    def reset(self):
+        ''' Forget the previous scan, call before the scan is started again. '''
+        self._consumed   = 0
+        self._last_count = None
+        self._acquired   = 0
+
+    def acquired(self) -> int:
+        ''' Points acquired since the scan started, unwrapping the 32 bit cur_count. '''
+        _, cur_count, _ = ul.get_status(self.daq.daq_board_num, FunctionType.AIFUNCTION)
+        if self._last_count is not None:
+            self._acquired += (cur_count - self._last_count) % (1 << 32)
+        else:
+            self._acquired = cur_count
+        self._last_count = cur_count
+        return self._acquired
+
+    def read(self) -> Tuple[int, np.ndarray]:
+        '''
+            Every point acquired since the last read, in the buffer dtype (volts or counts).
+
+            Return:
+                (absolute index of the first point, points) - the index jumps forward
+                when the scan overwrote points before they were read. Unless the read
+                wrapped, points is a view of the driver buffer: it is only valid until
+                the scan laps it (one buffer duration), copy it to keep it longer.
+        '''
+        self.metrics.reads += 1
+        end = self.acquired()
+        end -= end % self.num_chans
+        backlog = end - self._consumed
+        self.metrics.max_backlog = max(self.metrics.max_backlog, backlog)
+        if backlog > self.buffer_size:
+            # Oldest points were overwritten, skip to what is still in the ring
+            lost = backlog - self.buffer_size
+            lost += -lost % self.num_chans
+            self.metrics.overruns += 1
+            self.metrics.samples_lost += lost
+            self._consumed += lost
+            backlog -= lost
+        start = self._consumed
+        if backlog <= 0:
+            return start, self.ring[:0]
+
+        first = start % self.buffer_size
+        count = min(backlog, self.buffer_size - first)
+        if count < backlog:
+            points = np.concatenate((self.ring[first:], self.ring[:backlog - count]))
+        else:
+            points = self.ring[first:first + count]
+        self._consumed = end
+        self.metrics.samples_read += backlog
+        if self.recorder is not None:
+            self.recorder.write_ai(start, points)
+        return start, points
+
+    def read_volts(self) -> Tuple[int, np.ndarray]:
+        ''' read, with raw counts scaled to volts. '''
+        start, points = self.read()
+        if self.scaler is not None:
+            points = self.scaler.to_volts(points)
+        return start, points
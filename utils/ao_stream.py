@@ -0,0 +1,194 @@
+"""
+    Tear-free AO streaming for CONTINUOUS background output scans.
+
+    The win_buf_alloc buffer is split into N segments. get_status reports how
+    many points the DAQ has transferred, and only segments that were already
+    transferred are refilled from a generator of upcoming samples, so the
+    buffer is never overwritten while it is being read.
+"""
+from utils.daq import McculwUsbDaq, ul, sleep, async_sleep
+from utils.counts import write_buffer
+from mcculw.enums import FunctionType
+from typing import Iterable
+import numpy as np
+
+class AoStreamMetrics():
+    ''' Counters reported by AoStreamer. '''
+    def __init__(self):
+        self.polls            = 0
+        self.segments_written = 0
+        self.samples_written  = 0
+        self.idle_segments    = 0
+        self.underruns        = 0 # poll events where stale data was output
+        self.stale_segments   = 0 # segments output without being refilled
+        self.min_lead         = None # smallest lead (points) of written data over the scan
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class AoStreamer():
+    '''
+        Segment scheduler for a CONTINUOUS | BACKGROUND AO scan.
+
+        Args:
+            daq: AO DAQ running the scan.
+            buffer: POINTER(c_ushort) cast of the AO memhandle.
+            buffer_size: Points in the AO buffer (all channels).
+            rate: Scan rate per channel (Hz).
+            idle: Counts written once the source is exhausted. A scalar or an array
+                repeated to fill a segment (e.g. one carrier period at 0 V).
+            num_segments: Number of segments the buffer is split into.
+            num_chans: Interleaved channels, a segment must hold whole channel scans.
+    '''
+    def __init__(
+            self,
+            daq:McculwUsbDaq,
+            buffer,
+            buffer_size:int,
+            rate:int,
+            idle,
+            num_segments:int=2,
+            num_chans:int=1):
+        if num_segments < 2:
+            raise Exception("[ERROR] AO streaming needs at least 2 segments.")
+        seg_len = buffer_size // num_segments
+        if seg_len * num_segments != buffer_size or seg_len % num_chans:
+            raise Exception(
+                f"[ERROR] Buffer of {buffer_size} points can't be split into {num_segments} "
+                f"segments of whole {num_chans} channel scans."
+            )
+        self.daq          = daq
+        self.buffer       = buffer
+        self.buffer_size  = buffer_size
+        self.num_segments = num_segments
+        self.seg_len      = seg_len
+        self.rate         = rate * num_chans # points per second
+        self.idle         = np.resize(np.asarray(idle, dtype=np.uint16), seg_len)
+        self.metrics      = AoStreamMetrics()
+        self._source      = iter(())
+        self._pending     = np.empty(0, dtype=np.uint16)
+        self._exhausted   = True
+        self._written     = 0 # absolute index of the next segment to write
+        self._data_end    = 0 # absolute point after the last source sample written
+        self._last_count  = None
+        self._transferred = 0 # unwrapped cur_count
+
+    def set_source(self, source:Iterable):
+        ''' Queue a new source of count arrays (any length) after the pending samples. '''
+        self._source = iter(source)
+        self._exhausted = False
+
+    @property
+    def exhausted(self) -> bool:
+        ''' True once every source sample has been written into the buffer. '''
+        return self._exhausted and not len(self._pending)
+
+    def _next_segment(self):
+        chunks = [self._pending]
+        have = len(self._pending)
+        while have < self.seg_len and not self._exhausted:
+            try:
+                chunk = np.asarray(next(self._source), dtype=np.uint16).ravel()
+            except StopIteration:
+                self._exhausted = True
+                break
+            chunks.append(chunk)
+            have += len(chunk)
+        data = np.concatenate(chunks) if len(chunks) > 1 else self._pending
+        seg, self._pending = data[:self.seg_len], data[self.seg_len:]
+        num_data = len(seg)
+        if num_data < self.seg_len:
+            if not num_data:
+                self.metrics.idle_segments += 1
+            seg = np.concatenate((seg, self.idle[num_data:]))
+        return seg, num_data
+
+    def _write_segment(self):
+        seg, num_data = self._next_segment()
+        write_buffer(self.buffer, seg, (self._written % self.num_segments) * self.seg_len)
+        if num_data:
+            self._data_end = self._written * self.seg_len + num_data
+        self._written += 1
+        self.metrics.segments_written += 1
+        self.metrics.samples_written += self.seg_len
+
+    def prime(self, source:Iterable=None):
+        ''' Fill the whole buffer before the scan is started. '''
+        if source is not None:
+            self.set_source(source)
+        self._written = 0
+        self._data_end = 0
+        self._last_count = None
+        self._transferred = 0
+        for _ in range(self.num_segments):
+            self._write_segment()
+
+    def transferred(self) -> int:
+        ''' Points transferred since the scan started, unwrapping the 32 bit cur_count. '''
+        _, cur_count, _ = ul.get_status(self.daq.daq_board_num, FunctionType.AOFUNCTION)
+        if self._last_count is not None:
+            self._transferred += (cur_count - self._last_count) % (1 << 32)
+        else:
+            self._transferred = cur_count
+        self._last_count = cur_count
+        return self._transferred
+
+    def poll(self) -> int:
+        '''
+            Refill every segment the DAQ has finished transferring.
+
+            Return:
+                number of segments written.
+        '''
+        self.metrics.polls += 1
+        playing = self.transferred() // self.seg_len
+        if self._written <= playing:
+            # The DAQ reached segments that were not refilled in time
+            self.metrics.underruns += 1
+            self.metrics.stale_segments += playing - self._written + 1
+            self._written = playing + 1
+        lead = self._written * self.seg_len - self._transferred
+        if self.metrics.min_lead is None or lead < self.metrics.min_lead:
+            self.metrics.min_lead = lead
+
+        written = 0
+        while self._written < playing + self.num_segments:
+            self._write_segment()
+            written += 1
+        return written
+
+    def _run_steps(self, source:Iterable, poll_interval:float, drain:bool):
+        ''' Polls of run, yields the time to wait before the next one. '''
+        if source is not None:
+            self.set_source(source)
+        if poll_interval is None:
+            poll_interval = self.seg_len / self.rate / 4
+        while not self.exhausted:
+            self.poll()
+            yield poll_interval
+        if drain:
+            # Wait for the end of the segment holding the last sample, then one more
+            # poll refills its slot so the ring only replays idle samples.
+            end = -(-self._data_end // self.seg_len) * self.seg_len
+            while self.transferred() < end:
+                self.poll()
+                yield poll_interval
+            self.poll()
+
+    def run(self, source:Iterable=None, poll_interval:float=None, drain:bool=True):
+        '''
+            Stream a source until every sample has been written (and played if drain).
+
+            Args:
+                source: Iterable of count arrays, appended to the pending samples.
+                poll_interval: Seconds between polls, defaults to a quarter segment.
+                drain: Keep polling until the last source sample has been output and
+                    every segment holds idle samples again.
+        '''
+        for wait in self._run_steps(source, poll_interval, drain):
+            sleep(wait)
+
+    async def run_async(self, source:Iterable=None, poll_interval:float=None, drain:bool=True):
+        ''' run as an asyncio task, other tasks run between polls. '''
+        for wait in self._run_steps(source, poll_interval, drain):
+            await async_sleep(wait)
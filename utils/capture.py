@@ -0,0 +1,234 @@
+"""
+    Raw capture of a link run: every acquired AI block and the AO symbols sent.
+
+    A capture is a single append-only file:
+
+        magic (8 bytes) | version (uint32) | header length (uint32) | JSON header
+        record: tag (4 bytes) | lane (uint32) | start (int64) | nbytes (uint64) | data
+
+    The JSON header holds the rates, ranges, channels, AI sample dtype (volts or
+    raw counts with their scaling) and a snapshot of daq_config.ini. Records and
+    the header are padded to 8 bytes so every record is an aligned view of the
+    file. AI records hold the points of one AiRingReader read (start is the
+    absolute point index, it jumps forward over overruns). AO records hold the
+    symbol values of one packet (lane is the AO channel offset, start the
+    packet sequence number).
+
+    Capture reopens the file as an np.memmap, only the record headers are read
+    up front, and CaptureReader replays the AI records through the same read /
+    read_volts interface as AiRingReader.
+"""
+from utils import daq
+from utils.ai_stream import AiStreamMetrics
+from mcculw.enums import ULRange
+from typing import Iterator, List, Tuple
+import numpy as np
+import io, json, os, struct, time
+
+MAGIC   = b'MODRFCAP'
+VERSION = 1
+_PREFIX = struct.Struct('<8sII')
+_RECORD = struct.Struct('<4sIqQ')
+TAG_AI  = b'AI\0\0'
+TAG_AO  = b'AO\0\0'
+
+def _pad(num_bytes:int) -> int:
+    return -num_bytes % 8
+
+def config_snapshot() -> str:
+    ''' daq_config.ini as loaded by utils.daq. '''
+    text = io.StringIO()
+    daq.config.write(text)
+    return text.getvalue()
+
+def capture_header(ai_daq:daq.McculwUsbDaq, raw:bool=False, scaler=None, training=None) -> dict:
+    '''
+        Header of a capture of the configured link.
+
+        Args:
+            ai_daq: AI DAQ running the scan.
+            raw: AI records hold counts instead of volts.
+            scaler: VoltScaler of the raw counts (AiRingReader.scaler).
+            training: training.TrainingResult the link adopted, if any.
+    '''
+    ai = {
+        'rate':      daq.DaqAI.FREQ_SAMPLE.value,
+        'range':     ULRange(daq.DaqAI.AI_RANGE.value).name,
+        'chan_low':  daq.DaqAI.CHAN_LOW.value,
+        'chan_hig':  daq.DaqAI.CHAN_HIG.value,
+        'dtype':     'uint16' if raw else 'float64',
+    }
+    if raw:
+        ai['resolution'] = ai_daq.daq_ai_resolution
+        ai['offset'] = scaler.offset if scaler is not None else None
+        ai['gain'] = scaler.gain if scaler is not None else None
+    header = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backend': daq.ul.name,
+        'ai': ai,
+        'ao': {
+            'rate':     daq.DaqAO.FREQ_SAMPLE.value,
+            'range':    ULRange(daq.DaqAO.AO_RANGE.value).name,
+            'chan_low': daq.DaqAO.CHAN_LOW.value,
+            'chan_hig': daq.DaqAO.CHAN_HIG.value,
+        },
+        'config': config_snapshot(),
+    }
+    if training is not None:
+        header['training'] = training.as_dict()
+    return header
+
+def capture_path(directory:str) -> str:
+    ''' Time stamped capture file in directory. '''
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, time.strftime('capture_%Y%m%d_%H%M%S.modrf'))
+
+class CaptureRecorder():
+    '''
+        Writer of a capture file.
+
+        Args:
+            path: File to create (overwritten).
+            header: capture_header of the run.
+    '''
+    def __init__(self, path:str, header:dict):
+        self.path    = path
+        self.header  = header
+        self.records = 0
+        self.bytes   = 0
+        self._file   = open(path, 'wb')
+        body = json.dumps(header).encode()
+        body += b' ' * _pad(_PREFIX.size + len(body))
+        self._file.write(_PREFIX.pack(MAGIC, VERSION, len(body)) + body)
+
+    def _write(self, tag:bytes, lane:int, start:int, data:np.ndarray):
+        data = np.ascontiguousarray(data)
+        self._file.write(_RECORD.pack(tag, lane, start, data.nbytes))
+        self._file.write(data.data)
+        self._file.write(b'\0' * _pad(data.nbytes))
+        self.records += 1
+        self.bytes += data.nbytes
+
+    def write_ai(self, start:int, points:np.ndarray):
+        ''' Points of one AI read (buffer dtype), start is the absolute point index. '''
+        if len(points):
+            self._write(TAG_AI, 0, start, points)
+
+    def write_symbols(self, lane:int, seq:int, symbols:np.ndarray):
+        ''' Symbol values of one packet sent on lane. '''
+        self._write(TAG_AO, lane, seq, np.asarray(symbols, dtype=np.uint8))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Capture():
+    '''
+        Memory mapped capture file. A record cut short (run killed while
+        writing) ends the capture.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, header_len = _PREFIX.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise Exception(f"[ERROR] {path} is not a ModRF capture.")
+        if version != VERSION:
+            raise Exception(f"[ERROR] Capture version {version} of {path} is not supported.")
+        self.header    = json.loads(bytes(self._map[_PREFIX.size:_PREFIX.size + header_len]))
+        self.ai_dtype  = np.dtype(self.header['ai']['dtype'])
+        self.num_chans = self.header['ai']['chan_hig'] - self.header['ai']['chan_low'] + 1
+        self._ai = [] # (start, offset, nbytes)
+        self._ao = [] # (lane, seq, offset, nbytes)
+        self._index(_PREFIX.size + header_len)
+
+    def _index(self, offset:int):
+        size = len(self._map)
+        while offset + _RECORD.size <= size:
+            tag, lane, start, nbytes = _RECORD.unpack_from(self._map, offset)
+            data = offset + _RECORD.size
+            if data + nbytes > size:
+                break
+            if tag == TAG_AI:
+                self._ai.append((start, data, nbytes))
+            elif tag == TAG_AO:
+                self._ao.append((lane, start, data, nbytes))
+            offset = data + nbytes + _pad(nbytes)
+
+    @property
+    def num_blocks(self) -> int:
+        return len(self._ai)
+
+    @property
+    def num_points(self) -> int:
+        ''' AI points recorded (all channels). '''
+        return sum(nbytes for _, _, nbytes in self._ai) // self.ai_dtype.itemsize
+
+    def block(self, i:int) -> Tuple[int, np.ndarray]:
+        ''' (start, points) of AI record i, points is a read-only view of the file. '''
+        start, offset, nbytes = self._ai[i]
+        return start, self._map[offset:offset + nbytes].view(self.ai_dtype)
+
+    def blocks(self) -> Iterator[Tuple[int, np.ndarray]]:
+        for i in range(len(self._ai)):
+            yield self.block(i)
+
+    def symbols(self) -> List[Tuple[int, int, np.ndarray]]:
+        ''' (lane, seq, symbols) of every packet sent, in send order. '''
+        return [(lane, seq, self._map[offset:offset + nbytes]) for lane, seq, offset, nbytes in self._ao]
+
+    def to_volts(self, points:np.ndarray) -> np.ndarray:
+        ''' AI points in volts, raw counts are scaled with the recorded offset and gain. '''
+        ai = self.header['ai']
+        if self.ai_dtype == np.float64:
+            return points
+        if ai.get('gain') is None:
+            raise Exception("[ERROR] Raw capture without a linear count scaling.")
+        volts = np.multiply(points, ai['gain'], dtype=np.float64)
+        volts += ai['offset']
+        return volts
+
+    def close(self):
+        ''' Drop the mapping, it is unmapped once no block view is left. '''
+        self._map = None
+
+class CaptureReader():
+    '''
+        Replay of the AI records of a capture with the AiRingReader interface,
+        one record per read.
+    '''
+    def __init__(self, capture:Capture):
+        self.capture   = capture
+        self.num_chans = capture.num_chans
+        self.metrics   = AiStreamMetrics()
+        self._next     = 0
+        self._end      = 0 # absolute index after the last point read
+
+    @property
+    def done(self) -> bool:
+        return self._next >= self.capture.num_blocks
+
+    def read(self) -> Tuple[int, np.ndarray]:
+        self.metrics.reads += 1
+        if self.done:
+            return self._end, np.zeros(0, dtype=self.capture.ai_dtype)
+        start, points = self.capture.block(self._next)
+        self._next += 1
+        if start > self._end:
+            # Overrun while recording
+            self.metrics.overruns += 1
+            self.metrics.samples_lost += start - self._end
+        self._end = start + len(points)
+        self.metrics.samples_read += len(points)
+        self.metrics.max_backlog = max(self.metrics.max_backlog, len(points))
+        return start, points
+
+    def read_volts(self) -> Tuple[int, np.ndarray]:
+        start, points = self.read()
+        return start, self.capture.to_volts(points)
@@ -0,0 +1,312 @@
+"""
+    Link configuration: daq_config.ini loaded into frozen dataclass profiles.
+
+    A profile is the base sections of the file with the overrides of its named
+    sections on top. [Framing:fast] or [LC:cell2] hold only the keys that differ,
+    so one file describes several cells or bit rates:
+
+        [Framing:fast]
+        mod_period = 0.025
+
+    load_profile() validates every value once and precomputes the derived
+    quantities (channels, buffer sizes, samples per symbol). Profiles are cached
+    per file, profile name and modification time, a changed file is loaded again.
+
+    The file is the given path, else MODRF_CONFIG, else daq_config.ini in the
+    working directory, else the one next to the scripts. Relative paths in it
+    (PATHS) are relative to the file, not to the working directory.
+"""
+from mcculw.enums import ULRange
+from dataclasses import dataclass, field, fields, MISSING
+from typing import Dict, List, Tuple
+import configparser, os, threading
+
+CONFIG_FILE = 'daq_config.ini'
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@dataclass(frozen=True)
+class LcConfig():
+    v_on:            float
+    v_off:           float
+    freq_lc:         int
+    bits_per_symbol: int   = 1
+    bv_calibration:  str   = 'bv_calibration.npz'
+    preemphasis:     str   = 'off'
+    overdrive_on:    float = 0.0
+    overdrive_off:   float = 3.0
+    lc_fit:          str   = 'lc_fit.json'
+
+@dataclass(frozen=True)
+class AoConfig():
+    chan_low:     int
+    chan_hig:     int
+    amplitude:    int
+    freq_sample:  int
+    duration:     int
+    ao_range:     ULRange
+    num_chans:    int = field(init=False)
+    buffer_size:  int = field(init=False) # points of the AO scan buffer
+
+    def __post_init__(self):
+        object.__setattr__(self, 'num_chans', self.chan_hig - self.chan_low + 1)
+        object.__setattr__(self, 'buffer_size', self.freq_sample * self.duration * self.num_chans)
+
+@dataclass(frozen=True)
+class AiConfig():
+    chan_low:          int
+    chan_hig:          int
+    freq_sample:       int
+    duration:          int
+    ai_range:          ULRange
+    bit_low:           float
+    bit_hig:           float
+    acquisition:       str   = 'scaled'
+    capture_dir:       str   = ''
+    threshold:         str   = 'fixed'
+    threshold_tau:     float = 2.0
+    decision:          str   = 'sample'
+    decision_guard:    float = 0.25
+    front_end:         str   = 'none'
+    lockin_harmonic:   int   = 0
+    lockin_cutoff:     float = 25.0
+    lockin_decimation: int   = 5
+    equalizer:         str   = 'none'
+    eq_ff_taps:        int   = 3
+    eq_fb_taps:        int   = 2
+    eq_step:           float = 0.2
+    eq_block:          int   = 8
+    num_chans:         int   = field(init=False)
+    buffer_size:       int   = field(init=False) # points of the AI scan buffer
+
+    def __post_init__(self):
+        object.__setattr__(self, 'num_chans', self.chan_hig - self.chan_low + 1)
+        object.__setattr__(self, 'buffer_size', self.freq_sample * self.duration * self.num_chans)
+
+@dataclass(frozen=True)
+class FramingConfig():
+    max_payload: int   = 32
+    crc_bits:    int   = 16
+    mod_period:  float = 0.080
+    fec:         str   = 'none'
+    rs_nsym:     int   = 8
+    rs_block:    int   = 64
+
+@dataclass(frozen=True)
+class TrainingConfig():
+    mode:          str   = 'off'
+    hold:          float = 0.3
+    repeats:       int   = 4
+    target_margin: float = 6.0
+    min_period:    float = 0.010
+    max_period:    float = 0.200
+    period_step:   float = 0.005
+    result:        str   = 'link_training.json'
+
+@dataclass(frozen=True)
+class SocketConfig():
+    host: str
+    port: int
+
+@dataclass(frozen=True)
+class DevicesConfig():
+    registry: str = 'device_registry.json' # '' = enumerate on every start
+
+# Settings holding a file or directory, resolved against the config file's directory
+PATHS = (
+    ('LC',       'bv_calibration'),
+    ('LC',       'lc_fit'),
+    ('DaqAI',    'capture_dir'),
+    ('Training', 'result'),
+    ('Devices',  'registry'),
+    ('Sim',      'bv_curve'),
+)
+
+# Profile attribute, ini section and dataclass of every typed section
+SECTIONS = (
+    ('lc',       'LC',       LcConfig),
+    ('ao',       'DaqAO',    AoConfig),
+    ('ai',       'DaqAI',    AiConfig),
+    ('framing',  'Framing',  FramingConfig),
+    ('training', 'Training', TrainingConfig),
+    ('sockets',  'Socket',   SocketConfig),
+    ('devices',  'Devices',  DevicesConfig),
+)
+
+@dataclass(frozen=True)
+class Profile():
+    '''
+        One validated link configuration.
+
+        Args:
+            name: Profile name, '' for the base sections.
+            path: File it was loaded from.
+            lc, ao, ai, framing, training, sockets, devices: Typed sections.
+            backend: [Backend] name.
+            parser: Effective sections (base with the profile overrides), for the
+                parts read as ini ([Sim], capture snapshots).
+    '''
+    name:     str
+    path:     str
+    lc:       LcConfig
+    ao:       AoConfig
+    ai:       AiConfig
+    framing:  FramingConfig
+    training: TrainingConfig
+    sockets:  SocketConfig
+    devices:  DevicesConfig = DevicesConfig()
+    backend:  str = 'mcculw'
+    parser:   configparser.ConfigParser = field(default=None, compare=False, repr=False)
+    ao_samples_per_symbol: int = field(init=False)
+    ai_samples_per_symbol: int = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'ao_samples_per_symbol', int(self.framing.mod_period * self.ao.freq_sample))
+        object.__setattr__(self, 'ai_samples_per_symbol', int(self.framing.mod_period * self.ai.freq_sample))
+
+#__________________ Loading ___________________________________________________
+
+def _cast(kind, text:str):
+    if kind is ULRange:
+        return ULRange[text.strip()]
+    return kind(text)
+
+def _resolve(value:str, base_dir:str) -> str:
+    ''' value under base_dir if it is a relative path, empty (off) stays empty. '''
+    value = value.strip()
+    return os.path.join(base_dir, value) if value and base_dir and not os.path.isabs(value) else value
+
+def _section(cls, parser:configparser.ConfigParser, section:str, path:str):
+    '''
+        Dataclass of one ini section, missing keys take the dataclass defaults.
+        PATHS, given or default, are resolved against the directory of path.
+    '''
+    base_dir = os.path.dirname(os.path.abspath(path)) if path else ''
+    values = {}
+    for f in fields(cls):
+        if not f.init:
+            continue
+        text = parser.get(section, f.name, fallback=None)
+        if text is None:
+            if f.default is MISSING:
+                raise Exception(f"[ERROR] {path}: [{section}] {f.name} is missing.")
+            if (section, f.name) in PATHS:
+                values[f.name] = _resolve(f.default, base_dir)
+            continue
+        if (section, f.name) in PATHS:
+            text = _resolve(text, base_dir)
+        try:
+            values[f.name] = _cast(f.type, text)
+        except (KeyError, ValueError):
+            raise Exception(f"[ERROR] {path}: [{section}] {f.name} = {text!r} is not a {f.type.__name__}.")
+    return cls(**values)
+
+def profile_names(parser:configparser.ConfigParser) -> List[str]:
+    ''' Names of the profiles with override sections in parser. '''
+    return sorted({section.split(':', 1)[1] for section in parser.sections() if ':' in section})
+
+def effective_sections(parser:configparser.ConfigParser, name:str='') -> configparser.ConfigParser:
+    ''' Base sections of parser with the [<section>:<name>] overrides applied. '''
+    if name and name not in profile_names(parser):
+        raise Exception(f"[ERROR] Unknown profile '{name}', the config has {profile_names(parser) or 'none'}.")
+    merged = configparser.ConfigParser()
+    for section in parser.sections():
+        if ':' not in section:
+            merged[section] = dict(parser[section])
+    for section in parser.sections():
+        base, _, profile = section.partition(':')
+        if profile and profile == name:
+            if not merged.has_section(base):
+                merged[base] = {}
+            for key, value in parser[section].items():
+                merged[base][key] = value
+    return merged
+
+def validate(profile:Profile) -> List[str]:
+    ''' Problems of a profile, empty if it is usable. '''
+    lc, ao, ai, fr, tr = profile.lc, profile.ao, profile.ai, profile.framing, profile.training
+    checks = (
+        (ao.num_chans >= 1 and ao.chan_low >= 0, "[DaqAO] chan_hig must not be below chan_low"),
+        (ai.num_chans >= 1 and ai.chan_low >= 0, "[DaqAI] chan_hig must not be below chan_low"),
+        (ao.freq_sample > 0 and ao.duration > 0, "[DaqAO] freq_sample and duration must be positive"),
+        (ai.freq_sample > 0 and ai.duration > 0, "[DaqAI] freq_sample and duration must be positive"),
+        (1 <= lc.bits_per_symbol <= 3, "[LC] bits_per_symbol must be 1, 2 or 3"),
+        (lc.preemphasis in ('off', 'on'), "[LC] preemphasis must be off or on"),
+        (ai.acquisition in ('scaled', 'raw'), "[DaqAI] acquisition must be scaled or raw"),
+        (ai.threshold in ('fixed', 'adaptive'), "[DaqAI] threshold must be fixed or adaptive"),
+        (ai.decision in ('sample', 'integrate'), "[DaqAI] decision must be sample or integrate"),
+        (0 <= ai.decision_guard < 0.5, "[DaqAI] decision_guard must be in [0, 0.5)"),
+        (ai.front_end in ('none', 'lockin'), "[DaqAI] front_end must be none or lockin"),
+        (ai.lockin_decimation >= 1 and ai.lockin_cutoff > 0, "[DaqAI] lockin_decimation and lockin_cutoff must be positive"),
+        (ai.equalizer in ('none', 'dfe'), "[DaqAI] equalizer must be none or dfe"),
+        (ai.eq_ff_taps >= 1 and ai.eq_fb_taps >= 0 and ai.eq_block >= 1, "[DaqAI] eq_ff_taps, eq_block >= 1 and eq_fb_taps >= 0"),
+        (1 <= fr.max_payload <= 255, "[Framing] max_payload must be 1 - 255"),
+        (fr.crc_bits in (16, 32), "[Framing] crc_bits must be 16 or 32"),
+        (fr.mod_period > 0, "[Framing] mod_period must be positive"),
+        (fr.fec in ('none', 'hamming74', 'rs'), "[Framing] fec must be none, hamming74 or rs"),
+        (tr.mode in ('off', 'startup', 'saved'), "[Training] mode must be off, startup or saved"),
+        (0 < tr.min_period <= tr.max_period and tr.period_step > 0, "[Training] needs 0 < min_period <= max_period and period_step > 0"),
+        (profile.backend in ('mcculw', 'sim'), "[Backend] name must be mcculw or sim"),
+    )
+    problems = [problem for ok, problem in checks if not ok]
+    if profile.ai_samples_per_symbol < 1:
+        problems.append(f"[Framing] mod_period {fr.mod_period} s is shorter than one AI sample")
+    return problems
+
+def build_profile(parser:configparser.ConfigParser, name:str='', path:str='') -> Profile:
+    ''' Validated profile name of the sections in parser. '''
+    merged = effective_sections(parser, name)
+    # The sections read as ini ([Sim], capture snapshots) see the same resolved paths
+    base_dir = os.path.dirname(os.path.abspath(path)) if path else ''
+    for section, key in PATHS:
+        if merged.has_option(section, key):
+            merged[section][key] = _resolve(merged[section][key], base_dir)
+    profile = Profile(
+        name=name,
+        path=path,
+        backend=merged.get('Backend', 'name', fallback='mcculw'),
+        parser=merged,
+        **{attr: _section(cls, merged, section, path) for attr, section, cls in SECTIONS},
+    )
+    problems = validate(profile)
+    if problems:
+        label = f"profile '{name}' of {path}" if name else path
+        raise Exception(f"[ERROR] Invalid {label}: " + "; ".join(problems) + ".")
+    return profile
+
+def config_path(path:str=None) -> str:
+    ''' Absolute path of the config file to load (see the module docstring). '''
+    path = path or os.environ.get('MODRF_CONFIG')
+    if path:
+        if not os.path.isfile(path):
+            raise Exception(f"[ERROR] Config file {path} not found.")
+        return os.path.abspath(path)
+    for candidate in (CONFIG_FILE, os.path.join(REPO_DIR, CONFIG_FILE)):
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+    raise Exception(f"[ERROR] No {CONFIG_FILE} in {os.getcwd()} or {REPO_DIR}, set MODRF_CONFIG.")
+
+_cache:Dict[Tuple[str, str], Tuple[int, Profile]] = {}
+_lock = threading.Lock()
+
+def load_profile(name:str='', path:str=None) -> Profile:
+    '''
+        Profile name ('' for the base sections) of the config file, from the cache
+        unless the file changed since it was loaded.
+    '''
+    path = config_path(path)
+    name = name or ''
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        cached = _cache.get((path, name))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    profile = build_profile(parser, name, path)
+    with _lock:
+        _cache[(path, name)] = (mtime, profile)
+    return profile
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,165 @@
+"""
+    Vectorized engineering units to DAQ count conversion.
+
+    mcculw's from_eng_units converts one sample per FFI call. The waveform
+    builders write 10k+ samples per buffer, so instead the linear count
+    mapping of a (board, ULRange) pair is resolved once and whole NumPy
+    arrays are converted in one step, then bulk copied into the AO buffer.
+    VoltScaler does the same for raw AI counts against to_eng_units.
+"""
+from utils.daq import McculwUsbDaq, ul
+from mcculw.enums import ULRange
+from functools import lru_cache
+import numpy as np
+import ctypes
+
+# Candidate transfer functions (count span, rounding) a UL driver may use.
+# The one matching the driver on the probe set is kept.
+_ROUNDING = {
+    'half_up': lambda x: np.floor(x + 0.5),
+    'nearest': np.rint,
+    'floor':   np.floor,
+}
+
+class CountConverter():
+    '''
+        Linear eng units -> counts mapping for a single (board, ULRange).
+
+        The mapping is calibrated against from_eng_units on a small probe set
+        (grid points, half-LSB boundaries and out of range values) so the
+        vectorized path stays bit-exact with the driver. If no candidate
+        matches, conversion falls back to the per-sample driver call.
+    '''
+    def __init__(self, board_num:int, ul_range:ULRange, resolution:int=16):
+        self.board_num  = board_num
+        self.ul_range   = ULRange(ul_range)
+        self.resolution = resolution
+        self.max_count  = (1 << resolution) - 1
+        self.v_min      = float(self.ul_range.range_min)
+        self.v_max      = float(self.ul_range.range_max)
+        self.span       = None
+        self.rounding   = None
+        self._calibrate()
+
+    @property
+    def is_vectorized(self) -> bool:
+        return self.span is not None
+
+    def _probe_values(self) -> np.ndarray:
+        fsr = self.v_max - self.v_min
+        lsb = fsr / (1 << self.resolution)
+        grid = np.linspace(self.v_min, self.v_max, 17)
+        # Half-LSB boundaries spread over the whole span, each next to one of the other
+        # parity so round half up and round half to even disagree on some of them
+        counts = np.unique(np.round(np.linspace(1, self.max_count - 2, 33)))
+        half = self.v_min + (np.concatenate((counts, counts + 1)) + 0.5) * lsb
+        outside = np.array([self.v_min - 1.0, self.v_max + 1.0, 0.0])
+        # Driver receives single precision values (c_float)
+        return np.concatenate([grid, half, outside]).astype(np.float32)
+
+    def _calibrate(self):
+        probes = self._probe_values()
+        expected = np.array([
+            ul.from_eng_units(board_num=self.board_num, ul_range=self.ul_range, eng_units_value=float(v))
+            for v in probes
+        ])
+        for span in (1 << self.resolution, self.max_count):
+            for name in _ROUNDING:
+                self.span, self.rounding = span, name
+                if np.array_equal(self._convert(probes), expected):
+                    return
+        self.span, self.rounding = None, None
+
+    def _convert(self, volts:np.ndarray) -> np.ndarray:
+        v = np.asarray(volts, dtype=np.float32).astype(np.float64)
+        counts = _ROUNDING[self.rounding]((v - self.v_min) * (self.span / (self.v_max - self.v_min)))
+        return np.clip(counts, 0, self.max_count).astype(np.uint16)
+
+    def to_counts(self, volts) -> np.ndarray:
+        ''' Convert an array of voltages into uint16 DAQ counts. '''
+        if self.is_vectorized:
+            return self._convert(volts)
+        return np.array([
+            ul.from_eng_units(board_num=self.board_num, ul_range=self.ul_range, eng_units_value=float(v))
+            for v in np.ravel(volts)
+        ], dtype=np.uint16).reshape(np.shape(volts))
+
+@lru_cache(maxsize=None)
+def get_converter(board_num:int, ul_range:ULRange, resolution:int=16) -> CountConverter:
+    ''' Converter is built (and calibrated) once per (board, ULRange, resolution). '''
+    return CountConverter(board_num, ul_range, resolution)
+
+def daq_converter(daq:McculwUsbDaq) -> CountConverter:
+    ''' Handle function to fetch the AO converter of a DAQ. '''
+    return get_converter(daq.daq_board_num, ULRange(daq.daq_ao_range), daq.daq_ao_resolution)
+
+class VoltScaler():
+    '''
+        Linear counts -> eng units mapping for a single (board, ULRange).
+
+        Offset and gain are read from to_eng_units at both ends of the count range
+        and checked on a probe set, so raw AI counts become volts with a single
+        multiply-add. Falls back to the per-sample driver call if the driver is
+        not affine.
+    '''
+    def __init__(self, board_num:int, ul_range:ULRange, resolution:int=16):
+        self.board_num  = board_num
+        self.ul_range   = ULRange(ul_range)
+        self.resolution = resolution
+        self.max_count  = (1 << resolution) - 1
+        self.offset     = None
+        self.gain       = None
+        self._calibrate()
+
+    @property
+    def is_vectorized(self) -> bool:
+        return self.gain is not None
+
+    def _driver(self, counts) -> np.ndarray:
+        return np.array([
+            ul.to_eng_units(board_num=self.board_num, ul_range=self.ul_range, data_value=int(c))
+            for c in np.ravel(counts)
+        ]).reshape(np.shape(counts))
+
+    def _calibrate(self):
+        probes = np.unique(np.round(np.linspace(0, self.max_count, 33)).astype(np.int64))
+        expected = self._driver(probes)
+        offset = expected[0]
+        gain = (expected[-1] - expected[0]) / self.max_count
+        # Driver results may be single precision
+        tol = 1e-6 * max(abs(float(self.ul_range.range_max)), abs(float(self.ul_range.range_min)), 1.0)
+        if np.allclose(offset + gain * probes, expected, rtol=0, atol=tol):
+            self.offset, self.gain = float(offset), float(gain)
+
+    def to_volts(self, counts) -> np.ndarray:
+        ''' Convert an array of raw counts into float64 eng units. '''
+        if self.is_vectorized:
+            volts = np.multiply(counts, self.gain, dtype=np.float64)
+            volts += self.offset
+            return volts
+        return self._driver(counts)
+
+@lru_cache(maxsize=None)
+def get_scaler(board_num:int, ul_range:ULRange, resolution:int=16) -> VoltScaler:
+    return VoltScaler(board_num, ul_range, resolution)
+
+def daq_scaler(daq:McculwUsbDaq) -> VoltScaler:
+    ''' Handle function to fetch the AI scaler of a DAQ. '''
+    return get_scaler(daq.daq_board_num, ULRange(daq.daq_ai_range), daq.daq_ai_resolution)
+
+def write_buffer(buffer, counts:np.ndarray, offset:int=0):
+    '''
+        Bulk copy uint16 counts into a win_buf_alloc buffer.
+
+        Args:
+            buffer: POINTER(c_ushort) cast of the memhandle.
+            counts: uint16 array of counts.
+            offset: first sample index in the buffer to write to.
+    '''
+    counts = np.ascontiguousarray(counts, dtype=np.uint16)
+    dst = ctypes.cast(buffer, ctypes.c_void_p).value + offset * ctypes.sizeof(ctypes.c_ushort)
+    ctypes.memmove(dst, counts.ctypes.data, counts.nbytes)
+
+def write_waveform(daq:McculwUsbDaq, buffer, wave:np.ndarray, offset:int=0):
+    ''' Convert a voltage waveform and write it into the AO buffer with a single copy. '''
+    write_buffer(buffer, daq_converter(daq).to_counts(wave), offset)
@@ -2,46 +2,176 @@
     Utility script for DAQ handeling.
 """
 
-from mcculw import ul
 from mcculw.enums import InterfaceType, ULRange, InfoType, BoardInfo, ULRangeEnum
-from mcculw.device_info import DaqDeviceInfo
-
-from typing import Dict, List
-from enum import IntEnum, Enum
-
-import configparser
-config = configparser.ConfigParser()
-config.read('daq_config.ini')
-
-class DaqAO(Enum):
-    CHAN_LOW    = int(config['DaqAO']['chan_low'])
-    CHAN_HIG    = int(config['DaqAO']['chan_hig'])
-    AMPLITUDE   = int(config['DaqAO']['amplitude'])
-    FREQ_SAMPLE = int(config['DaqAO']['freq_sample'])
-    DURAION     = int(config['DaqAO']['duration'])
-    AO_RANGE    = ULRange[str(config['DaqAO']['ao_range'])]
-    NUM_CHANS   = CHAN_HIG - CHAN_LOW + 1
-
-class DaqAI(Enum):
-    CHAN_LOW    = int(config['DaqAI']['chan_low'])
-    CHAN_HIG    = int(config['DaqAI']['chan_hig'])
-    FREQ_SAMPLE = int(config['DaqAI']['freq_sample'])
-    DURAION     = int(config['DaqAI']['duration'])
-    AI_RANGE    = ULRange[str(config['DaqAI']['ai_range'])]
-    NUM_CHANS   = CHAN_HIG - CHAN_LOW + 1
-    BIT_LOW     = float(config['DaqAI']['bit_low'])
-    BIT_HIG     = float(config['DaqAI']['bit_hig'])
-
-class LC(Enum):
-    V_ON    = float(config['LC']['v_on'])
-    V_OFF   = float(config['LC']['v_off'])
-    FREQ_LC = int(config['LC']['freq_lc'])
-
-class Sockets(Enum):
-    HOST = str(config['Socket']['host'])
-    PORT = int(config['Socket']['port'])
-
-def configure_devices(printDevices=False) -> Dict:
+from utils.config import Profile, load_profile
+
+from typing import Dict, List, NamedTuple
+
+import os, time, threading, asyncio
+
+BACKENDS = ('mcculw', 'sim')
+
+class UlBackend():
+    '''
+        Proxy for the mcculw.ul module.
+
+        Scripts call ul.<function> through this object so the hardware driver can be
+        swapped for the software simulator (utils/sim.py) without touching call sites.
+        The backend is picked from the MODRF_BACKEND environment variable, then the
+        [Backend] config section, and is loaded on first use.
+    '''
+    def __init__(self, name:str=None):
+        self._name = name # None: MODRF_BACKEND, else the profile's [Backend] name
+        self._impl = None
+        self._device_info = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        if self._name is None:
+            self._name = os.environ.get('MODRF_BACKEND', profile().backend)
+        return self._name
+
+    def select(self, name:str):
+        ''' Load a backend by name ('mcculw' or 'sim'). '''
+        with self._lock:
+            self._select(name)
+
+    def _select(self, name:str):
+        if name == 'mcculw':
+            from mcculw import ul as impl
+            from mcculw.device_info import DaqDeviceInfo
+        elif name == 'sim':
+            from utils import sim as impl
+            if not impl.configured():
+                impl.load_config(profile().parser)
+            DaqDeviceInfo = impl.DaqDeviceInfo
+        else:
+            raise Exception(f"[ERROR] Unknown DAQ backend: {name}. Choose from {BACKENDS}")
+        self._name = name
+        self._impl = impl
+        self._device_info = DaqDeviceInfo
+
+    def _loaded(self):
+        # Threads may hit the proxy first at the same time, load only once
+        if self._impl is None:
+            with self._lock:
+                if self._impl is None:
+                    self._select(self.name)
+        return self._impl
+
+    def device_info(self, board_num:int):
+        ''' DaqDeviceInfo of the selected backend. '''
+        self._loaded()
+        return self._device_info(board_num)
+
+    def sleep(self, seconds:float):
+        ''' Sleep on the backend clock (the simulator can run faster than real time). '''
+        getattr(self._loaded(), 'sleep', time.sleep)(seconds)
+
+    async def async_sleep(self, seconds:float):
+        ''' Awaitable sleep on the backend clock, for asyncio tasks. '''
+        impl = self._loaded()
+        if hasattr(impl, 'async_sleep'):
+            await impl.async_sleep(seconds)
+        else:
+            await asyncio.sleep(seconds)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self._loaded(), attr)
+
+ul = UlBackend()
+
+def sleep(seconds:float):
+    ''' Handle function to sleep on the DAQ backend clock. '''
+    ul.sleep(seconds)
+
+async def async_sleep(seconds:float):
+    ''' Handle function to await a sleep on the DAQ backend clock. '''
+    await ul.async_sleep(seconds)
+
+#__________________ Configuration ______________________________________________
+
+_profile:Profile = None
+_profile_path    = None # None = utils.config.config_path() search
+
+def use_profile(name:str=None, path:str=None) -> Profile:
+    '''
+        Make a profile of daq_config.ini (utils/config.py) the active one. Links opened
+        afterwards, and DaqAO/DaqAI/LC/... below, read it. The DAQ backend stays the
+        one selected first.
+
+        Args:
+            name: Profile name, None for MODRF_PROFILE (or the base sections).
+            path: Config file, None to keep the current one.
+    '''
+    global _profile, _profile_path
+    if path is not None:
+        _profile_path = path
+    if name is None:
+        name = os.environ.get('MODRF_PROFILE', '')
+    _profile = load_profile(name, _profile_path)
+    return _profile
+
+def profile() -> Profile:
+    ''' Active profile, loaded on first use. '''
+    return _profile if _profile is not None else use_profile()
+
+def __getattr__(attr):
+    # daq.config: the effective ini sections of the active profile
+    if attr == 'config':
+        return profile().parser
+    raise AttributeError(f"module {__name__!r} has no attribute {attr!r}")
+
+class Setting(NamedTuple):
+    name:  str
+    value: object
+
+class ProfileSection():
+    '''
+        Enum style view of one section of the active profile: DaqAI.FREQ_SAMPLE.value
+        reads profile().ai.freq_sample when it is accessed, so a profile switch is seen
+        by every module without re-importing. Unlike Enum members, equal values of two
+        settings never alias.
+    '''
+    def __init__(self, attr:str, aliases:Dict[str, str]=None):
+        self._attr    = attr
+        self._aliases = aliases or {}
+
+    def __getattr__(self, name:str) -> Setting:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        section = getattr(profile(), self._attr)
+        try:
+            return Setting(name, getattr(section, self._aliases.get(name, name.lower())))
+        except AttributeError:
+            raise AttributeError(f"{type(section).__name__} has no setting {name}") from None
+
+DaqAO    = ProfileSection('ao', {'DURAION': 'duration'})
+DaqAI    = ProfileSection('ai', {'DURAION': 'duration'})
+LC       = ProfileSection('lc')
+Framing  = ProfileSection('framing')
+Training = ProfileSection('training')
+Sockets  = ProfileSection('sockets')
+Devices  = ProfileSection('devices')
+
+def devices():
+    '''
+        Process wide device registry (utils/registry.py): cached board capabilities and
+        shared McculwUsbDaq handles.
+
+        Example:
+            usb_3101fs, usb_202 = devices().acquire('USB-3101FS', 'USB-202')
+            ...
+            usb_3101fs.release_device()
+            usb_202.release_device()
+    '''
+    from utils.registry import registry
+    return registry()
+
+def configure_devices(printDevices=False, backend:str=None) -> Dict:
     '''
         Assign DAQ's to device nubers.
 
@@ -49,24 +179,25 @@ def configure_devices(printDevices=False) -> Dict:
         ex/ USB-3101FS (2128658) - Device ID = 224 -> referenced with board num 0.
 
         DAQ Devices can then be commanded with board number as reference.
+        Boards come from the device registry, which only scans the inventory when
+        its [Devices] registry file does not match the connected boards. Scripts
+        share one board through devices().acquire() instead.
+
+        Args:
+            printDevices: Print the board number of each device.
+            backend: Optionally select the DAQ backend ('mcculw' or 'sim') first.
 
         Return:
             list of device names to keep track of assigned board num as index in list.
     '''
-    ul.ignore_instacal()
-    devices:List[ul.DaqDeviceDescriptor] = ul.get_daq_device_inventory(InterfaceType.USB)
+    if backend is not None:
+        ul.select(backend)
+    connected_devices = devices().boards()
 
-    if not devices:
-        raise Exception("ERROR: No USB DAQ devices connected")
-
-    connected_devices = {}
     if printDevices:
-        print(f"\nConfiguring {len(devices)} USB DAQs. ")
-    for board_num, device in enumerate(devices):
-        if printDevices:
-            print(f"Board Number: {board_num} | {device.product_name}")
-        connected_devices[device.product_name] = board_num
-        ul.create_daq_device(board_num, device)
+        print(f"\nConfiguring {len(connected_devices)} USB DAQs. ")
+        for product_name, board_num in connected_devices.items():
+            print(f"Board Number: {board_num} | {product_name}")
     print()
 
     return connected_devices
@@ -74,50 +205,52 @@ def configure_devices(printDevices=False) -> Dict:
 class McculwUsbDaq():
     ''' 
         Handler class for USB DAQ Devices.
-        After running configure_devices, pass board_num to initialize class.
+        Get a shared one with devices().acquire(product_name), or after running
+        configure_devices pass board_num to initialize class.
+
+        Args:
+            daq_board_num: Board number of a created board.
+            capabilities: registry.DeviceCapabilities of the board, None to look
+                them up in the registry (or query the driver).
+            registry: registry.DeviceRegistry the handle was acquired from,
+                release_device() then drops one use of the shared handle.
     '''
-    def __init__(self, daq_board_num:int):
-        self._daq_dev_info = DaqDeviceInfo(daq_board_num)
+    def __init__(self, daq_board_num:int, capabilities=None, registry=None):
+        if capabilities is None:
+            from utils.registry import DeviceCapabilities
+            capabilities = devices().board_capabilities(daq_board_num) or DeviceCapabilities.query(daq_board_num)
+        self._daq_board_num = daq_board_num
+        self._daq_caps      = capabilities
+        self._registry      = registry
         # Sometimes USB DAQ's do not have AO or AI
         # Used for universal range getter.
-        if (
-            self._daq_dev_info.supports_analog_output and
-            self._daq_dev_info.supports_analog_input
-            ):
-            self._daq_ao_info  = self._daq_dev_info.get_ao_info()
-            self._daq_ai_info  = self._daq_dev_info.get_ai_info()
-            self._daq_ao_range = self._daq_ao_info.supported_ranges[0]
-            self._daq_ai_range = self._daq_ai_info.supported_ranges[0]
-        elif self._daq_dev_info.supports_analog_output:
-            self._daq_ao_info  = self._daq_dev_info.get_ao_info()
-            self._daq_ao_range = self._daq_ao_info.supported_ranges[0]
-            self._daq_ai_info  = None
-            self._daq_ai_range = None
-        else: # supports only AI
-            self._daq_ao_info  = None
-            self._daq_ao_range = None
-            self._daq_ai_info  = self._daq_dev_info.get_ai_info()
-            self._daq_ai_range = self._daq_ai_info.supported_ranges[0]
-    
+        self._daq_ao_range = ULRange[capabilities.ao_ranges[0]] if capabilities.supports_ao else None
+        self._daq_ai_range = ULRange[capabilities.ai_ranges[0]] if capabilities.supports_ai else None
+
     @property
     def daq_board_num(self):
-        return self._daq_dev_info.board_num
+        return self._daq_board_num
     
     @property
     def daq_product_name(self):
-        return self._daq_dev_info.product_name
+        return self._daq_caps.product_name
     
     @property
     def daq_unique_id(self):
-        return self._daq_dev_info.unique_id
+        return self._daq_caps.unique_id
     
     @property
     def daq_supports_ao(self):
-        return self._daq_dev_info.supports_analog_output
+        return self._daq_caps.supports_ao
     
     @property
     def daq_supports_ai(self):
-        return self._daq_dev_info.supports_analog_input
+        return self._daq_caps.supports_ai
+
+    @property
+    def daq_capabilities(self):
+        ''' registry.DeviceCapabilities: ranges, channel counts, resolutions and max rates. '''
+        return self._daq_caps
     
     @property
     def daq_ao_range(self):
@@ -125,6 +258,11 @@ class McculwUsbDaq():
             return self._daq_ao_range
         else:
             raise f"[ERROR] DAQ {self.daq_product_name} does not support AO.\n"
+
+    @property
+    def daq_ao_resolution(self) -> int:
+        ''' DAC resolution in bits, from the cached capabilities. '''
+        return self._daq_caps.ao_resolution
         
     def set_daq_ao_range(self, daq_chan:int, new_range:ULRange, verbose=False):
         """
@@ -140,8 +278,8 @@ class McculwUsbDaq():
                 daq_chan = 0
                 new_range = enums.ULRange.BIP10VOLTS
         """
-        if daq_chan > self._daq_ao_info.num_chans or daq_chan < 0:
-            raise f"[ERROR] Can't assign range to daq_chan: {daq_chan} | {self.daq_product_name} has {self._daq_ao_info.num_chans} chans.\n"
+        if daq_chan > self._daq_caps.ao_chans or daq_chan < 0:
+            raise f"[ERROR] Can't assign range to daq_chan: {daq_chan} | {self.daq_product_name} has {self._daq_caps.ao_chans} chans.\n"
         
         if verbose:
             print(f"Current {self.daq_product_name} range: {ULRange(self.daq_ao_range).name}")
@@ -155,6 +293,11 @@ class McculwUsbDaq():
         if verbose:
             print(f"New DAQ range: {ULRange(self.daq_ao_range).name}")
     
+    @property
+    def daq_ai_resolution(self) -> int:
+        ''' ADC resolution in bits, from the cached capabilities. '''
+        return self._daq_caps.ai_resolution
+
     @property
     def daq_ai_range(self):
         if self.daq_supports_ai:
@@ -177,8 +320,8 @@ class McculwUsbDaq():
                 daq_chan = 0
                 new_range = enums.ULRange.BIP10VOLTS
         """
-        if daq_chan > self._daq_ai_info.num_chans or daq_chan < 0:
-            raise f"[ERROR] Can't assign range to daq_chan: {daq_chan} | {self.daq_product_name} has {self._daq_ai_info.num_chans} chans.\n"
+        if daq_chan > self._daq_caps.ai_chans or daq_chan < 0:
+            raise f"[ERROR] Can't assign range to daq_chan: {daq_chan} | {self.daq_product_name} has {self._daq_caps.ai_chans} chans.\n"
         
         if verbose:
             print(f"Current {self.daq_product_name} range: {ULRange(self.daq_ai_range).name}")
@@ -193,9 +336,14 @@ class McculwUsbDaq():
             print(f"New DAQ range: {ULRange(self.daq_ai_range).name}")
 
     def release_device(self):
-        """ Safely release device from script exit. """
-        print(f"Released device {self.daq_product_name}")
-        ul.release_daq_device(self.daq_board_num)
+        """
+            Safely release device from script exit. A shared handle is released
+            with its last user, the registry releases a board only once.
+        """
+        if self._registry is not None:
+            self._registry.release(self)
+        else:
+            devices().release_board(self.daq_board_num)
 
 #__________________ Scan Operations ______________________________________________
 
@@ -205,7 +353,7 @@ def daq_ao_scan(usb_daq:McculwUsbDaq, memhandle, options):
         board_num=usb_daq.daq_board_num,
         low_chan=DaqAO.CHAN_LOW.value,
         high_chan=DaqAO.CHAN_HIG.value,
-        num_points=DaqAO.FREQ_SAMPLE.value * DaqAO.DURAION.value * DaqAO.NUM_CHANS.value,
+        num_points=profile().ao.buffer_size,
         rate=DaqAO.FREQ_SAMPLE.value,
         ul_range=DaqAO.AO_RANGE.value,
         memhandle=memhandle,
@@ -218,7 +366,7 @@ def daq_ai_scan(usb_daq:McculwUsbDaq, memhandle, options):
         board_num=usb_daq.daq_board_num,
         low_chan=DaqAI.CHAN_LOW.value,
         high_chan=DaqAI.CHAN_HIG.value,
-        num_points=DaqAI.FREQ_SAMPLE.value * DaqAI.DURAION.value * DaqAI.NUM_CHANS.value,
+        num_points=profile().ai.buffer_size,
         rate=DaqAI.FREQ_SAMPLE.value,
         ul_range=DaqAI.AI_RANGE.value,
         memhandle=memhandle,
@@ -0,0 +1,96 @@
+"""
+    Stateful streaming demodulator for waves.waveform_single_char_2 frames.
+
+    Blocks of AI samples of any size are pushed as they are acquired. Bit
+    decisions are taken at fixed offsets from each frame start and a byte is
+    emitted as soon as the sample of its last bit has arrived.
+
+    The receivers no longer use it: recv.py and link.py decode packets with
+    framing.PacketDemodulator, which locks on every preamble instead of trusting
+    fixed bit offsets. It is kept only as the baseline of the demod group in
+    benchmarks/bench.py, next to recv.process_buf and sync.SyncDemodulator.
+"""
+from typing import List
+import numpy as np
+
+# Decision times (s) from the frame start, tuned on 'H' (see recv.process_buf)
+BIT_WINDOW = [0.23, 0.31, 0.39, 0.46, 0.55, 0.63, 0.71, 0.79]
+
+class CharDemodulator():
+    '''
+        One character per frame, frames back to back from the AI scan start.
+
+        Args:
+            sample_rate: AI sample rate (Hz).
+            threshold: Detector voltage separating '0' (below) from '1'.
+            frame_period: Seconds per character frame (AO buffer duration).
+            bit_window: Decision times (s) of the 8 bits, MSB first.
+            frame_offset: Sample index of the first frame start.
+    '''
+    def __init__(
+            self,
+            sample_rate:int,
+            threshold:float,
+            frame_period:float=1.0,
+            bit_window:List[float]=BIT_WINDOW,
+            frame_offset:int=0):
+        self.sample_rate  = sample_rate
+        self.threshold    = threshold
+        self.frame_len    = int(round(frame_period * sample_rate))
+        self.offsets      = (np.asarray(bit_window) * sample_rate).astype(np.int64)
+        self.frame_offset = frame_offset
+        self.frames_lost  = 0
+        self._n           = 0 # absolute index of the next expected sample
+        self._frame       = None # frame the pending bits belong to
+        self._bits        = []
+
+    def reset(self, frame_offset:int=None):
+        if frame_offset is not None:
+            self.frame_offset = frame_offset
+        self._frame = None
+        self._bits = []
+
+    def _decisions(self, n0:int, n1:int):
+        ''' (frame, bit index, sample index) of decisions inside samples [n0, n1). '''
+        f_lo = max((n0 - self.frame_offset - int(self.offsets[-1])) // self.frame_len, 0)
+        f_hi = max((n1 - self.frame_offset) // self.frame_len + 1, 0)
+        frames = np.arange(f_lo, f_hi)
+        idx = frames[:, None] * self.frame_len + self.frame_offset + self.offsets[None, :]
+        bit = np.broadcast_to(np.arange(len(self.offsets)), idx.shape)
+        frame = np.broadcast_to(frames[:, None], idx.shape)
+        keep = (idx >= n0) & (idx < n1)
+        return frame[keep], bit[keep], idx[keep]
+
+    def push(self, block:np.ndarray, start:int=None) -> bytes:
+        '''
+            Feed newly acquired samples.
+
+            Args:
+                block: Detector samples of one channel.
+                start: Absolute index of block[0], defaults to right after the last block.
+                    A gap drops the partially received character.
+
+            Return:
+                bytes completed by this block.
+        '''
+        if start is None:
+            start = self._n
+        n1 = start + len(block)
+        frame, bit, idx = self._decisions(start, n1)
+        values = np.asarray(block)[idx - start] > self.threshold
+        self._n = n1
+
+        out = bytearray()
+        for f, b, v in zip(frame.tolist(), bit.tolist(), values.tolist()):
+            if f != self._frame or b != len(self._bits):
+                # Decisions of the previous frame are missing, drop it
+                if self._bits:
+                    self.frames_lost += 1
+                self._frame, self._bits = f, []
+                if b != 0:
+                    continue
+            self._bits.append(v)
+            if len(self._bits) == len(self.offsets):
+                out.append(int(''.join('1' if x else '0' for x in self._bits), 2))
+                self._frame, self._bits = None, []
+        return bytes(out)
@@ -0,0 +1,144 @@
+"""
+    Decision-feedback equalizer of the symbol soft values.
+
+    At short mod_period the slow LC tail of a symbol still moves the detector
+    during the next ones, so a fixed threshold decides against a level that
+    depends on the previous symbols. The equalizer works in level units (0 for
+    the darkest level, len(thresholds) for the brightest):
+
+        y[i] = ff . soft[i - ff//2 : i + ff - ff//2] + fb . d[i-1 : i-fb-1 : -1] + bias
+        d[i] = y[i] rounded to the nearest level
+
+    The taps start as the gain and offset that put the receiver's thresholds
+    half way between levels and are learnt with normalized LMS. Every packet
+    first trains on the symbol windows inside its init bits, whose levels are
+    known (bright, dark, bright), then continues decision directed through the
+    payload. Symbols are processed in blocks: the feed-forward part and the tap
+    update of a block are array operations with the taps frozen, only the short
+    feedback recursion runs per symbol.
+"""
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+
+class EqualizerMetrics():
+    ''' Taps and error reported by DecisionFeedbackEqualizer. '''
+    def __init__(self):
+        self.packets = 0    # packets the taps were adapted on
+        self.symbols = 0    # symbols decided
+        self.mse     = None # mean squared error (level units) of the last adapted packet's payload
+        self.ff      = []   # feed-forward taps, oldest soft value first
+        self.fb      = []   # feedback taps, previous decision first
+        self.bias    = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class DecisionFeedbackEqualizer():
+    '''
+        Block LMS decision-feedback equalizer of one lane.
+
+        Args:
+            num_levels: Symbol levels (2**bits_per_symbol).
+            ff_taps: Feed-forward taps over the soft values around the symbol.
+            fb_taps: Feedback taps over the previous decisions.
+            step: Normalized LMS step size (0..1).
+            block: Symbols per block the taps are frozen for.
+    '''
+    def __init__(self, num_levels:int=2, ff_taps:int=3, fb_taps:int=2, step:float=0.2, block:int=8):
+        ff_taps, fb_taps, block = int(ff_taps), int(fb_taps), int(block)
+        if ff_taps < 1 or fb_taps < 0 or block < 1:
+            raise Exception(f"[ERROR] Equalizer needs ff_taps >= 1, fb_taps >= 0 and block >= 1, got {ff_taps}, {fb_taps}, {block}.")
+        self.top     = num_levels - 1
+        self.ff_taps = ff_taps
+        self.fb_taps = fb_taps
+        self.step    = float(step)
+        self.block   = block
+        self.metrics = EqualizerMetrics()
+        self.w       = None # [ff..., fb..., bias], None until the first preamble
+
+    def reset(self):
+        self.w = None
+
+    def _initial_taps(self, soft:np.ndarray, known:np.ndarray, thresholds=None) -> np.ndarray:
+        '''
+            Gain and offset without ISI taps, mapping threshold k on level k + 1/2 and
+            the dark preamble windows on level 0 (a single threshold needs them for the
+            gain). The bright ones are left out, the LC rarely settles there within a
+            data symbol.
+        '''
+        w = np.zeros(self.ff_taps + self.fb_taps + 1)
+        thresholds = np.atleast_1d(np.asarray([] if thresholds is None else thresholds, dtype=float))
+        dark = soft[:len(known)][known == 0]
+        x = np.concatenate((thresholds, dark))
+        t = np.concatenate((np.arange(len(thresholds)) + 0.5, np.zeros(len(dark))))
+        if np.all(np.isfinite(x)) and len(x) >= 2 and np.ptp(x) > 0:
+            gain, offset = np.polyfit(x, t, 1)
+        elif len(known) >= 2 and np.ptp(known) > 0 and np.ptp(soft) > 0:
+            gain, offset = np.polyfit(soft, known, 1)
+        else:
+            # No dark preamble window: spread the 5th to 95th percentile over the levels,
+            # the first threshold still half way to level 1
+            low, high = np.percentile(soft, [5, 95])
+            gain = self.top / max(high - low, 1e-6)
+            offset = 0.5 - thresholds[0] * gain if len(thresholds) and np.isfinite(thresholds[0]) else -low * gain
+        w[self.ff_taps // 2], w[-1] = gain, offset
+        return w
+
+    def equalize(self, soft:np.ndarray, train_soft:np.ndarray=None, train_known:np.ndarray=None, adapt:bool=True,
+                 thresholds=None) -> np.ndarray:
+        '''
+            Level index of every soft value.
+
+            Args:
+                soft: Soft values (volts) of the symbols of one packet.
+                train_soft: Soft values of the preamble symbols before them.
+                train_known: Transmitted level (level units, fractional where the
+                    decision window straddles two init bits) of each preamble symbol.
+                adapt: Keep the taps learnt on this packet, False to decide with taps
+                    trained on the preamble only and leave them unchanged.
+                thresholds: Receiver thresholds (volts, ascending) the first taps are
+                    derived from.
+        '''
+        soft = np.asarray(soft, dtype=float)
+        train_soft = np.empty(0) if train_soft is None else np.asarray(train_soft, dtype=float)
+        train_known = np.empty(0) if train_known is None else np.asarray(train_known, dtype=float)
+        if not len(soft):
+            return np.empty(0, dtype=np.int64)
+        r = np.concatenate((train_soft, soft))
+        n, n_train, ff, fb = len(r), len(train_soft), self.ff_taps, self.fb_taps
+        if self.w is None:
+            self.w = self._initial_taps(train_soft if n_train else soft, train_known, thresholds)
+        pre = ff // 2
+        U = sliding_window_view(np.pad(r, (pre, ff - 1 - pre), mode='edge'), ff)
+        # Decisions, preceded by the bright lead the feedback starts from
+        d = np.concatenate((np.full(fb, float(self.top)), np.empty(n)))
+        y = np.empty(n)
+        w = self.w.copy()
+        for b0 in range(0, n, self.block):
+            b1 = min(b0 + self.block, n)
+            forward = U[b0:b1] @ w[:ff] + w[-1]
+            taps = w[ff:ff + fb].tolist()
+            for i in range(b0, b1):
+                yi = float(forward[i - b0])
+                for k in range(fb):
+                    yi += taps[k] * d[fb + i - 1 - k]
+                y[i] = yi
+                d[fb + i] = train_known[i] if i < n_train else min(max(round(yi), 0), self.top)
+            b_end = b1 if adapt else min(b1, n_train) # without adapt only the preamble trains
+            if b_end > b0:
+                e = d[fb + b0:fb + b_end] - y[b0:b_end]
+                # Feedback inputs of the block: previous decisions, newest first
+                F = sliding_window_view(d[b0:fb + b_end - 1], fb)[:, ::-1] if fb else np.empty((b_end - b0, 0))
+                u = np.hstack((U[b0:b_end], F, np.ones((b_end - b0, 1))))
+                power = np.mean(np.sum(u * u, axis=1))
+                w += self.step * (u.T @ e) / ((b_end - b0) * max(power, 1e-12))
+        if adapt:
+            self.w = w
+            self.metrics.packets += 1
+            e = d[fb + n_train:] - y[n_train:]
+            self.metrics.mse = float(np.mean(e * e))
+            self.metrics.ff = w[:ff].tolist()
+            self.metrics.fb = w[ff:ff + fb].tolist()
+            self.metrics.bias = float(w[-1])
+        self.metrics.symbols += len(soft)
+        return d[fb + n_train:].astype(np.int64)
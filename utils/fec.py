@@ -0,0 +1,245 @@
+"""
+    Forward error correction between the packet bytes and the symbol mapper.
+
+    Codes work on bit arrays (uint8 0/1) so the coded stream does not have to be
+    byte aligned. Every code encodes and decodes whole packets at once:
+    Hamming(7,4) as GF(2) matrix products over all nibbles, Reed-Solomon with a
+    precomputed parity matrix and syndromes over all blocks. Only the blocks
+    with a non-zero syndrome go through the (scalar) Berlekamp-Massey solver.
+
+    decode returns (bits, corrected, uncorrectable): the number of corrected
+    bit (Hamming) or byte (RS) errors and of blocks that could not be decoded.
+"""
+from utils.daq import Framing
+from functools import lru_cache
+from typing import Tuple
+import numpy as np
+
+class NoFec():
+    ''' Pass-through code. '''
+    name = 'none'
+
+    def encoded_bits(self, num_bits:int) -> int:
+        return num_bits
+
+    def encode(self, bits:np.ndarray) -> np.ndarray:
+        return np.asarray(bits, dtype=np.uint8)
+
+    def decode(self, bits:np.ndarray, num_bits:int) -> Tuple[np.ndarray, int, int]:
+        return np.asarray(bits, dtype=np.uint8)[:num_bits], 0, 0
+
+#__________________ Hamming(7,4) ______________________________________________
+
+# Systematic generator [I4 | P] and parity check [P^T | I3]
+_HAMMING_P = np.array([[1, 1, 0], [1, 0, 1], [0, 1, 1], [1, 1, 1]], dtype=np.uint8)
+_HAMMING_G = np.hstack((np.eye(4, dtype=np.uint8), _HAMMING_P))
+_HAMMING_H = np.hstack((_HAMMING_P.T, np.eye(3, dtype=np.uint8)))
+# Syndrome (as an int, MSB first) -> position of the single bit error, -1 for none
+_HAMMING_POS = np.full(8, -1)
+_HAMMING_POS[_HAMMING_H.T @ np.array([4, 2, 1])] = np.arange(7)
+
+class Hamming74():
+    ''' Hamming(7,4), corrects one bit error per 7 bit codeword. '''
+    name = 'hamming74'
+
+    def encoded_bits(self, num_bits:int) -> int:
+        return -(-num_bits // 4) * 7
+
+    def encode(self, bits:np.ndarray) -> np.ndarray:
+        bits = np.asarray(bits, dtype=np.uint8)
+        data = np.concatenate((bits, np.zeros(-len(bits) % 4, dtype=np.uint8))).reshape(-1, 4)
+        return ((data @ _HAMMING_G) & 1).astype(np.uint8).ravel()
+
+    def decode(self, bits:np.ndarray, num_bits:int) -> Tuple[np.ndarray, int, int]:
+        words = np.asarray(bits, dtype=np.uint8)[:self.encoded_bits(num_bits)].reshape(-1, 7).copy()
+        syndrome = ((words @ _HAMMING_H.T) & 1) @ np.array([4, 2, 1])
+        pos = _HAMMING_POS[syndrome]
+        rows = np.flatnonzero(pos >= 0)
+        words[rows, pos[rows]] ^= 1
+        return words[:, :4].ravel()[:num_bits], len(rows), 0
+
+#__________________ Reed-Solomon over GF(2^8) __________________________________
+
+_GF_EXP = np.zeros(512, dtype=np.int64)
+_GF_LOG = np.zeros(256, dtype=np.int64)
+_x = 1
+for _i in range(255):
+    _GF_EXP[_i] = _x
+    _GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+_GF_EXP[255:] = _GF_EXP[:257]
+
+def _gf_mul(a, b):
+    ''' Element-wise GF(2^8) product of integer arrays (or scalars). '''
+    a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+    return np.where((a != 0) & (b != 0), _GF_EXP[_GF_LOG[a] + _GF_LOG[b]], 0)
+
+def _gf_div(a:int, b:int) -> int:
+    if a == 0:
+        return 0
+    return int(_GF_EXP[(_GF_LOG[a] - _GF_LOG[b]) % 255])
+
+def _poly_eval(poly, x:int) -> int:
+    ''' Polynomial with coefficients in ascending powers at x. '''
+    y = 0
+    for c in reversed(poly):
+        y = int(_gf_mul(y, x)) ^ c
+    return y
+
+@lru_cache(maxsize=None)
+def _generator(nsym:int) -> tuple:
+    ''' prod (x - alpha^j), j < nsym, coefficients highest power first. '''
+    g = [1]
+    for j in range(nsym):
+        g = [c ^ int(_gf_mul(gc, _GF_EXP[j])) for c, gc in zip(g + [0], [0] + g)]
+    return tuple(g)
+
+@lru_cache(maxsize=None)
+def _parity_matrix(k:int, nsym:int) -> np.ndarray:
+    ''' Row i: parity of the unit message e_i, i.e. x^(nsym + k - 1 - i) mod g. '''
+    g = np.array(_generator(nsym)[1:])
+    rows = np.zeros((k, nsym), dtype=np.int64)
+    rem = g.copy() # x^nsym mod g
+    for i in range(k - 1, -1, -1):
+        rows[i] = rem
+        top = rem[0]
+        rem = np.concatenate((rem[1:], [0])) ^ _gf_mul(top, g)
+    return rows
+
+@lru_cache(maxsize=None)
+def _syndrome_powers(n:int, nsym:int) -> np.ndarray:
+    ''' log of alpha^(j * (n - 1 - i)) for coefficient i and syndrome j. '''
+    return (np.arange(n - 1, -1, -1)[:, None] * np.arange(nsym)[None, :]) % 255
+
+def _syndromes(blocks:np.ndarray, nsym:int) -> np.ndarray:
+    log = _GF_LOG[blocks][:, :, None] + _syndrome_powers(blocks.shape[1], nsym)[None]
+    terms = np.where(blocks[:, :, None] != 0, _GF_EXP[log % 255], 0)
+    return np.bitwise_xor.reduce(terms, axis=1)
+
+def _berlekamp_massey(S) -> list:
+    ''' Error locator, coefficients in ascending powers. '''
+    C, B = [1], [1]
+    L, m, b = 0, 1, 1
+    for n in range(len(S)):
+        d = S[n]
+        for i in range(1, L + 1):
+            d ^= int(_gf_mul(C[i], S[n - i]))
+        if d == 0:
+            m += 1
+            continue
+        coef = _gf_div(d, b)
+        T = list(C)
+        C = C + [0] * max(len(B) + m - len(C), 0)
+        for i, Bi in enumerate(B):
+            C[i + m] ^= int(_gf_mul(coef, Bi))
+        if 2 * L <= n:
+            L, B, b, m = n + 1 - L, T, d, 1
+        else:
+            m += 1
+    return C[:L + 1]
+
+def _correct(block:np.ndarray, S:np.ndarray) -> int:
+    '''
+        Correct block in place from its syndromes.
+
+        Return:
+            number of corrected bytes, -1 if the block is uncorrectable.
+    '''
+    n, nsym = len(block), len(S)
+    S = [int(s) for s in S]
+    locator = _berlekamp_massey(S)
+    num_errors = len(locator) - 1
+    if num_errors == 0 or 2 * num_errors > nsym:
+        return -1
+    # Chien search over every position p (power of the coefficient), X = alpha^p
+    p = np.arange(n)
+    terms = _gf_mul(np.array(locator)[None, :], _GF_EXP[(-p[:, None] * np.arange(len(locator))[None, :]) % 255])
+    positions = p[np.bitwise_xor.reduce(terms, axis=1) == 0]
+    if len(positions) != num_errors:
+        return -1
+    # Forney: e = X * Omega(X^-1) / Lambda'(X^-1), Omega = S * Lambda mod x^nsym
+    omega = [0] * nsym
+    for i, s in enumerate(S):
+        for j, c in enumerate(locator[:nsym - i]):
+            omega[i + j] ^= int(_gf_mul(s, c))
+    derivative = [locator[i] if i % 2 else 0 for i in range(1, len(locator))]
+    for pos in positions:
+        X = int(_GF_EXP[pos])
+        X_inv = int(_GF_EXP[(-pos) % 255])
+        magnitude = _gf_div(int(_gf_mul(X, _poly_eval(omega, X_inv))), _poly_eval(derivative, X_inv))
+        block[n - 1 - pos] ^= magnitude
+    return num_errors
+
+class ReedSolomon():
+    '''
+        Systematic RS(n, n - nsym) over GF(2^8), shortened to the data length.
+        Corrects up to nsym / 2 byte errors per block.
+
+        Args:
+            nsym: Parity bytes per block.
+            block_data: Data bytes per block (at most 255 - nsym).
+    '''
+    name = 'rs'
+
+    def __init__(self, nsym:int=8, block_data:int=64):
+        if not 0 < block_data <= 255 - nsym:
+            raise Exception(f"[ERROR] RS block of {block_data} + {nsym} bytes exceeds 255.")
+        self.nsym       = nsym
+        self.block_data = block_data
+
+    def _layout(self, num_bytes:int):
+        ''' Data bytes of each block, blocks are as even as possible. '''
+        num_blocks = max(-(-num_bytes // self.block_data), 1)
+        return np.diff(np.linspace(0, num_bytes, num_blocks + 1).round().astype(int))
+
+    def encoded_bits(self, num_bits:int) -> int:
+        num_bytes = -(-num_bits // 8)
+        return 8 * (num_bytes + len(self._layout(num_bytes)) * self.nsym)
+
+    def encode(self, bits:np.ndarray) -> np.ndarray:
+        data = np.packbits(np.asarray(bits, dtype=np.uint8)).astype(np.int64)
+        sizes = self._layout(len(data))
+        k = int(sizes.max())
+        # Shortened blocks are left padded with zeros, which do not change the parity
+        blocks = np.zeros((len(sizes), k), dtype=np.int64)
+        mask = np.arange(k)[None, :] >= (k - sizes)[:, None]
+        blocks[mask] = data
+        parity = np.bitwise_xor.reduce(_gf_mul(blocks[:, :, None], _parity_matrix(k, self.nsym)[None]), axis=1)
+        coded = np.concatenate([np.concatenate((blocks[b, k - s:], parity[b])) for b, s in enumerate(sizes)])
+        return np.unpackbits(coded.astype(np.uint8))
+
+    def decode(self, bits:np.ndarray, num_bits:int) -> Tuple[np.ndarray, int, int]:
+        num_bytes = -(-num_bits // 8)
+        sizes = self._layout(num_bytes)
+        coded = np.packbits(np.asarray(bits, dtype=np.uint8)[:self.encoded_bits(num_bits)]).astype(np.int64)
+        n = int(sizes.max()) + self.nsym
+        blocks = np.zeros((len(sizes), n), dtype=np.int64)
+        mask = np.arange(n)[None, :] >= (n - sizes - self.nsym)[:, None]
+        blocks[mask] = coded
+
+        corrected = uncorrectable = 0
+        S = _syndromes(blocks, self.nsym)
+        for b in np.flatnonzero(S.any(axis=1)):
+            found = _correct(blocks[b], S[b])
+            if found < 0 or _syndromes(blocks[b:b + 1], self.nsym).any():
+                uncorrectable += 1
+            else:
+                corrected += found
+        data = blocks[:, :-self.nsym][mask[:, :-self.nsym]]
+        return np.unpackbits(data.astype(np.uint8))[:num_bits], corrected, uncorrectable
+
+def make_fec(name:str, rs_nsym:int=8, rs_block:int=64):
+    ''' Code selected by the [Framing] fec option. '''
+    if name in ('', 'none'):
+        return NoFec()
+    if name == Hamming74.name:
+        return Hamming74()
+    if name == ReedSolomon.name:
+        return ReedSolomon(rs_nsym, rs_block)
+    raise Exception(f"[ERROR] Unknown FEC '{name}', use none, hamming74 or rs.")
+
+def configured_fec():
+    ''' Code selected in the [Framing] section of daq_config.ini. '''
+    return make_fec(Framing.FEC.value, Framing.RS_NSYM.value, Framing.RS_BLOCK.value)
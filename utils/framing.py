@@ -0,0 +1,287 @@
+"""
+    Packet framing shared by send.py and recv.py.
+
+    A message is split into packets of up to max_payload bytes. Each packet is
+    sent as one burst: the min/max/min preamble, then a continuous symbol stream
+    of
+
+        length (1 byte) | sequence (1 byte) | payload | CRC (2 or 4 bytes, big endian)
+
+    and a bright gap that doubles as the preamble lead of the next packet. The
+    CRC covers the header and payload; the receiver drops packets that fail it.
+    With FEC (utils/fec.py) the header and the rest of the packet are coded as
+    two separate blocks, so the length can be read before the whole packet arrived.
+"""
+from utils.waves import BIT_INI_WIND, wave_symbols, frame_index
+from utils.sync import SyncDemodulator, normalized_xcorr, PREAMBLE_LEAD
+from utils.pam import bits_to_symbols, symbols_to_bits
+from utils.fec import NoFec
+from typing import List, Tuple
+import numpy as np
+import binascii, zlib
+
+HEADER_LEN  = 2
+MAX_PAYLOAD = 255 # largest length the header can hold
+
+def crc(data:bytes, bits:int=16) -> bytes:
+    ''' CRC-16/CCITT-FALSE or CRC-32 (zlib) of data, big endian. '''
+    if bits == 16:
+        return binascii.crc_hqx(data, 0xFFFF).to_bytes(2, 'big')
+    if bits == 32:
+        return zlib.crc32(data).to_bytes(4, 'big')
+    raise Exception(f"[ERROR] Unsupported CRC width {bits}, use 16 or 32.")
+
+def encode_packet(seq:int, payload:bytes, crc_bits:int=16) -> bytes:
+    if len(payload) > MAX_PAYLOAD:
+        raise Exception(f"[ERROR] Payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}.")
+    body = bytes([len(payload), seq & 0xFF]) + bytes(payload)
+    return body + crc(body, crc_bits)
+
+def packetize(data:bytes, max_payload:int=32, crc_bits:int=16, seq:int=0) -> List[bytes]:
+    ''' Split data into encoded packets with consecutive sequence numbers from seq. '''
+    return [
+        encode_packet(seq + i, data[n:n + max_payload], crc_bits)
+        for i, n in enumerate(range(0, max(len(data), 1), max_payload))
+    ]
+
+def packet_len(payload_len:int, crc_bits:int=16) -> int:
+    ''' Bytes of an encoded packet. '''
+    return HEADER_LEN + payload_len + crc_bits // 8
+
+def packet_duration(num_symbols:int, mod_period:float, gap:float=PREAMBLE_LEAD) -> float:
+    ''' Seconds of a packet burst: preamble, symbols and the trailing bright gap. '''
+    return 3 * BIT_INI_WIND + num_symbols * mod_period + gap
+
+def packet_bits(packet:bytes, fec=NoFec()) -> np.ndarray:
+    ''' Coded bit stream of an encoded packet: FEC coded header, then FEC coded body. '''
+    bits = np.unpackbits(np.frombuffer(packet, dtype=np.uint8))
+    return np.concatenate((fec.encode(bits[:8 * HEADER_LEN]), fec.encode(bits[8 * HEADER_LEN:])))
+
+def packet_symbols(packet:bytes, bits_per_symbol:int, fec=NoFec()) -> np.ndarray:
+    ''' Symbol values (0 = darkest level) of an encoded packet. '''
+    return bits_to_symbols(packet_bits(packet, fec), bits_per_symbol)
+
+def wave_packet(
+        packet:bytes,
+        volts:np.ndarray,
+        sample_rate:int,
+        frequency:int,
+        mod_period:float,
+        fec=NoFec(),
+        emphasis=None) -> np.ndarray:
+    '''
+        Voltage samples of one packet burst.
+
+        Args:
+            packet: Encoded packet (encode_packet).
+            volts: Drive amplitude of each symbol level, darkest first (2**k levels).
+            fec: Code from fec.make_fec, the receiver must use the same one.
+            emphasis: Optional preemphasis.PreEmphasis at sample_rate.
+    '''
+    symbols = packet_symbols(packet, int(np.log2(len(volts))), fec)
+    return wave_symbols(
+        duration=packet_duration(len(symbols), mod_period),
+        sample_rate=sample_rate,
+        a_max=volts[0],
+        a_min=volts[-1],
+        frequency=frequency,
+        mod_period=mod_period,
+        amplitudes=np.asarray(volts)[symbols],
+        emphasis=emphasis
+    )
+
+def packet_index(packet:bytes, num_levels:int, sample_rate:int, mod_period:float, fec=NoFec()) -> np.ndarray:
+    ''' Level index (0 = darkest) of every sample of the burst wave_packet builds without emphasis. '''
+    symbols = packet_symbols(packet, int(np.log2(num_levels)), fec)
+    num_samples = int(sample_rate * packet_duration(len(symbols), mod_period))
+    return frame_index(num_samples, sample_rate, mod_period, symbols, dark=0, bright=num_levels - 1)
+
+class FramingMetrics():
+    ''' Counters reported by PacketDemodulator. '''
+    def __init__(self):
+        self.packets     = 0 # packets that passed the CRC
+        self.bytes       = 0 # payload bytes delivered
+        self.crc_errors  = 0
+        self.bad_headers = 0 # impossible length, dropped before the CRC
+        self.seq_gaps    = 0 # packets missing before a received sequence number, from the first
+        self.fec_corrected     = 0 # bit (Hamming) or byte (RS) errors corrected
+        self.fec_uncorrectable = 0 # FEC blocks with more errors than the code corrects
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class PacketDemodulator(SyncDemodulator):
+    '''
+        Streaming receiver of packet bursts. Each burst is acquired on its own
+        preamble, its length is read from the header and the packet is delivered
+        only if its CRC matches.
+
+        Args:
+            sample_rate: AI sample rate (Hz).
+            threshold: Binary threshold or ascending PAM thresholds (see SyncDemodulator).
+            mod_period: Seconds per symbol.
+            max_payload: Largest payload the sender uses, longer headers are rejected.
+            crc_bits: 16 or 32.
+            fec: Code from fec.make_fec, the same as the sender's.
+            seq_step: Sequence increment between packets of this stream (lanes.stripe).
+            first_seq: Sequence number of the first packet of this stream (its lane).
+            slicer: Optional threshold.AdaptiveThreshold (see SyncDemodulator).
+            decision, guard: Symbol decision (see SyncDemodulator).
+            equalizer: Optional equalizer.DecisionFeedbackEqualizer (see SyncDemodulator).
+    '''
+    def __init__(
+            self,
+            sample_rate:int,
+            threshold,
+            mod_period:float=0.080,
+            max_payload:int=32,
+            crc_bits:int=16,
+            fec=NoFec(),
+            seq_step:int=1,
+            first_seq:int=0,
+            min_corr:float=0.6,
+            loop_gain:float=0.3,
+            slicer=None,
+            decision:str='sample',
+            guard:float=0.25,
+            equalizer=None):
+        super().__init__(
+            sample_rate=sample_rate,
+            threshold=threshold,
+            mod_period=mod_period,
+            min_corr=min_corr,
+            loop_gain=loop_gain,
+            slicer=slicer,
+            decision=decision,
+            guard=guard,
+            equalizer=equalizer
+        )
+        self.max_payload = max_payload
+        self.crc_bits    = crc_bits
+        self.fec         = fec
+        self.seq_step    = seq_step
+        self.framing     = FramingMetrics()
+        self.n_ini       = int(BIT_INI_WIND * sample_rate)
+        self.frame_log   = None # set to a list to keep (seq, coded bits, crc ok) of every frame
+        self._seq        = first_seq % 256 # expected sequence number
+        self._last_end   = 0 # absolute index after the last packet
+        self._last_lock  = 0 # absolute frame start of the last preamble lock
+        self._header     = (None, 0) # (frame start, payload length) of the last header read
+
+    @property
+    def last_end(self) -> int:
+        ''' Absolute sample index where the last complete packet burst ended. '''
+        return self._last_end
+
+    @property
+    def last_seen(self) -> int:
+        ''' Absolute sample index of the last preamble lock or packet end, valid or not. '''
+        return max(self._last_end, self._last_lock)
+
+    def _acquire(self):
+        ''' Lock on the first preamble in the buffer. '''
+        c = normalized_xcorr(self._buf, self.template)
+        hits = np.flatnonzero(c >= self.min_corr)
+        if not len(hits):
+            self._trim(self._buf_start + len(self._buf) - len(self.template) + 1)
+            return
+        first = int(hits[0])
+        if first + self.n_ini >= len(c):
+            # The correlation peak may lie past the samples received so far
+            self._trim(self._buf_start + first)
+            return
+        peak = first + int(np.argmax(c[first:first + self.n_ini + 1]))
+        self._frame = self._buf_start + peak + self.lead
+        self._last_lock = self._frame
+        self.metrics.locks += 1
+        self.metrics.last_corr = float(c[peak])
+
+    def _bits(self, num_bits:int, track:bool) -> np.ndarray:
+        ''' Hard decisions of the first num_bits coded bits of the packet at _frame. '''
+        count = -(-num_bits // self.bits_per_symbol)
+        bounds = self._frame + self.pre_len + np.arange(count) * self.bit_len
+        # One symbol past the last one (see _available) so a late integration window still fits
+        symbols = self._decide(self._window(self._frame, bounds[-1] + 2 * self.bit_len), self._frame, bounds, track)
+        return symbols_to_bits(symbols, self.bits_per_symbol)[:num_bits]
+
+    def _decode(self, bits:np.ndarray, num_bits:int) -> np.ndarray:
+        data, corrected, uncorrectable = self.fec.decode(bits, num_bits)
+        self.framing.fec_corrected += corrected
+        self.framing.fec_uncorrectable += uncorrectable
+        return data
+
+    def _available(self, count:int) -> bool:
+        end = self._frame + self.pre_len + (count + 1) * self.bit_len
+        return self._buf_start + len(self._buf) >= end
+
+    def _deliver(self, packet:bytes):
+        ''' (sequence, payload) of a packet that passes the CRC, else None. '''
+        body, check = packet[:-(self.crc_bits // 8)], packet[-(self.crc_bits // 8):]
+        if crc(body, self.crc_bits) != check:
+            self.framing.crc_errors += 1
+            return None
+        seq = body[1]
+        self.framing.seq_gaps += ((seq - self._seq) % 256) // self.seq_step
+        self._seq = (seq + self.seq_step) % 256
+        self.framing.packets += 1
+        self.framing.bytes += len(body) - HEADER_LEN
+        return seq, body[HEADER_LEN:]
+
+    def push(self, block:np.ndarray, start:int=None) -> bytes:
+        '''
+            Feed newly acquired samples.
+
+            Return:
+                payload bytes of every valid packet completed by this block.
+        '''
+        return b''.join(payload for _, payload in self.push_packets(block, start))
+
+    def push_packets(self, block:np.ndarray, start:int=None) -> List[Tuple[int, bytes]]:
+        ''' Like push, but returns (sequence, payload) of every valid packet. '''
+        end = self._buf_start + len(self._buf)
+        if start is not None and start != end:
+            self._buf, self._buf_start, self._frame = np.empty(0), start, None
+            self._header = (None, 0)
+        self._buf = np.concatenate((self._buf, np.asarray(block, dtype=np.float64)))
+        self._adapt(block)
+
+        out = []
+        header_bits = self.fec.encoded_bits(8 * HEADER_LEN)
+        while True:
+            if self._frame is None:
+                self._acquire()
+                if self._frame is None:
+                    break
+            if not self._available(-(-header_bits // self.bits_per_symbol)):
+                break
+            if self._header[0] != self._frame:
+                # Read once per burst, not again with every block until the body is in
+                header, _, _ = self.fec.decode(self._bits(header_bits, track=False), 8 * HEADER_LEN)
+                self._header = (self._frame, int(np.packbits(header)[0]))
+            length = self._header[1]
+            if length > self.max_payload:
+                # False lock or corrupted header, search again past this preamble
+                self.framing.bad_headers += 1
+                self._trim(self._frame - self.lead + self.n_ini)
+                self._frame = None
+                continue
+            body_len = 8 * (packet_len(length, self.crc_bits) - HEADER_LEN)
+            total = header_bits + self.fec.encoded_bits(body_len)
+            count = -(-total // self.bits_per_symbol)
+            if not self._available(count):
+                break
+            bits = self._bits(total, track=True)
+            packet = np.concatenate((
+                self._decode(bits[:header_bits], 8 * HEADER_LEN),
+                self._decode(bits[header_bits:], body_len)
+            ))
+            delivered = self._deliver(np.packbits(packet).tobytes())
+            if delivered is not None:
+                out.append(delivered)
+            if self.frame_log is not None:
+                self.frame_log.append((int(np.packbits(packet[8:8 * HEADER_LEN])[0]), bits, delivered is not None))
+            self.metrics.frames += 1
+            self._last_end = self._frame + self.pre_len + count * self.bit_len
+            self._trim(self._last_end - self.search)
+            self._frame = None
+        return out
@@ -0,0 +1,125 @@
+"""
+    Striping of a packet stream across several LC cells (AO channels CHAN_LOW..CHAN_HIG).
+
+    Packet i goes out on lane i % N. The bursts of one round start together and
+    are written as interleaved channel samples into the single AO scan buffer;
+    shorter bursts are padded with idle samples. On the receive side the
+    interleaved AI scan is split into lanes with strided views (no copies), each
+    lane has its own PacketDemodulator (each LC cell has its own timing) and the
+    payloads are put back in sequence order.
+"""
+from utils.framing import PacketDemodulator
+from utils.lockin import LockIn
+from typing import List
+import numpy as np
+
+def stripe(packets:List[bytes], num_lanes:int) -> List[List[bytes]]:
+    ''' Rounds of up to num_lanes packets, packet i on lane i % num_lanes. '''
+    return [packets[i:i + num_lanes] for i in range(0, len(packets), num_lanes)]
+
+def interleave(lanes:List[np.ndarray], num_lanes:int, fill) -> np.ndarray:
+    '''
+        Interleaved channel samples (scan order) of one round of lane waveforms.
+
+        Args:
+            lanes: Samples of each lane, at most num_lanes, any lengths.
+            num_lanes: Channels in the scan, missing lanes only carry fill.
+            fill: Idle sample padding the shorter lanes.
+    '''
+    length = max(len(lane) for lane in lanes)
+    first = np.asarray(lanes[0])
+    out = np.full((length, num_lanes), fill, dtype=first.dtype)
+    for c, lane in enumerate(lanes):
+        out[:len(lane), c] = lane
+    return out.ravel()
+
+def deinterleave(block:np.ndarray, num_lanes:int) -> np.ndarray:
+    ''' (num_lanes, samples) strided view of an interleaved block of whole scans. '''
+    return np.asarray(block).reshape(-1, num_lanes).T
+
+class LaneMetrics():
+    ''' Counters reported by MultiLaneReceiver. '''
+    def __init__(self):
+        self.packets        = 0
+        self.bytes          = 0
+        self.skipped_seqs   = 0 # sequence numbers given up on (packet lost on its lane)
+        self.max_reorder    = 0 # most packets held back waiting for an earlier one
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class MultiLaneReceiver():
+    '''
+        Decoder of an interleaved multi-channel AI scan carrying striped packets.
+
+        Args:
+            demods: One PacketDemodulator per lane, in channel order (seq_step = lanes).
+            seq: Sequence number of the first packet (framing.packetize).
+            front_ends: Optional lockin.LockIn per lane, the demodulators then run at
+                its output rate.
+    '''
+    def __init__(self, demods:List[PacketDemodulator], seq:int=0, front_ends:List[LockIn]=None):
+        self.demods    = demods
+        self.front_ends = front_ends
+        self.num_lanes = len(demods)
+        self.metrics   = LaneMetrics()
+        self._next     = seq % 256 # next sequence number to output
+        self._pending  = {}   # sequence -> payload received ahead of _next
+
+    @property
+    def locked(self) -> bool:
+        ''' True while any lane is inside a packet burst. '''
+        return any(demod.locked for demod in self.demods)
+
+    @property
+    def last_seen(self) -> int:
+        ''' Per lane sample index of the last preamble lock or packet end on any lane. '''
+        if self.front_ends:
+            return max(fe.to_input(demod.last_seen) for fe, demod in zip(self.front_ends, self.demods))
+        return max(demod.last_seen for demod in self.demods)
+
+    def _release(self, force:bool=False) -> bytes:
+        out = bytearray()
+        while self._pending:
+            if self._next in self._pending:
+                out += self._pending.pop(self._next)
+            elif force or len(self._pending) >= self.num_lanes:
+                # Every lane has moved past _next, its packet was lost
+                new = min(self._pending, key=lambda s: (s - self._next) % 256)
+                self.metrics.skipped_seqs += (new - self._next) % 256
+                self._next = new
+                continue
+            else:
+                break
+            self._next = (self._next + 1) % 256
+        return bytes(out)
+
+    def push(self, block:np.ndarray, start:int=None) -> bytes:
+        '''
+            Feed newly acquired interleaved samples.
+
+            Args:
+                block: Whole channel scans, channel order CHAN_LOW..CHAN_HIG.
+                start: Absolute point index (all channels) of block[0].
+
+            Return:
+                payload bytes that are now complete in sequence order.
+        '''
+        lanes = deinterleave(block, self.num_lanes)
+        lane_start = None if start is None else start // self.num_lanes
+        for lane, (demod, samples) in enumerate(zip(self.demods, lanes)):
+            start_in = lane_start
+            if self.front_ends:
+                start_in, samples = self.front_ends[lane].process(samples, lane_start)
+            for seq, payload in demod.push_packets(samples, start_in):
+                if (seq - self._next) % 256 >= 128:
+                    continue # older than what was already output
+                self._pending[seq] = payload
+                self.metrics.packets += 1
+                self.metrics.bytes += len(payload)
+        self.metrics.max_reorder = max(self.metrics.max_reorder, len(self._pending))
+        return self._release()
+
+    def flush(self) -> bytes:
+        ''' Output every held back payload, skipping the lost ones. '''
+        return self._release(force=True)
@@ -0,0 +1,126 @@
+"""
+    Lock-in receive front-end at the LC drive carrier.
+
+    Every builder drives the LC with a freq_lc bipolar square carrier, and the
+    detector output carries that carrier (and its harmonics) on top of the data
+    envelope. The front-end mixes each lane with a reference at harmonic *
+    freq_lc, low-passes the product with a Butterworth filter and keeps every
+    decimation-th sample, so the slicer sees a clean envelope at a fraction of
+    the AI rate:
+
+        harmonic 0:  low-pass only, the data envelope in detector volts (the
+                     thresholds of recv.py still apply)
+        harmonic k:  amplitude (V) of the detector component at k * freq_lc
+
+    Filter state, reference phase and decimation phase carry over from block to
+    block, a gap in the sample indices restarts them.
+
+    scipy.signal is imported when the first LockIn is built, receivers without
+    a lock-in front-end never load it.
+"""
+import numpy as np
+
+class LockInMetrics():
+    ''' Counters reported by LockIn. '''
+    def __init__(self):
+        self.samples_in  = 0
+        self.samples_out = 0
+        self.restarts    = 0 # gaps in the sample indices
+        self.phase       = None # reference phase (rad) of the carrier component, harmonic > 0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class LockIn():
+    '''
+        Streaming mixer, low-pass filter and decimator of one lane.
+
+        Args:
+            sample_rate: AI sample rate (Hz).
+            frequency: LC carrier frequency freq_lc (Hz).
+            harmonic: Reference at harmonic * frequency, 0 for the baseband envelope.
+            cutoff: Low-pass corner (Hz), below the carrier and half the output rate.
+            decimation: Input samples per output sample, divides sample_rate.
+            order: Butterworth filter order.
+    '''
+    def __init__(
+            self,
+            sample_rate:int,
+            frequency:float,
+            harmonic:int=0,
+            cutoff:float=25.0,
+            decimation:int=5,
+            order:int=4):
+        harmonic, decimation = int(harmonic), int(decimation)
+        if decimation < 1 or sample_rate % decimation:
+            raise Exception(f"[ERROR] Decimation {decimation} does not divide the AI rate {sample_rate}.")
+        if not 0 < cutoff < sample_rate / decimation / 2:
+            raise Exception(f"[ERROR] Cutoff {cutoff} Hz must lie below half the output rate {sample_rate / decimation} Hz.")
+        if harmonic * frequency >= sample_rate / 2:
+            raise Exception(f"[ERROR] Reference {harmonic * frequency} Hz is above the Nyquist rate of {sample_rate} Hz.")
+        self.sample_rate = sample_rate
+        self.out_rate    = sample_rate // decimation
+        self.harmonic    = harmonic
+        self.decimation  = decimation
+        from scipy.signal import butter, lfilter, lfilter_zi
+        self._lfilter, self._lfilter_zi = lfilter, lfilter_zi
+        # Transfer function form: per block call overhead is a fraction of sosfilt's
+        self.b, self.a   = butter(order, cutoff, fs=sample_rate)
+        self.step        = 2 * np.pi * harmonic * frequency / sample_rate # reference phase per sample
+        self.metrics     = LockInMetrics()
+        self._zi         = None # filter state, None until the first block
+        self._next       = None # absolute index expected next
+        self._skip       = 0    # samples of the next block before the first kept one
+        self._phase      = 0.0  # reference phase at _next
+
+    def _restart(self, start:int):
+        ''' Forget the filter state, output sample j sits at input index j * decimation. '''
+        self._zi = None
+        self._skip = -start % self.decimation
+        self._phase = (self.step * start) % (2 * np.pi)
+        self._next = start
+
+    def process(self, block:np.ndarray, start:int=None):
+        '''
+            Filter newly acquired samples of one lane.
+
+            Args:
+                block: Detector samples.
+                start: Absolute index of block[0], defaults to right after the last block.
+
+            Return:
+                (absolute output index of the first sample, envelope samples at out_rate)
+        '''
+        x = np.asarray(block, dtype=np.float64)
+        if self._next is None or (start is not None and start != self._next):
+            if self._next is not None:
+                self.metrics.restarts += 1
+            self._restart(0 if start is None else start)
+        first = self._next + self._skip
+        if not len(x):
+            return first // self.decimation, np.empty(0)
+
+        if self.harmonic:
+            # Mix down to DC with a complex reference, the phase continues across blocks
+            x = x * np.exp(-1j * (self._phase + self.step * np.arange(len(x))))
+            self._phase = (self._phase + self.step * len(x)) % (2 * np.pi)
+        if self._zi is None:
+            # Baseband starts in the steady state of its first sample instead of ramping up from 0 V
+            zi = self._lfilter_zi(self.b, self.a)
+            self._zi = zi * x[0] if not self.harmonic else np.zeros_like(zi, dtype=complex)
+        y, self._zi = self._lfilter(self.b, self.a, x, zi=self._zi)
+
+        out = y[self._skip::self.decimation]
+        self._skip = (self._skip - len(x)) % self.decimation
+        self._next += len(x)
+        self.metrics.samples_in += len(x)
+        self.metrics.samples_out += len(out)
+        if self.harmonic:
+            if len(out):
+                self.metrics.phase = float(np.angle(out[-1]))
+            out = 2 * np.abs(out) # peak amplitude of the carrier component
+        return first // self.decimation, out
+
+    def to_input(self, index:int) -> int:
+        ''' Input sample index of output sample index. '''
+        return index * self.decimation
@@ -0,0 +1,51 @@
+"""
+    Integrate-and-dump decisions over whole symbol windows.
+
+    Deciding a symbol from the one AI sample at its centre keeps a single noise
+    sample and whatever phase of the 200 Hz LC carrier ripple it lands on. The
+    matched filter of a rectangular symbol is its mean: the synchronized sample
+    stream is viewed as a (symbols x samples per symbol) matrix without copying,
+    the LC transition at each end of the window is trimmed by a guard, and every
+    row is averaged into one soft value before slicing. Averaging n samples of
+    white noise lowers its deviation by sqrt(n).
+"""
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+
+DECISIONS = ('sample', 'integrate')
+
+def integration_width(bit_len:int, guard:float) -> int:
+    ''' Samples averaged per symbol: the symbol minus guard * bit_len at each end. '''
+    if not 0 <= guard < 0.5:
+        raise Exception(f"[ERROR] Guard {guard} must trim less than half of the symbol at each end.")
+    return max(int(round(bit_len * (1 - 2 * guard))), 1)
+
+def symbol_windows(x:np.ndarray, first:int, count:int, step:int, width:int) -> np.ndarray:
+    '''
+        Read only (count, width) view of x, row i holds x[first + i*step:][:width].
+
+        Args:
+            x: Detector samples.
+            first: Index of the first sample of the first window.
+            count: Windows (symbols).
+            step: Samples between window starts (bit_len).
+            width: Samples per window.
+    '''
+    x = np.asarray(x)
+    if first < 0 or count < 1 or first + (count - 1) * step + width > len(x):
+        raise Exception(f"[ERROR] {count} windows of {width} samples from {first} exceed {len(x)} samples.")
+    return sliding_window_view(x[first:first + (count - 1) * step + width], width)[::step]
+
+def integrate_dump(x:np.ndarray, first:int, count:int, step:int, width:int) -> np.ndarray:
+    ''' Soft value (mean volts) of each of count windows (see symbol_windows). '''
+    return symbol_windows(x, first, count, step, width).mean(axis=1)
+
+def centred_means(x:np.ndarray, centres:np.ndarray, width:int) -> np.ndarray:
+    '''
+        Mean of the width samples around each centre index, windows clipped to x.
+        For decision instants that are not evenly spaced.
+    '''
+    x = np.asarray(x)
+    width = min(width, len(x))
+    starts = np.clip(np.asarray(centres, dtype=np.int64) - width // 2, 0, len(x) - width)
+    return sliding_window_view(x, width)[starts].mean(axis=1)
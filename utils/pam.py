@@ -0,0 +1,310 @@
+"""
+    Multi-level (PAM-2/4/8) symbol modulation from a measured BV curve.
+
+    A BV calibration (drive amplitude vs detector intensity) is measured once and
+    stored. Drive levels are chosen so their settled intensities are evenly spaced
+    over the monotonic part of the curve, and the receive thresholds are the
+    midpoints between neighbouring intensities. Symbols are Gray coded so a
+    decision error between neighbouring levels costs a single bit.
+
+    More levels sit closer together, so the LC has to settle further within a
+    symbol. configured_levels() passes a pseudo random level sequence through
+    the cell's step response (the [Sim] cell on the sim backend, else the stored
+    lc_fit) and refuses a mod_period that leaves less than MIN_OPENING of the
+    level spacing open at the decision instants.
+"""
+from utils.daq import McculwUsbDaq, LC, DaqAO, DaqAI, ul, sleep
+from utils.counts import daq_converter, write_buffer
+from utils.matched import integrate_dump, integration_width
+from mcculw.enums import ScanOptions, FunctionType, Status
+from typing import List
+import numpy as np
+import ctypes, os
+
+class BvCalibration():
+    '''
+        Measured BV curve of an LC cell.
+
+        Args:
+            voltages: Carrier amplitudes (V), ascending.
+            intensity: Settled detector voltage at each amplitude.
+    '''
+    def __init__(self, voltages, intensity):
+        order = np.argsort(voltages)
+        self.voltages  = np.asarray(voltages, dtype=float)[order]
+        self.intensity = np.asarray(intensity, dtype=float)[order]
+
+    def save(self, path:str):
+        np.savez(path, voltages=self.voltages, intensity=self.intensity)
+
+    @classmethod
+    def load(cls, path:str) -> 'BvCalibration':
+        data = np.load(path)
+        return cls(data['voltages'], data['intensity'])
+
+    @classmethod
+    def from_steps(cls, voltages, ai_samples:np.ndarray, settle:float=0.5) -> 'BvCalibration':
+        '''
+            Average the settled part of each voltage step of a sweep capture.
+
+            Args:
+                voltages: Amplitude of each step, in sweep order.
+                ai_samples: Detector samples covering all steps, equally split.
+                settle: Fraction of each step skipped while the LC settles.
+        '''
+        steps = np.array_split(np.asarray(ai_samples, dtype=float), len(voltages))
+        intensity = [step[int(settle * len(step)):].mean() for step in steps]
+        return cls(voltages, intensity)
+
+    def monotonic_range(self):
+        '''
+            (v_lo, v_hi) of the monotonic stretch with the largest intensity swing,
+            the part of the curve that can be inverted to pick drive levels.
+        '''
+        slope = np.sign(np.diff(self.intensity))
+        # Flat steps belong to the stretch they sit in
+        filled = np.maximum.accumulate(np.where(slope != 0, np.arange(len(slope)), 0))
+        slope = slope[filled]
+        bounds = np.flatnonzero(np.diff(slope)) + 1
+        starts = np.concatenate(([0], bounds))
+        stops = np.concatenate((bounds, [len(slope)]))
+        swing = np.abs(self.intensity[stops] - self.intensity[starts])
+        best = (starts[np.argmax(swing)], stops[np.argmax(swing)])
+        return self.voltages[best[0]], self.voltages[best[1]]
+
+class PamLevels():
+    '''
+        Drive amplitudes and receive thresholds of a PAM alphabet.
+        Level i has the i-th lowest intensity, level 0 is the darkest.
+    '''
+    def __init__(self, volts, intensity):
+        self.volts      = np.asarray(volts, dtype=float)
+        self.intensity  = np.asarray(intensity, dtype=float)
+        self.thresholds = (self.intensity[1:] + self.intensity[:-1]) / 2
+        self.bits_per_symbol = int(np.log2(len(self.volts)))
+        if 1 << self.bits_per_symbol != len(self.volts):
+            raise Exception(f"[ERROR] PAM needs a power of 2 levels, got {len(self.volts)}.")
+
+    @property
+    def a_min(self) -> float:
+        ''' Amplitude of the brightest level (preamble min bits). '''
+        return float(self.volts[-1])
+
+    @property
+    def a_max(self) -> float:
+        ''' Amplitude of the darkest level (preamble max bit). '''
+        return float(self.volts[0])
+
+def select_levels(cal:BvCalibration, bits_per_symbol:int, margin:float=0.05) -> PamLevels:
+    '''
+        Pick 2**bits_per_symbol drive amplitudes with evenly spaced intensities.
+
+        Args:
+            cal: Stored BV calibration.
+            bits_per_symbol: 1 (binary), 2 (PAM-4) or 3 (PAM-8).
+            margin: Fraction of the intensity swing left unused at each end,
+                where the BV curve flattens and small drifts move the level most.
+    '''
+    v_lo, v_hi = cal.monotonic_range()
+    inside = (cal.voltages >= v_lo) & (cal.voltages <= v_hi)
+    v, i = cal.voltages[inside], cal.intensity[inside]
+    swing = i.max() - i.min()
+    targets = np.linspace(i.min() + margin * swing, i.max() - margin * swing, 1 << bits_per_symbol)
+    order = np.argsort(i)
+    volts = np.interp(targets, i[order], v[order])
+    return PamLevels(volts, np.interp(volts, cal.voltages, cal.intensity))
+
+def load_levels(bits_per_symbol:int, path:str) -> PamLevels:
+    ''' Levels of the link from the stored BV calibration at path. '''
+    try:
+        cal = BvCalibration.load(path)
+    except FileNotFoundError:
+        raise Exception(f"[ERROR] No BV calibration at {path}, measure it with `python -m utils.pam`.")
+    return select_levels(cal, bits_per_symbol)
+
+#__________________ Settling check ______________________________________________
+
+MIN_OPENING = 0.6 # fraction of the level spacing left to the noise after the LC transitions
+_unchecked = set() # PAM alphabets warned about once, without a step response to check them
+
+def eye_opening(levels:PamLevels, fit, mod_period:float, sample_rate:int, decision:str='sample',
+                guard:float=0.25, emphasis=None) -> float:
+    '''
+        Narrowest eye between neighbouring levels at the decision instants of a pseudo
+        random level sequence, as a fraction of their settled spacing: 1 for a cell
+        that settles within the symbol, 0 or less once neighbouring levels overlap.
+
+        Args:
+            fit: Step response of the cell (preemphasis.LcFit).
+            decision, guard: Symbol decision of the receiver (see SyncDemodulator).
+            emphasis: Optional preemphasis.PreEmphasis at sample_rate.
+    '''
+    num_levels = len(levels.volts)
+    pattern = np.random.default_rng(0).integers(0, num_levels, 64 * num_levels)
+    T = int(round(mod_period * sample_rate))
+    env = np.repeat(levels.volts[pattern], T)
+    if emphasis is not None:
+        env = emphasis.shape(env)
+    settled = fit.intensity(levels.volts)
+    y = fit.respond(env, 1 / sample_rate, float(settled[pattern[0]]))
+    if decision == 'integrate':
+        width = integration_width(T, guard)
+        soft = integrate_dump(y, T // 2 - width // 2, len(pattern), T, width)
+    else:
+        soft = y[T // 2::T][:len(pattern)]
+    # The first symbols start from a settled cell
+    soft, pattern = soft[8:], pattern[8:]
+    order = np.argsort(settled)
+    return float(min(
+        (soft[pattern == upper].min() - soft[pattern == lower].max()) / (settled[upper] - settled[lower])
+        for lower, upper in zip(order[:-1], order[1:])
+    ))
+
+def configured_fit(volts):
+    ''' Step response of the cell driven with volts: the [Sim] cell on the sim backend, else lc_fit, None without one. '''
+    from utils.preemphasis import LcFit
+    from utils import daq
+    if ul.name == 'sim':
+        from utils.sim import lc_from_config
+        lc = lc_from_config(daq.config)
+        drives = np.unique(np.round(np.concatenate((volts, [LC.OVERDRIVE_ON.value, LC.OVERDRIVE_OFF.value])), 3))
+        return LcFit(drives, lc.bv(drives), lc.tau_rise, lc.tau_fall, sigma=lc.noise)
+    if os.path.exists(LC.LC_FIT.value):
+        return LcFit.load(LC.LC_FIT.value)
+    return None
+
+def check_settling(levels:PamLevels, mod_period:float, fit=None, emphasis=None):
+    ''' Raise if the LC cannot settle between levels within mod_period (see eye_opening). '''
+    fit = fit or configured_fit(levels.volts)
+    num_levels = len(levels.volts)
+    if fit is None:
+        if num_levels not in _unchecked:
+            _unchecked.add(num_levels)
+            print(f"[pam.py] [WARNING] No LC fit at {LC.LC_FIT.value}, PAM-{num_levels} settling at mod_period "
+                  f"{mod_period} s is not checked (measure it with `python -m utils.preemphasis`).")
+        return
+    rate, decision, guard = DaqAI.FREQ_SAMPLE.value, DaqAI.DECISION.value, DaqAI.DECISION_GUARD.value
+    opening = eye_opening(levels, fit, mod_period, rate, decision, guard, emphasis)
+    if opening >= MIN_OPENING:
+        return
+    # Shortest period that would do, in 5 ms steps
+    periods = np.arange(mod_period, 1.0, 0.005)
+    usable = next((p for p in periods if eye_opening(levels, fit, p, rate, decision, guard, emphasis) >= MIN_OPENING), None)
+    hint = f"use mod_period >= {usable:.3f} s" if usable is not None else "no mod_period below 1 s settles"
+    raise Exception(
+        f"[ERROR] PAM-{num_levels} at mod_period {mod_period} s leaves {opening:.1%} of the level spacing open after "
+        f"the LC transitions (tau_rise {fit.tau_rise * 1e3:.0f} ms, tau_fall {fit.tau_fall * 1e3:.0f} ms), "
+        f"{MIN_OPENING:.0%} needed: {hint} or fewer bits_per_symbol."
+    )
+
+def configured_levels(mod_period:float) -> PamLevels:
+    '''
+        Levels of [LC] bits_per_symbol from the stored BV calibration, checked to
+        settle within mod_period with the configured pre-emphasis.
+    '''
+    from utils.preemphasis import configured_emphasis
+    levels = load_levels(LC.BITS_PER_SYMBOL.value, LC.BV_CALIBRATION.value)
+    check_settling(levels, mod_period, emphasis=configured_emphasis(DaqAI.FREQ_SAMPLE.value))
+    return levels
+
+#__________________ Symbol mapping ______________________________________________
+
+def gray_encode(n:np.ndarray) -> np.ndarray:
+    n = np.asarray(n)
+    return n ^ (n >> 1)
+
+def gray_decode(g:np.ndarray) -> np.ndarray:
+    g = np.asarray(g).copy()
+    shift = g >> 1
+    while shift.any():
+        g ^= shift
+        shift >>= 1
+    return g
+
+def bits_to_symbols(bits:np.ndarray, bits_per_symbol:int) -> np.ndarray:
+    ''' Level index of every symbol, MSB first, Gray coded. The last symbol is zero padded. '''
+    bits = np.asarray(bits, dtype=np.int64)
+    if len(bits) % bits_per_symbol:
+        bits = np.concatenate((bits, np.zeros(-len(bits) % bits_per_symbol, dtype=np.int64)))
+    weights = 1 << np.arange(bits_per_symbol - 1, -1, -1)
+    return gray_decode(bits.reshape(-1, bits_per_symbol) @ weights)
+
+def symbols_to_bits(levels:np.ndarray, bits_per_symbol:int) -> np.ndarray:
+    ''' Inverse of bits_to_symbols. '''
+    values = gray_encode(np.asarray(levels, dtype=np.int64))
+    return ((values[:, None] >> np.arange(bits_per_symbol - 1, -1, -1)) & 1).astype(np.uint8).ravel()
+
+def bytes_to_symbols(data:bytes, bits_per_symbol:int) -> np.ndarray:
+    return bits_to_symbols(np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8)), bits_per_symbol)
+
+def symbols_to_bytes(levels:np.ndarray, bits_per_symbol:int) -> bytes:
+    ''' Inverse of bytes_to_symbols, trailing partial bytes are dropped. '''
+    bits = symbols_to_bits(levels, bits_per_symbol)
+    return np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
+
+def slice_levels(values:np.ndarray, thresholds:np.ndarray) -> np.ndarray:
+    ''' Level index of each soft value for ascending thresholds. '''
+    return np.searchsorted(thresholds, values)
+
+#__________________ Calibration measurement ______________________________________
+
+def measure_steps(
+        ao_daq:McculwUsbDaq,
+        ai_daq:McculwUsbDaq,
+        voltages:List[float],
+        step_time:float=0.2,
+        frequency:int=200) -> np.ndarray:
+    '''
+        Step the carrier amplitude of channel 0 through voltages, step_time each,
+        and return the detector samples of the whole sequence (finite AO and AI
+        background scans).
+    '''
+    ao_rate, ai_rate = DaqAO.FREQ_SAMPLE.value, DaqAI.FREQ_SAMPLE.value
+    step_len = int(step_time * ao_rate)
+    t = np.arange(step_len * len(voltages)) / ao_rate
+    wave = np.repeat(np.asarray(voltages, dtype=float), step_len) * np.sign(np.sin(2 * np.pi * frequency * t))
+
+    memhandle_ao = ul.win_buf_alloc(len(wave))
+    num_ai = int(len(wave) / ao_rate * ai_rate)
+    memhandle_ai = ul.scaled_win_buf_alloc(num_ai)
+    try:
+        write_buffer(ctypes.cast(memhandle_ao, ctypes.POINTER(ctypes.c_ushort)), daq_converter(ao_daq).to_counts(wave))
+        ul.a_out_scan(ao_daq.daq_board_num, 0, 0, len(wave), ao_rate, ao_daq.daq_ao_range,
+                      memhandle_ao, ScanOptions.BACKGROUND)
+        ul.a_in_scan(ai_daq.daq_board_num, 0, 0, num_ai, ai_rate, ai_daq.daq_ai_range,
+                     memhandle_ai, ScanOptions.BACKGROUND | ScanOptions.SCALEDATA)
+        while ul.get_status(ai_daq.daq_board_num, FunctionType.AIFUNCTION)[0] != Status.IDLE:
+            sleep(step_time)
+        ai = (ctypes.c_double * num_ai)()
+        ul.scaled_win_buf_to_array(memhandle_ai, ai, 0, num_ai)
+    finally:
+        ul.stop_background(ao_daq.daq_board_num, FunctionType.AOFUNCTION)
+        ul.stop_background(ai_daq.daq_board_num, FunctionType.AIFUNCTION)
+        ul.win_buf_free(memhandle_ao)
+        ul.win_buf_free(memhandle_ai)
+    return np.array(ai)
+
+def measure_bv_curve(
+        ao_daq:McculwUsbDaq,
+        ai_daq:McculwUsbDaq,
+        voltages:List[float],
+        step_time:float=0.2,
+        frequency:int=200) -> BvCalibration:
+    '''
+        Sweep the carrier amplitude through voltages and average the settled
+        detector level of each step.
+    '''
+    return BvCalibration.from_steps(voltages, measure_steps(ao_daq, ai_daq, voltages, step_time, frequency))
+
+if __name__ == "__main__":
+    # Measure and store the BV calibration used for level selection
+    from utils import daq
+    usb_3101fs, usb_202 = daq.devices().acquire('USB-3101FS', 'USB-202')
+    try:
+        cal = measure_bv_curve(usb_3101fs, usb_202, np.arange(0, 3.0, 0.02), frequency=daq.LC.FREQ_LC.value)
+        path = daq.LC.BV_CALIBRATION.value
+        cal.save(path)
+        print(f"Saved BV calibration to {path} | monotonic range {cal.monotonic_range()}")
+    finally:
+        usb_3101fs.release_device()
+        usb_202.release_device()
@@ -0,0 +1,281 @@
+"""
+    Transmit pre-emphasis: overdrive the LC at every symbol transition.
+
+    A step response of the cell is measured once (channel 0, every drive level
+    entered from above and below) and fitted with an asymmetric first order
+    model, optionally followed by a second pole:
+
+        settled intensity of every measured drive amplitude
+        tau_rise, tau_fall:  time constants of brightening and darkening
+        tau_2:               common second pole (0 for a first order fit)
+
+    The shaper then starts every symbol at the overdrive amplitude beyond its
+    level (overdrive_on towards bright, overdrive_off towards dark) for the time
+    the model takes to reach the level from the previous one, and holds the level
+    for the rest of the symbol. With levels inside the BV curve, the cell settles
+    in a fraction of its free response time. The boost only depends on the pair
+    of levels of a transition, so it is computed once per pair and whole frames
+    are shaped with array operations.
+
+    usage: python -m utils.preemphasis [--hold 0.3] [--order 1] [--drives 0,1.4,1.6,3]
+"""
+from utils import daq
+from utils.sim import LcModel
+from utils.training import EyeModel, configured_periods
+from mcculw.enums import ULRange
+import numpy as np
+import json, os
+
+class LcFit():
+    '''
+        Fitted step response of an LC cell.
+
+        Args:
+            drives: Carrier amplitudes (V) of the measurement, ascending.
+            intensities: Settled detector voltage of every drive.
+            tau_rise: Time constant (s) of increasing intensity.
+            tau_fall: Time constant (s) of decreasing intensity.
+            tau_2: Time constant (s) of the second pole, 0 for a first order response.
+            delay: Offset (s) of the AI record from the drive steps.
+            sigma: RMS residual (V) of the fit.
+    '''
+    def __init__(self, drives, intensities, tau_rise:float, tau_fall:float, tau_2:float=0.0, delay:float=0.0, sigma:float=0.0):
+        order = np.argsort(drives)
+        self.drives      = [float(v) for v in np.asarray(drives, dtype=float)[order]]
+        self.intensities = [float(i) for i in np.asarray(intensities, dtype=float)[order]]
+        self.tau_rise    = float(tau_rise)
+        self.tau_fall    = float(tau_fall)
+        self.tau_2       = float(tau_2)
+        self.delay       = float(delay)
+        self.sigma       = float(sigma)
+        self._lc = LcModel(tau_rise=self.tau_rise, tau_fall=self.tau_fall, noise=0.0)
+
+    def intensity(self, volts) -> np.ndarray:
+        ''' Settled intensity of drive amplitudes, interpolated between the measured drives. '''
+        return np.interp(np.round(np.abs(volts), 3), self.drives, self.intensities)
+
+    def respond(self, envelope:np.ndarray, dt:float, state:float) -> np.ndarray:
+        ''' Modelled detector samples for a drive amplitude per sample, from intensity state. '''
+        y, _ = self._lc.respond(self.intensity(envelope), dt, state)
+        if self.tau_2 > 0:
+            from scipy.signal import lfilter, lfilter_zi # second order fits only
+            a = 1 - np.exp(-dt / self.tau_2)
+            y, _ = lfilter([a], [1, a - 1], y, zi=lfilter_zi([a], [1, a - 1]) * state)
+        return y
+
+    def as_dict(self) -> dict:
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+    def save(self, path:str):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path:str) -> 'LcFit':
+        with open(path) as f:
+            return cls(**json.load(f))
+
+def step_sequence(drives) -> np.ndarray:
+    '''
+        Drive amplitude of every step of the fit measurement: a lead at the lowest
+        drive, then each pair of drives from the higher to the lower one, so every
+        level is entered from above and from below.
+    '''
+    drives = np.unique(np.asarray(drives, dtype=float))
+    steps = [drives[0]]
+    for i in range(len(drives)):
+        for j in range(i + 1, len(drives)):
+            steps += [drives[j], drives[i]]
+    return np.array(steps)
+
+def _steps_response(t:np.ndarray, switches:np.ndarray, levels:np.ndarray, tau_rise:float, tau_fall:float, start:float) -> np.ndarray:
+    ''' First order response at times t to levels[k] from switches[k] on, closed form per step. '''
+    states, taus = np.empty(len(levels)), np.empty(len(levels))
+    y = start
+    for k, level in enumerate(levels):
+        states[k] = y
+        taus[k] = tau_rise if level > y else tau_fall
+        if k + 1 < len(levels):
+            y = level + (y - level) * np.exp(-(switches[k + 1] - switches[k]) / taus[k])
+    run = np.searchsorted(switches, t, side='right') - 1
+    out = np.full(len(t), float(start))
+    k = run[run >= 0]
+    out[run >= 0] = levels[k] + (states[k] - levels[k]) * np.exp(-(t[run >= 0] - switches[k]) / taus[k])
+    return out
+
+def fit_response(x:np.ndarray, sample_rate:int, steps, hold:float, order:int=1) -> LcFit:
+    '''
+        Fit the step response of a measurement.
+
+        Args:
+            x: Detector samples from the start of the first step (pam.measure_steps).
+            sample_rate: AI sample rate (Hz).
+            steps: Drive amplitude of every step (step_sequence), the first one is the lead.
+            hold: Seconds per step.
+            order: 1 for the asymmetric first order model, 2 to add a second pole.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    steps = np.round(np.asarray(steps, dtype=float), 3)
+    from scipy.optimize import least_squares
+    from scipy.signal import lfilter, lfilter_zi
+    drives, index = np.unique(steps, return_inverse=True)
+    t = np.arange(len(x)) / sample_rate
+    n_hold = int(hold * sample_rate)
+    if len(x) < len(steps) * n_hold:
+        raise Exception(f"[ERROR] {len(x)} samples do not cover {len(steps)} steps of {hold} s.")
+    # The lead lets the cell settle, it only provides the starting state
+    used = t >= hold
+
+    # Start: median of the settled end of every step of each drive, free response times
+    tails = x[:len(steps) * n_hold].reshape(len(steps), n_hold)[:, -int(0.4 * n_hold):]
+    p0 = [np.median(tails[index == i]) for i in range(len(drives))] + [hold / 20, hold / 20, 0.0]
+    lo = [-np.inf] * len(drives) + [1 / sample_rate / 10] * 2 + [-hold / 4]
+    hi = [np.inf] * len(drives) + [hold] * 2 + [hold / 4]
+    if order == 2:
+        p0, lo, hi = p0 + [2 / sample_rate], lo + [1 / sample_rate / 10], hi + [hold]
+    elif order != 1:
+        raise Exception(f"[ERROR] Unsupported model order {order}, use 1 or 2.")
+
+    def model(p):
+        levels = np.asarray(p[:len(drives)])
+        tau_rise, tau_fall, delay = p[len(drives):len(drives) + 3]
+        switches = delay + hold * np.arange(1, len(steps))
+        y = _steps_response(t, switches, levels[index[1:]], tau_rise, tau_fall, levels[index[0]])
+        if order == 2:
+            a = 1 - np.exp(-1 / sample_rate / p[-1])
+            y, _ = lfilter([a], [1, a - 1], y, zi=lfilter_zi([a], [1, a - 1]) * y[0])
+        return y
+
+    result = least_squares(lambda p: (model(p) - x)[used], p0, bounds=(lo, hi), x_scale='jac')
+    p = result.x
+    sigma = float(np.sqrt(np.mean(result.fun ** 2)))
+    return LcFit(drives, p[:len(drives)], p[len(drives)], p[len(drives) + 1],
+                 p[-1] if order == 2 else 0.0, p[len(drives) + 2], sigma)
+
+class PreEmphasis():
+    '''
+        Transition shaper of frame envelopes.
+
+        Args:
+            fit: LcFit of the cell.
+            overdrive_on: Drive (V) at the bright end of the BV curve, used towards brighter levels.
+            overdrive_off: Drive (V) at the dark end, used towards darker levels.
+            sample_rate: Sample rate (Hz) of the envelopes.
+    '''
+    def __init__(self, fit:LcFit, overdrive_on:float, overdrive_off:float, sample_rate:int):
+        self.fit           = fit
+        self.overdrive_on  = float(overdrive_on)
+        self.overdrive_off = float(overdrive_off)
+        self.sample_rate   = sample_rate
+        self._boosts       = {} # (previous, level) drive in mV -> (samples, overdrive volts)
+
+    def boost(self, previous:float, level:float):
+        '''
+            (samples, drive) of the overdrive starting a symbol at level after previous,
+            0 samples when the overdrive does not reach past the level.
+        '''
+        key = (int(round(previous * 1e3)), int(round(level * 1e3)))
+        if key not in self._boosts:
+            i_prev, i_level = self.fit.intensity(previous), self.fit.intensity(level)
+            if i_level > i_prev:
+                drive, tau = self.overdrive_on, self.fit.tau_rise
+            else:
+                drive, tau = self.overdrive_off, self.fit.tau_fall
+            i_drive = self.fit.intensity(drive)
+            # Time the free response towards i_drive takes from i_prev to i_level
+            ratio = (i_drive - i_prev) / (i_drive - i_level) if i_drive != i_level else 0.0
+            samples = int(round(tau * np.log(ratio) * self.sample_rate)) if ratio > 1 else 0
+            self._boosts[key] = (samples, drive)
+        return self._boosts[key]
+
+    def settle_time(self, volts) -> float:
+        ''' Longest overdrive (s) between any two of the drive levels, the shortest symbol it fits in. '''
+        return max((self.boost(a, b)[0] for a in volts for b in volts if a != b), default=0) / self.sample_rate
+
+    def shape(self, envelope:np.ndarray) -> np.ndarray:
+        ''' Drive amplitude per sample with the start of every level run overdriven. '''
+        env = np.asarray(envelope, dtype=float)
+        starts = np.flatnonzero(np.diff(env)) + 1
+        if not len(starts):
+            return env
+        stops = np.append(starts[1:], len(env))
+        # One integer key per (previous, level) pair in mV, the boosts are looked up once per pair
+        prev, level = np.round(env[starts - 1] * 1e3).astype(np.int64), np.round(env[starts] * 1e3).astype(np.int64)
+        keys, first_run, inverse = np.unique(prev * (1 << 20) + level, return_index=True, return_inverse=True)
+        boosts = np.array([self.boost(env[starts[i] - 1], env[starts[i]]) for i in first_run])[inverse]
+        # A boost longer than its run is cut at the next transition
+        n = np.minimum(boosts[:, 0].astype(np.int64), stops - starts)
+        out = env.copy()
+        out[np.repeat(starts - (np.cumsum(n) - n), n) + np.arange(n.sum())] = np.repeat(boosts[:, 1], n)
+        return out
+
+def eye_margin(fit:LcFit, volts, mod_period:float, sample_rate:int, emphasis:PreEmphasis=None) -> float:
+    '''
+        Modelled eye half-opening at the symbol centres of a pseudo random pattern
+        between the darkest and brightest of volts, in fit.sigma.
+    '''
+    pattern = EyeModel.PATTERN
+    T = int(round(mod_period * sample_rate))
+    levels = np.array([volts[0], volts[-1]], dtype=float)
+    env = np.repeat(levels[pattern], T)
+    if emphasis is not None:
+        env = emphasis.shape(env)
+    y = fit.respond(env, 1 / sample_rate, float(fit.intensity(levels[1])))
+    soft = y[T // 2::T][:len(pattern)][8:]
+    bits = pattern[8:]
+    return float((soft[bits == 1].min() - soft[bits == 0].max()) / 2 / max(fit.sigma, 1e-6))
+
+def usable_period(fit:LcFit, volts, sample_rate:int, periods, target_margin:float, emphasis:PreEmphasis=None) -> float:
+    ''' Shortest of periods (ascending) whose modelled eye keeps target_margin, None if none does. '''
+    for period in periods:
+        if eye_margin(fit, volts, period, sample_rate, emphasis) >= target_margin:
+            return float(period)
+    return None
+
+def configured_emphasis(sample_rate:int) -> PreEmphasis:
+    ''' Shaper of [LC] preemphasis = on at sample_rate, None when off. '''
+    mode = daq.LC.PREEMPHASIS.value
+    if mode == 'off':
+        return None
+    if mode != 'on':
+        raise Exception(f"[ERROR] Unknown preemphasis '{mode}', use off or on.")
+    path = daq.LC.LC_FIT.value
+    if not os.path.exists(path):
+        raise Exception(f"[ERROR] No LC fit at {path}, measure it with `python -m utils.preemphasis`.")
+    ao_range = ULRange(daq.DaqAO.AO_RANGE.value)
+    for drive in (daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value):
+        if not ao_range.range_min <= drive <= ao_range.range_max:
+            raise Exception(f"[ERROR] Overdrive {drive} V is outside the AO range {ao_range.name}.")
+    return PreEmphasis(LcFit.load(path), daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value, sample_rate)
+
+if __name__ == "__main__":
+    # Measure the step response of channel 0 and store the LC fit used by pre-emphasis
+    from utils.pam import measure_steps
+    import argparse
+    parser = argparse.ArgumentParser(description="Fit the LC step response for transmit pre-emphasis.")
+    parser.add_argument('--hold', type=float, default=daq.Training.HOLD.value, help="seconds per step")
+    parser.add_argument('--order', type=int, default=1, help="1: first order, 2: with a second pole")
+    parser.add_argument('--drives', default=None, help="comma separated drive amplitudes (default: V_ON, V_OFF and the overdrives)")
+    args = parser.parse_args()
+    if args.drives:
+        drives = [float(v) for v in args.drives.split(',')]
+    else:
+        drives = [daq.LC.V_ON.value, daq.LC.V_OFF.value, daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value]
+
+    usb_3101fs, usb_202 = daq.devices().acquire('USB-3101FS', 'USB-202')
+    try:
+        steps = step_sequence(drives)
+        x = measure_steps(usb_3101fs, usb_202, steps, args.hold, daq.LC.FREQ_LC.value)
+    finally:
+        usb_3101fs.release_device()
+        usb_202.release_device()
+    fit = fit_response(x, daq.DaqAI.FREQ_SAMPLE.value, steps, args.hold, args.order)
+    fit.save(daq.LC.LC_FIT.value)
+    print(f"Saved LC fit to {daq.LC.LC_FIT.value} | {fit.as_dict()}")
+
+    volts, rate = [daq.LC.V_OFF.value, daq.LC.V_ON.value], daq.DaqAI.FREQ_SAMPLE.value
+    emphasis = PreEmphasis(fit, daq.LC.OVERDRIVE_ON.value, daq.LC.OVERDRIVE_OFF.value, rate)
+    periods, target = configured_periods(), daq.Training.TARGET_MARGIN.value
+    print(f"Usable mod_period for a margin of {target:g}: {usable_period(fit, volts, rate, periods, target)} s plain, "
+          f"{usable_period(fit, volts, rate, periods, target, emphasis)} s with pre-emphasis "
+          f"(overdrive settles in {emphasis.settle_time(volts) * 1e3:.1f} ms)")
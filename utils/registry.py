@@ -0,0 +1,309 @@
+"""
+    Registry of the USB DAQ boards of one process.
+
+    The first start enumerates the boards (get_daq_device_inventory), queries
+    their capabilities (ranges, channel counts, resolutions, max scan rates) and
+    stores them per backend and unique ID in the [Devices] registry file. Later
+    starts create a board straight from its cached descriptor and capabilities,
+    without the inventory or DaqDeviceInfo queries. If a cached board cannot be
+    created (unplugged, swapped) or a product is not cached, the boards are
+    enumerated again and the file is rewritten.
+
+    acquire() hands out one shared McculwUsbDaq per board and counts its users.
+    The board is released when the last user releases it, or at interpreter exit
+    for the ones still held, exactly once either way. Acquire the boards a script
+    needs in one call, a scan then keeps all of them created; boards nobody asked
+    for are released again right away, without a message.
+"""
+from utils.daq import McculwUsbDaq, ul, profile
+from mcculw.enums import InterfaceType, InfoType, BoardInfo, ULRange
+from mcculw.structs import DaqDeviceDescriptor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+import atexit, json, os, threading
+
+@dataclass(frozen=True)
+class DeviceCapabilities():
+    ''' Descriptor and static capabilities of one board, as cached in the registry file. '''
+    board_num:      int
+    product_name:   str
+    unique_id:      str
+    product_id:     int = 0
+    interface_type: int = int(InterfaceType.USB)
+    dev_string:     str = ''
+    ao_chans:       int = 0
+    ao_resolution:  int = 0
+    ao_ranges:      List[str] = field(default_factory=list) # ULRange names, default first
+    ao_max_rate:    int = None
+    ai_chans:       int = 0
+    ai_resolution:  int = 0
+    ai_ranges:      List[str] = field(default_factory=list)
+    ai_max_rate:    int = None
+
+    @property
+    def supports_ao(self) -> bool:
+        return self.ao_chans > 0
+
+    @property
+    def supports_ai(self) -> bool:
+        return self.ai_chans > 0
+
+    def descriptor(self) -> DaqDeviceDescriptor:
+        ''' Descriptor to create the board with, instead of one from the inventory. '''
+        descriptor = DaqDeviceDescriptor()
+        descriptor.product_name   = self.product_name
+        descriptor.product_id     = self.product_id
+        descriptor.interface_type = self.interface_type
+        descriptor.dev_string     = self.dev_string or self.product_name
+        descriptor.unique_id      = self.unique_id
+        return descriptor
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def query(cls, board_num:int, descriptor=None) -> 'DeviceCapabilities':
+        ''' Capabilities of a created board from the driver (DaqDeviceInfo). '''
+        info = ul.device_info(board_num)
+        ao = info.get_ao_info() if info.supports_analog_output else None
+        ai = info.get_ai_info() if info.supports_analog_input else None
+        ai_max_rate = getattr(ai, 'max_scan_rate', None)
+        if ai is not None and ai_max_rate is None:
+            try:
+                ai_max_rate = ul.get_config(InfoType.BOARDINFO, board_num, 0, BoardInfo.ADMAXRATE)
+            except Exception:
+                ai_max_rate = None # not reported by every board
+        return cls(
+            board_num=board_num,
+            product_name=info.product_name,
+            unique_id=info.unique_id,
+            product_id=int(getattr(descriptor, 'product_id', 0)),
+            interface_type=int(getattr(descriptor, 'interface_type', InterfaceType.USB)),
+            dev_string=str(getattr(descriptor, 'dev_string', info.product_name)),
+            ao_chans=ao.num_chans if ao else 0,
+            ao_resolution=ao.resolution if ao else 0,
+            ao_ranges=[ULRange(r).name for r in ao.supported_ranges] if ao else [],
+            ao_max_rate=getattr(ao, 'max_scan_rate', None),
+            ai_chans=ai.num_chans if ai else 0,
+            ai_resolution=ai.resolution if ai else 0,
+            ai_ranges=[ULRange(r).name for r in ai.supported_ranges] if ai else [],
+            ai_max_rate=ai_max_rate,
+        )
+
+class RegistryMetrics():
+    ''' Counters reported by DeviceRegistry. '''
+    def __init__(self):
+        self.enumerations = 0 # inventory scans
+        self.cache_hits   = 0 # boards created from cached descriptors
+        self.created      = 0
+        self.released     = 0
+        self.acquires     = 0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class DeviceRegistry():
+    '''
+        Board capabilities of one backend and the shared handles of its boards.
+
+        Args:
+            path: Registry file, '' to always enumerate (no file).
+            backend: Backend name the cached boards belong to (default: ul.name).
+    '''
+    def __init__(self, path:str='', backend:str=None):
+        self.path     = path
+        self.backend  = backend or ul.name
+        self.metrics  = RegistryMetrics()
+        self._caps:Dict[str, DeviceCapabilities] = self._load() # product name -> capabilities
+        self._handles:Dict[int, McculwUsbDaq] = {}
+        self._refs:Dict[int, int] = {}
+        self._created = set() # board numbers created in the backend
+        self._lock = threading.RLock()
+
+    #__________________ Registry file ___________
+
+    def _load(self) -> Dict[str, DeviceCapabilities]:
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                boards = json.load(f).get(self.backend, {})
+            return {caps.product_name: caps for caps in (DeviceCapabilities(**board) for board in boards.values())}
+        except (ValueError, TypeError):
+            print(f"[registry.py] Ignoring unreadable device registry {self.path}.")
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+        boards = sorted(self._caps.values(), key=lambda c: c.board_num)
+        data[self.backend] = {caps.unique_id: caps.as_dict() for caps in boards}
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    #__________________ Boards ___________________
+
+    def enumerate(self, keep=()) -> Dict[str, DeviceCapabilities]:
+        '''
+            Scan the inventory, query the capabilities of every board and rewrite the
+            registry file. Boards with handles out and the product names in keep (None:
+            all) stay created, the others are released again.
+
+            Args:
+                keep: Product names about to be acquired.
+        '''
+        with self._lock:
+            ul.ignore_instacal()
+            inventory = ul.get_daq_device_inventory(InterfaceType.USB)
+            if not inventory:
+                raise Exception("ERROR: No USB DAQ devices connected")
+            self.metrics.enumerations += 1
+            caps = {}
+            for board_num, descriptor in enumerate(inventory):
+                if board_num not in self._created:
+                    ul.create_daq_device(board_num, descriptor)
+                    self._created.add(board_num)
+                    self.metrics.created += 1
+                caps[descriptor.product_name] = DeviceCapabilities.query(board_num, descriptor)
+            self._caps = caps
+            # Only boards somebody holds stay created
+            keep = caps if keep is None else keep
+            kept = set(self._handles) | {caps[name].board_num for name in keep if name in caps}
+            for board_num in sorted(self._created - kept):
+                self.release_board(board_num, verbose=False)
+            self._save()
+            return dict(caps)
+
+    def capabilities(self) -> Dict[str, DeviceCapabilities]:
+        ''' Cached capabilities per product name, enumerated if there are none. '''
+        with self._lock:
+            return dict(self._caps) if self._caps else self.enumerate()
+
+    def board_capabilities(self, board_num:int) -> DeviceCapabilities:
+        ''' Cached capabilities of board_num, None if it is not known. '''
+        with self._lock:
+            return next((caps for caps in self._caps.values() if caps.board_num == board_num), None)
+
+    def _create(self, product_name:str, keep=()) -> DeviceCapabilities:
+        '''
+            Create the board of product_name from the cache, enumerating if needed.
+            A scan keeps the boards of keep (see enumerate) created as well.
+        '''
+        caps = self._caps.get(product_name)
+        if caps is not None and caps.board_num in self._created:
+            return caps
+        if caps is not None: # warm start, no inventory scan
+            try:
+                ul.ignore_instacal()
+                ul.create_daq_device(caps.board_num, caps.descriptor())
+                self._created.add(caps.board_num)
+                self.metrics.created += 1
+                self.metrics.cache_hits += 1
+                return caps
+            except Exception:
+                pass # hardware set changed, enumerate again
+        caps = self.enumerate(keep=(product_name,) + tuple(keep)).get(product_name)
+        if caps is None:
+            raise Exception(f"[ERROR] No {product_name} connected, found {sorted(self._caps)}.")
+        return caps
+
+    def acquire(self, *product_names:str):
+        '''
+            Shared handle of every board in product_names, release() each when done.
+
+            Return:
+                The McculwUsbDaq of a single product name, else a tuple in argument order.
+                If a board cannot be opened, the ones already acquired are released again.
+        '''
+        with self._lock:
+            handles, created = [], set(self._created)
+            try:
+                for product_name in product_names:
+                    caps = self._create(product_name, keep=product_names)
+                    handle = self._handles.get(caps.board_num)
+                    if handle is None:
+                        handle = McculwUsbDaq(caps.board_num, capabilities=caps, registry=self)
+                        self._handles[caps.board_num] = handle
+                    self._refs[caps.board_num] = self._refs.get(caps.board_num, 0) + 1
+                    self.metrics.acquires += 1
+                    handles.append(handle)
+            except Exception:
+                # All or nothing, the caller gets no handle to release
+                for handle in handles:
+                    self.release(handle)
+                for board_num in sorted(self._created - created - set(self._handles)):
+                    self.release_board(board_num, verbose=False) # kept by a scan for this call
+                raise
+            return handles[0] if len(handles) == 1 else tuple(handles)
+
+    def release(self, handle:McculwUsbDaq):
+        ''' Drop one use of handle, the board is released with the last one. '''
+        with self._lock:
+            board_num = handle.daq_board_num
+            if self._handles.get(board_num) is not handle:
+                return # already released
+            self._refs[board_num] -= 1
+            if self._refs[board_num] <= 0:
+                self.release_board(board_num)
+
+    def release_board(self, board_num:int, verbose:bool=True):
+        ''' Release a created board now, dropping its handle. No-op if it is not created. '''
+        with self._lock:
+            self._handles.pop(board_num, None)
+            self._refs.pop(board_num, None)
+            if board_num not in self._created:
+                return
+            self._created.discard(board_num)
+            self.metrics.released += 1
+            if verbose:
+                names = [name for name, caps in self._caps.items() if caps.board_num == board_num]
+                print(f"Released device {names[0] if names else board_num}")
+            ul.release_daq_device(board_num)
+
+    def boards(self) -> Dict[str, int]:
+        ''' Board number per product name of every known board, all created (configure_devices). '''
+        with self._lock:
+            if not self._caps:
+                self.enumerate(keep=None)
+            for name in list(self._caps):
+                self._create(name)
+            return {name: caps.board_num for name, caps in self._caps.items()}
+
+    def shutdown(self):
+        ''' Release every board still created, whatever its use count. '''
+        with self._lock:
+            self._handles.clear()
+            self._refs.clear()
+            for board_num in sorted(self._created):
+                try:
+                    self.release_board(board_num)
+                except Exception as e:
+                    print(f"[registry.py] Releasing board {board_num} failed: {e}")
+
+_registry:DeviceRegistry = None
+_registry_lock = threading.Lock()
+
+def registry() -> DeviceRegistry:
+    ''' Process wide registry of the selected backend and [Devices] registry file. '''
+    global _registry
+    with _registry_lock:
+        if _registry is None or _registry.backend != ul.name:
+            # Built first, a config that fails to load leaves no half made registry
+            new = DeviceRegistry(profile().devices.registry)
+            if _registry is not None:
+                _registry.shutdown()
+            else:
+                atexit.register(_shutdown)
+            _registry = new
+        return _registry
+
+def _shutdown():
+    if _registry is not None:
+        _registry.shutdown()
@@ -0,0 +1,588 @@
+"""
+    Software simulated MCC DAQ backend.
+
+    Drop-in replacement for the subset of mcculw.ul used by this repo, selected
+    through daq.ul.select('sim') or `name = sim` in the [Backend] config section.
+    A simulated USB-3101FS (AO) and USB-202 (AI) are connected by an optical
+    loopback: every AO channel drives one LC cell (BV curve transfer, first order
+    rise/fall response, detector noise) which is read by the AI channel of the
+    same number.
+
+    Scans are not run by a thread. Every API call advances the simulation up to
+    the current clock time, so BACKGROUND/CONTINUOUS ring buffer semantics hold
+    as long as the caller polls (get_status) like it would with real hardware.
+    AO samples are read from the buffer at the time of that call.
+"""
+from mcculw.enums import (
+    ULRange, ScanOptions, FunctionType, Status, ErrorCode, InterfaceType, InfoType, BoardInfo
+)
+from threading import RLock
+import numpy as np
+import ctypes, time, asyncio
+
+class ULError(Exception):
+    ''' Mirrors mcculw.ul.ULError for simulated failures. '''
+    def __init__(self, errorcode:ErrorCode, message:str=''):
+        super().__init__()
+        self.errorcode = errorcode
+        self.message = message or ErrorCode(errorcode).name
+
+    def __str__(self):
+        return "Error " + str(int(self.errorcode)) + ": " + self.message
+
+#__________________ Clocks ______________________________________________________
+
+class RealtimeClock():
+    ''' Wall clock scaled by speed (speed > 1 runs faster than real time). '''
+    def __init__(self, speed:float=1.0):
+        self.speed = speed
+        self._t0 = time.perf_counter()
+
+    def now(self) -> float:
+        return (time.perf_counter() - self._t0) * self.speed
+
+    def sleep(self, seconds:float):
+        time.sleep(max(seconds, 0) / self.speed)
+
+    async def async_sleep(self, seconds:float):
+        await asyncio.sleep(max(seconds, 0) / self.speed)
+
+class ManualClock():
+    ''' Clock that only moves through sleep/advance, for deterministic runs. '''
+    def __init__(self, t:float=0.0):
+        self.t = t
+
+    def now(self) -> float:
+        return self.t
+
+    def sleep(self, seconds:float):
+        self.t += max(seconds, 0)
+
+    advance = sleep
+
+    async def async_sleep(self, seconds:float):
+        # Every waiting task moves the clock, only meant for single task runs
+        self.sleep(seconds)
+        await asyncio.sleep(0)
+
+#__________________ LC optical model ____________________________________________
+
+class LcModel():
+    '''
+        Optical response of a liquid crystal cell seen by the detector.
+
+        Args:
+            bv_v_mid: Drive amplitude (V) at the middle of the BV curve transition.
+            bv_width: Width (V) of the logistic BV transition.
+            i_on: Detector voltage of a relaxed cell (low drive).
+            i_off: Detector voltage of a driven cell (high drive).
+            tau_rise: Time constant (s) of increasing intensity.
+            tau_fall: Time constant (s) of decreasing intensity.
+            noise: Gaussian detector noise standard deviation (V).
+            bv_curve: Optional (voltages, intensities) table replacing the logistic curve.
+    '''
+    def __init__(
+            self,
+            bv_v_mid:float=1.5,
+            bv_width:float=0.02,
+            i_on:float=1.7,
+            i_off:float=1.0,
+            tau_rise:float=0.020,
+            tau_fall:float=0.008,
+            noise:float=0.01,
+            bv_curve=None):
+        self.bv_v_mid = bv_v_mid
+        self.bv_width = bv_width
+        self.i_on     = i_on
+        self.i_off    = i_off
+        self.tau_rise = tau_rise
+        self.tau_fall = tau_fall
+        self.noise    = noise
+        self.bv_curve = None if bv_curve is None else (np.asarray(bv_curve[0]), np.asarray(bv_curve[1]))
+
+    def bv(self, volts:np.ndarray) -> np.ndarray:
+        '''
+            Settled intensity for a drive amplitude. The LC responds to |V| of the carrier,
+            rounded to 1 mV so DAC asymmetry between carrier polarities does not split runs.
+        '''
+        v = np.round(np.abs(volts), 3)
+        if self.bv_curve is not None:
+            return np.interp(v, *self.bv_curve)
+        x = np.clip((v - self.bv_v_mid) / self.bv_width, -50, 50)
+        return self.i_off + (self.i_on - self.i_off) / (1 + np.exp(x))
+
+    def respond(self, target:np.ndarray, dt:float, state:float):
+        '''
+            First order asymmetric response to a sampled target intensity.
+            The target is piecewise constant, so each run is solved in closed form.
+
+            Return:
+                (response, final state)
+        '''
+        out = np.empty_like(target)
+        edges = np.flatnonzero(np.diff(target)) + 1
+        starts = np.concatenate(([0], edges))
+        stops = np.concatenate((edges, [len(target)]))
+        y = state
+        for start, stop in zip(starts, stops):
+            level = target[start]
+            tau = self.tau_rise if level > y else self.tau_fall
+            n = np.arange(1, stop - start + 1)
+            out[start:stop] = level + (y - level) * np.exp(-n * dt / tau)
+            y = out[stop - 1]
+        return out, y
+
+#__________________ Simulated boards ____________________________________________
+
+class SimDeviceDescriptor():
+    def __init__(self, product_name:str, unique_id:str, product_id:int):
+        self.product_name   = product_name
+        self.unique_id      = unique_id
+        self.product_id     = product_id
+        self.dev_string     = product_name
+        self.interface_type = InterfaceType.USB
+
+class SimBoard():
+    ''' Static capabilities and runtime configuration of a simulated board. '''
+    def __init__(self, descriptor:SimDeviceDescriptor, ao_chans:int, ao_res:int, ao_scan:bool,
+                 ai_chans:int, ai_res:int, ranges, max_rate:int):
+        self.descriptor = descriptor
+        self.ao_chans   = ao_chans
+        self.ao_res     = ao_res
+        self.ao_scan    = ao_scan
+        self.ai_chans   = ai_chans
+        self.ai_res     = ai_res
+        self.ranges     = list(ranges)
+        self.max_rate   = max_rate
+        self.dac_range  = self.ranges[0]
+        self.adc_range  = self.ranges[0]
+
+def _default_boards():
+    return [
+        SimBoard(SimDeviceDescriptor('USB-3101FS', '2128658', 224),
+                 ao_chans=4, ao_res=16, ao_scan=True, ai_chans=0, ai_res=0,
+                 ranges=[ULRange.BIP10VOLTS, ULRange.UNI10VOLTS], max_rate=100_000),
+        SimBoard(SimDeviceDescriptor('USB-202', '01D6A4C9', 299),
+                 ao_chans=2, ao_res=12, ao_scan=False, ai_chans=8, ai_res=12,
+                 ranges=[ULRange.BIP10VOLTS], max_rate=100_000),
+    ]
+
+class SimAoInfo():
+    def __init__(self, board:SimBoard):
+        self._board = board
+    num_chans         = property(lambda self: self._board.ao_chans)
+    is_supported      = property(lambda self: self._board.ao_chans > 0)
+    resolution        = property(lambda self: self._board.ao_res)
+    supports_scan     = property(lambda self: self._board.ao_scan)
+    supported_ranges  = property(lambda self: list(self._board.ranges))
+    max_scan_rate     = property(lambda self: self._board.max_rate if self._board.ao_scan else 0)
+
+class SimAiInfo():
+    def __init__(self, board:SimBoard):
+        self._board = board
+    num_chans         = property(lambda self: self._board.ai_chans)
+    is_supported      = property(lambda self: self._board.ai_chans > 0)
+    resolution        = property(lambda self: self._board.ai_res)
+    supports_scan     = property(lambda self: True)
+    supported_ranges  = property(lambda self: list(self._board.ranges))
+    max_scan_rate     = property(lambda self: self._board.max_rate)
+
+class DaqDeviceInfo():
+    ''' Mirrors mcculw.device_info.DaqDeviceInfo for a created simulated board. '''
+    def __init__(self, board_num:int):
+        self._board = _system.board(board_num)
+        self._board_num = board_num
+
+    board_num              = property(lambda self: self._board_num)
+    product_name           = property(lambda self: self._board.descriptor.product_name)
+    unique_id              = property(lambda self: self._board.descriptor.unique_id)
+    supports_analog_output = property(lambda self: self._board.ao_chans > 0)
+    supports_analog_input  = property(lambda self: self._board.ai_chans > 0)
+
+    def get_ao_info(self) -> SimAoInfo:
+        return SimAoInfo(self._board)
+
+    def get_ai_info(self) -> SimAiInfo:
+        return SimAiInfo(self._board)
+
+#__________________ Scans _______________________________________________________
+
+class _Scan():
+    ''' State of one background scan. Counts are per channel sample index. '''
+    def __init__(self, board_num, low_chan, high_chan, num_points, rate, ul_range, buf, options, t_start):
+        self.board_num  = board_num
+        self.low_chan   = low_chan
+        self.num_chans  = high_chan - low_chan + 1
+        self.num_points = num_points
+        self.per_chan   = num_points // self.num_chans
+        self.rate       = rate
+        self.ul_range   = ULRange(ul_range)
+        self.buf        = buf
+        self.options    = ScanOptions(options)
+        self.t_start    = t_start
+        self.count      = 0 # samples per channel transferred
+        self.running    = True
+
+    @property
+    def continuous(self) -> bool:
+        return bool(self.options & ScanOptions.CONTINUOUS)
+
+    def due(self, now:float) -> int:
+        ''' Per channel sample count that should have been transferred by now. '''
+        n = int(np.floor((now - self.t_start) * self.rate)) + 1 if now >= self.t_start else 0
+        return n if self.continuous else min(n, self.per_chan)
+
+    def status(self):
+        cur_count = self.count * self.num_chans
+        cur_index = ((self.count - 1) % self.per_chan) * self.num_chans if self.count else -1
+        return (Status.RUNNING if self.running else Status.IDLE), cur_count, cur_index
+
+class SimSystem():
+    ''' Boards, buffers, scans and the optical loopback sharing one clock. '''
+    CHUNK = 1 << 16
+
+    def __init__(self, clock=None, lc:LcModel=None, model_rate:int=10_000, seed=None):
+        self.lock       = RLock()
+        self.clock      = clock or RealtimeClock()
+        self.lc         = lc or LcModel()
+        self.model_rate = model_rate
+        self.rng        = np.random.default_rng(seed)
+        self.inventory  = _default_boards()
+        self.boards     = {}
+        self.buffers    = {}
+        self.ao_scans   = {}
+        self.ai_scans   = {}
+        self.m_done     = 0
+        self.drive      = {}   # AO channel -> last drive voltage
+        self.optic      = {}   # AO channel -> last LC output
+
+    def board(self, board_num:int) -> SimBoard:
+        if board_num not in self.boards:
+            raise ULError(ErrorCode.BADBOARD, f"Board {board_num} was not created")
+        return self.boards[board_num]
+
+    def array(self, memhandle:int, dtype) -> np.ndarray:
+        if memhandle not in self.buffers:
+            raise ULError(ErrorCode.BAD_MEM_HANDLE, "Invalid memhandle")
+        c_buf = self.buffers[memhandle]
+        if ctypes.sizeof(c_buf._type_) != np.dtype(dtype).itemsize:
+            raise ULError(ErrorCode.BADBUFFERSIZE, "Buffer type does not match scan options")
+        return np.ctypeslib.as_array(c_buf)
+
+    def alloc(self, ctype, num_points:int) -> int:
+        if num_points <= 0:
+            return 0
+        c_buf = (ctype * num_points)()
+        handle = ctypes.addressof(c_buf)
+        self.buffers[handle] = c_buf
+        return handle
+
+    #__________ Simulation ______________________________________________________
+
+    def advance(self):
+        ''' Transfer every AO/AI sample due up to the current clock time. '''
+        now = self.clock.now()
+        m_end = int(np.floor(now * self.model_rate)) + 1
+        while self.m_done < m_end:
+            m_stop = min(self.m_done + self.CHUNK, m_end)
+            self._step(m_stop, now)
+            self.m_done = m_stop
+        # AO transfer counts can only be settled once all ticks are modelled
+        for scan in self.ao_scans.values():
+            if scan.running:
+                scan.count = scan.due(now)
+                scan.running = scan.continuous or scan.count < scan.per_chan
+
+    def _ao_volts(self, scan:_Scan, t:np.ndarray):
+        ''' Drive voltage per AO channel at model times t, None before scan start. '''
+        board = self.boards[scan.board_num]
+        k = np.floor((t - scan.t_start) * scan.rate).astype(np.int64)
+        started = k >= 0
+        if not scan.continuous:
+            k = np.minimum(k, scan.per_chan - 1)
+        counts = self.array(scan.buf, np.uint16)
+        fsr = scan.ul_range.range_max - scan.ul_range.range_min
+        idx = (np.maximum(k, 0) % scan.per_chan) * scan.num_chans
+        volts = {}
+        for c in range(scan.num_chans):
+            v = scan.ul_range.range_min + counts[idx + c] * (fsr / (1 << board.ao_res))
+            volts[scan.low_chan + c] = (v, started)
+        return volts
+
+    def _step(self, m_stop:int, now:float):
+        m = np.arange(self.m_done, m_stop)
+        t = m / self.model_rate
+        dt = 1.0 / self.model_rate
+        drive = {}
+        for scan in list(self.ao_scans.values()) + list(self.ai_scans.values()):
+            if scan.running and scan.buf not in self.buffers:
+                # Buffer freed under a running scan, the driver would abort it
+                scan.running = False
+        for scan in self.ao_scans.values():
+            if scan.running:
+                for chan, (v, started) in self._ao_volts(scan, t).items():
+                    held = self.drive.get(chan, 0.0)
+                    drive[chan] = np.where(started, v, held)
+        for chan in set(self.drive) | set(drive):
+            if chan not in drive:
+                drive[chan] = np.full(len(m), self.drive[chan])
+            self.drive[chan] = float(drive[chan][-1])
+
+        # LC response per cell, prefixed with the last output of the previous chunk
+        optic = {}
+        for chan, v in drive.items():
+            state = self.optic.get(chan, float(self.lc.bv(0.0)))
+            out, self.optic[chan] = self.lc.respond(self.lc.bv(v), dt, state)
+            optic[chan] = np.concatenate(([state], out))
+
+        for scan in self.ai_scans.values():
+            if scan.running:
+                self._sample_ai(scan, optic, m_stop, now)
+
+    def _sample_ai(self, scan:_Scan, optic:dict, m_stop:int, now:float):
+        board = self.boards[scan.board_num]
+        # Only samples that can fall inside this chunk of model ticks
+        span = int(np.ceil((m_stop - self.m_done + 1) / self.model_rate * scan.rate)) + 2
+        j = np.arange(scan.count, min(scan.due(now), scan.count + span))
+        m_j = np.floor((scan.t_start + j / scan.rate) * self.model_rate).astype(np.int64)
+        j, m_j = j[m_j < m_stop], m_j[m_j < m_stop]
+        if not len(j):
+            return
+        idx = np.clip(m_j - self.m_done + 1, 0, m_stop - self.m_done)
+        keep = slice(max(len(j) - scan.per_chan, 0), None) # older samples are overwritten
+        rng = scan.ul_range
+        lsb = (rng.range_max - rng.range_min) / (1 << board.ai_res)
+        scaled = bool(scan.options & ScanOptions.SCALEDATA)
+        buf = self.array(scan.buf, np.float64 if scaled else np.uint16)
+        pos = (j[keep] % scan.per_chan) * scan.num_chans
+        for c in range(scan.num_chans):
+            chan = scan.low_chan + c
+            level = optic[chan][idx[keep]] if chan in optic else np.full(len(pos), float(self.lc.bv(0.0)))
+            v = level + self.rng.normal(0.0, self.lc.noise, len(pos))
+            counts = np.clip(np.floor((v - rng.range_min) / lsb + 0.5), 0, (1 << board.ai_res) - 1)
+            buf[pos + c] = (rng.range_min + counts * lsb) if scaled else counts
+        scan.count = int(j[-1]) + 1
+        if not scan.continuous and scan.count >= scan.per_chan:
+            scan.running = False
+
+    #__________ Scan control ____________________________________________________
+
+    def start_scan(self, scans:dict, board_num, low_chan, high_chan, num_points, rate, ul_range,
+                   memhandle, options, dtype):
+        num_chans = high_chan - low_chan + 1
+        if num_chans <= 0 or num_points < num_chans:
+            raise ULError(ErrorCode.BADCOUNT, f"num_points {num_points} for {num_chans} channels")
+        if rate <= 0 or rate > self.board(board_num).max_rate:
+            raise ULError(ErrorCode.BADRATE, f"Rate {rate}")
+        if board_num in scans and scans[board_num].running:
+            raise ULError(ErrorCode.ALREADYACTIVE)
+        if len(self.array(memhandle, dtype)) < num_points:
+            raise ULError(ErrorCode.BADBUFFERSIZE, "Buffer smaller than num_points")
+        self.advance()
+        scan = _Scan(board_num, low_chan, high_chan, num_points, rate, ul_range, memhandle,
+                     options, self.clock.now())
+        scans[board_num] = scan
+        if not options & ScanOptions.BACKGROUND:
+            # Foreground scans block until all points are transferred
+            self.clock.sleep(scan.per_chan / rate)
+            self.advance()
+            scan.running = False
+
+_system = SimSystem()
+_configured = False
+
+#__________________ Simulator control ___________________________________________
+
+def reset(clock=None, lc:LcModel=None, model_rate:int=10_000, seed=None) -> SimSystem:
+    ''' Replace the simulated system, dropping all boards, buffers and scans. '''
+    global _system, _configured
+    _system = SimSystem(clock, lc, model_rate, seed)
+    _configured = True
+    return _system
+
+def system() -> SimSystem:
+    return _system
+
+def configured() -> bool:
+    ''' True once reset/load_config ran, so selecting the backend keeps a custom system. '''
+    return _configured
+
+def lc_from_config(config) -> LcModel:
+    ''' LC model of the [Sim] section of daq_config.ini (defaults without one). '''
+    if not config.has_section('Sim'):
+        return LcModel()
+    sec = config['Sim']
+    bv_curve = None
+    if sec.get('bv_curve', ''):
+        table = np.loadtxt(sec['bv_curve'], delimiter=',')
+        bv_curve = (table[:, 0], table[:, 1])
+    return LcModel(
+        bv_v_mid=sec.getfloat('bv_v_mid', 1.5),
+        bv_width=sec.getfloat('bv_width', 0.02),
+        i_on=sec.getfloat('i_on', 1.7),
+        i_off=sec.getfloat('i_off', 1.0),
+        tau_rise=sec.getfloat('tau_rise', 0.020),
+        tau_fall=sec.getfloat('tau_fall', 0.008),
+        noise=sec.getfloat('noise', 0.01),
+        bv_curve=bv_curve,
+    )
+
+def load_config(config) -> SimSystem:
+    ''' Build the simulated system from the [Sim] section of daq_config.ini. '''
+    if not config.has_section('Sim'):
+        return reset()
+    sec = config['Sim']
+    seed = sec.get('seed', '')
+    return reset(
+        clock=RealtimeClock(sec.getfloat('speed', 1.0)),
+        lc=lc_from_config(config),
+        model_rate=int(sec.get('model_rate', '10_000')),
+        seed=int(seed) if seed else None,
+    )
+
+def detector_samples(wave:np.ndarray, ao_rate:int, ai_rate:int, lc:LcModel=None, seed=None) -> np.ndarray:
+    '''
+        Offline loopback: detector samples of one AO waveform through the LC model,
+        without boards or a clock (sweeps, benchmarks). ao_rate must be a multiple of ai_rate.
+    '''
+    lc = lc or LcModel()
+    if ao_rate % ai_rate:
+        raise Exception(f"[ERROR] AI rate {ai_rate} does not divide the AO rate {ao_rate}.")
+    response, _ = lc.respond(lc.bv(wave), 1 / ao_rate, lc.bv(0.0))
+    samples = response[::ao_rate // ai_rate]
+    return samples + np.random.default_rng(seed).normal(0.0, lc.noise, len(samples))
+
+def sleep(seconds:float):
+    ''' Sleep on the simulated clock. '''
+    _system.clock.sleep(seconds)
+
+async def async_sleep(seconds:float):
+    ''' Awaitable sleep on the simulated clock. '''
+    await _system.clock.async_sleep(seconds)
+
+#__________________ mcculw.ul API ________________________________________________
+
+def ignore_instacal():
+    pass
+
+def get_daq_device_inventory(interface_type, number_of_devices=100):
+    return [b.descriptor for b in _system.inventory][:number_of_devices]
+
+def create_daq_device(board_num, descriptor):
+    with _system.lock:
+        for b in _system.inventory:
+            if b.descriptor.unique_id == descriptor.unique_id:
+                _system.boards[board_num] = b
+                return
+        raise ULError(ErrorCode.BADBOARD, f"Unknown device {descriptor.product_name}")
+
+def release_daq_device(board_num):
+    with _system.lock:
+        _system.advance()
+        for scans in (_system.ao_scans, _system.ai_scans):
+            if board_num in scans:
+                scans[board_num].running = False
+        _system.boards.pop(board_num, None)
+
+def get_config(info_type, board_num, dev_num, config_item):
+    board = _system.board(board_num)
+    items = {
+        BoardInfo.NUMDACHANS: board.ao_chans,
+        BoardInfo.NUMADCHANS: board.ai_chans,
+        BoardInfo.DACRES:     board.ao_res,
+        BoardInfo.ADRES:      board.ai_res,
+        BoardInfo.DACRANGE:   board.dac_range,
+        BoardInfo.RANGE:      board.adc_range,
+    }
+    if config_item not in items:
+        raise ULError(ErrorCode.BADCONFIGITEM, f"Config item {config_item}")
+    return int(items[config_item])
+
+def set_config(info_type, board_num, dev_num, config_item, config_val):
+    board = _system.board(board_num)
+    if ULRange(config_val) not in board.ranges:
+        raise ULError(ErrorCode.BADRANGE, f"{ULRange(config_val).name}")
+    if config_item == BoardInfo.DACRANGE:
+        board.dac_range = ULRange(config_val)
+    elif config_item == BoardInfo.RANGE:
+        board.adc_range = ULRange(config_val)
+    else:
+        raise ULError(ErrorCode.BADCONFIGITEM, f"Config item {config_item}")
+
+def _resolution(board_num, prefer_ao:bool) -> int:
+    board = _system.board(board_num)
+    if prefer_ao and board.ao_chans:
+        return board.ao_res
+    return board.ai_res or board.ao_res or 12
+
+def from_eng_units(board_num, ul_range, eng_units_value):
+    ''' Same transfer function as the UL: FSR / 2**res per count, rounded, clipped. '''
+    rng = ULRange(ul_range)
+    res = _resolution(board_num, prefer_ao=True)
+    v = float(np.float32(eng_units_value))
+    count = np.floor((v - rng.range_min) * (1 << res) / (rng.range_max - rng.range_min) + 0.5)
+    return int(min(max(count, 0), (1 << res) - 1))
+
+def to_eng_units(board_num, ul_range, data_value):
+    rng = ULRange(ul_range)
+    res = _resolution(board_num, prefer_ao=False)
+    return float(np.float32(rng.range_min + data_value * (rng.range_max - rng.range_min) / (1 << res)))
+
+def win_buf_alloc(num_points):
+    with _system.lock:
+        return _system.alloc(ctypes.c_ushort, num_points)
+
+def scaled_win_buf_alloc(num_points):
+    with _system.lock:
+        return _system.alloc(ctypes.c_double, num_points)
+
+def win_buf_free(memhandle):
+    with _system.lock:
+        if _system.buffers.pop(memhandle, None) is None:
+            raise ULError(ErrorCode.BAD_MEM_HANDLE, "Invalid memhandle")
+
+def win_buf_to_array(memhandle, data_array, first_point, count):
+    with _system.lock:
+        _system.advance()
+        src = _system.array(memhandle, np.uint16)[first_point:first_point + count]
+        ctypes.memmove(data_array, src.ctypes.data, src.nbytes)
+
+def scaled_win_buf_to_array(memhandle, data_array, first_point, count):
+    with _system.lock:
+        _system.advance()
+        src = _system.array(memhandle, np.float64)[first_point:first_point + count]
+        ctypes.memmove(data_array, src.ctypes.data, src.nbytes)
+
+def a_out_scan(board_num, low_chan, high_chan, num_points, rate, ul_range, memhandle, options):
+    with _system.lock:
+        board = _system.board(board_num)
+        if not board.ao_scan:
+            raise ULError(ErrorCode.BADBOARDTYPE, f"{board.descriptor.product_name} has no AO scan")
+        if high_chan >= board.ao_chans or low_chan < 0:
+            raise ULError(ErrorCode.BADADCHAN, f"AO channels {low_chan}-{high_chan}")
+        _system.start_scan(_system.ao_scans, board_num, low_chan, high_chan, num_points, rate,
+                           ul_range, memhandle, options, np.uint16)
+
+def a_in_scan(board_num, low_chan, high_chan, num_points, rate, ul_range, memhandle, options):
+    with _system.lock:
+        board = _system.board(board_num)
+        if high_chan >= board.ai_chans or low_chan < 0:
+            raise ULError(ErrorCode.BADADCHAN, f"AI channels {low_chan}-{high_chan}")
+        dtype = np.float64 if ScanOptions(options) & ScanOptions.SCALEDATA else np.uint16
+        _system.start_scan(_system.ai_scans, board_num, low_chan, high_chan, num_points, rate,
+                           ul_range, memhandle, options, dtype)
+
+def get_status(board_num, function_type):
+    with _system.lock:
+        _system.advance()
+        scans = _system.ao_scans if function_type == FunctionType.AOFUNCTION else _system.ai_scans
+        if board_num not in scans:
+            return Status.IDLE, 0, -1
+        return scans[board_num].status()
+
+def stop_background(board_num, function_type):
+    with _system.lock:
+        _system.advance()
+        scans = _system.ao_scans if function_type == FunctionType.AOFUNCTION else _system.ai_scans
+        if board_num in scans:
+            scans[board_num].running = False
@@ -0,0 +1,283 @@
+"""
+    Preamble detection and symbol clock recovery for waveform_single_char_2 frames.
+
+    The min/max/min initialization bits are seen by the detector as a short dark
+    pulse after the bright tail of the previous frame. That pattern is located with
+    a normalized FFT cross-correlation, then each frame start is re-tracked in a
+    small window and a timing-error loop on the data bit edges keeps decisions in
+    the centre of every mod_period window.
+"""
+from utils.waves import BIT_INI_WIND
+from utils.pam import slice_levels, symbols_to_bytes
+from utils.matched import DECISIONS, centred_means, integrate_dump, integration_width
+import numpy as np
+
+# Bright tail of the previous frame (s) included in the template
+PREAMBLE_LEAD = 0.15
+
+def preamble_template(sample_rate:int, bit_ini:float=BIT_INI_WIND, lead:float=PREAMBLE_LEAD) -> np.ndarray:
+    '''
+        Detector shape of a frame start: lead and first init bit bright, second
+        init bit dark, third bright. The frame starts `lead` seconds in.
+    '''
+    n_ini = int(bit_ini * sample_rate)
+    n_lead = int(lead * sample_rate)
+    return np.concatenate((np.ones(n_lead + n_ini), -np.ones(n_ini), np.ones(n_ini)))
+
+def normalized_xcorr(x:np.ndarray, template:np.ndarray) -> np.ndarray:
+    '''
+        Normalized cross-correlation (Pearson coefficient per lag) computed with FFTs.
+
+        Return:
+            c[i] for template aligned with x[i:i+len(template)], len(x) - len(template) + 1 lags.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    n = len(template)
+    if len(x) < n:
+        return np.empty(0)
+    t = template - template.mean()
+    t = t / np.linalg.norm(t)
+    nfft = 1 << int(np.ceil(np.log2(len(x) + n - 1)))
+    corr = np.fft.irfft(np.fft.rfft(x, nfft) * np.conj(np.fft.rfft(t, nfft)), nfft)[:len(x) - n + 1]
+    # Local energy of x around its window mean (t is zero mean, so the mean drops out of corr)
+    cs = np.concatenate(([0.0], np.cumsum(x)))
+    cs2 = np.concatenate(([0.0], np.cumsum(x * x)))
+    s = cs[n:] - cs[:-n]
+    var = cs2[n:] - cs2[:-n] - s * s / n
+    return corr / np.sqrt(np.maximum(var, 1e-12))
+
+class SyncMetrics():
+    ''' Counters reported by SyncDemodulator. '''
+    def __init__(self):
+        self.locks         = 0
+        self.frames        = 0
+        self.frames_missed = 0 # expected preambles below min_corr
+        self.last_corr     = 0.0
+        self.phase         = 0.0 # decision offset (samples) from the window centre
+        self.drift         = 0.0 # last frame start correction (samples)
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class SyncDemodulator():
+    '''
+        Streaming frame synchronizer and bit slicer, replacing the fixed bit offsets of
+        demod.CharDemodulator with preamble tracking.
+
+        Args:
+            sample_rate: AI sample rate (Hz).
+            threshold: Detector voltage separating '0' (below) from '1', or the
+                ascending 2**k - 1 thresholds of a PAM alphabet (pam.PamLevels).
+            mod_period: Seconds per symbol.
+            frame_period: Seconds per character frame (AO buffer duration).
+            num_symbols: Symbols per frame.
+            min_corr: Correlation a preamble must reach.
+            loop_gain: Gain of the first order timing loop (0..1).
+            max_misses: Consecutive missed preambles before searching again.
+            slicer: Optional threshold.AdaptiveThreshold, updated with every block
+                and replacing threshold once it learnt the levels.
+            decision: 'sample' slices the sample at each symbol centre, 'integrate'
+                the mean of the symbol window (utils/matched.py).
+            guard: Fraction of the symbol left out at each end of the integration window.
+            equalizer: Optional equalizer.DecisionFeedbackEqualizer deciding the soft
+                values instead of the thresholds, trained on the preamble symbols.
+    '''
+    def __init__(
+            self,
+            sample_rate:int,
+            threshold,
+            mod_period:float=0.080,
+            frame_period:float=1.0,
+            num_symbols:int=8,
+            min_corr:float=0.6,
+            loop_gain:float=0.3,
+            max_misses:int=3,
+            slicer=None,
+            decision:str='sample',
+            guard:float=0.25,
+            equalizer=None):
+        if decision not in DECISIONS:
+            raise Exception(f"[ERROR] Unknown decision '{decision}', use one of {DECISIONS}.")
+        self.sample_rate = sample_rate
+        self.thresholds  = np.atleast_1d(np.asarray(threshold, dtype=float))
+        self.bits_per_symbol = int(np.log2(len(self.thresholds) + 1))
+        self.bit_len     = int(mod_period * sample_rate)
+        self.frame_len   = int(round(frame_period * sample_rate))
+        self.num_symbols = num_symbols
+        self.min_corr    = min_corr
+        self.loop_gain   = loop_gain
+        self.max_misses  = max_misses
+        self.template    = preamble_template(sample_rate)
+        self.lead        = int(PREAMBLE_LEAD * sample_rate)
+        self.pre_len     = 3 * int(BIT_INI_WIND * sample_rate)
+        self.search      = self.bit_len // 2 # tracking window (samples) around the expected start
+        self.slicer      = slicer
+        self.decision    = decision
+        self.width       = integration_width(self.bit_len, guard) # samples integrated per symbol
+        self.equalizer   = equalizer
+        self.metrics     = SyncMetrics()
+        self._buf        = np.empty(0)
+        self._buf_start  = 0 # absolute index of _buf[0]
+        self._frame      = None # absolute start of the next frame, None while searching
+        self._phase      = 0.0
+        self._misses     = 0
+
+    @property
+    def locked(self) -> bool:
+        return self._frame is not None
+
+    def _window(self, a:int, b:int) -> np.ndarray:
+        return self._buf[a - self._buf_start:b - self._buf_start]
+
+    def _acquire(self):
+        ''' Search one frame period of lags for the strongest preamble. '''
+        span = self.frame_len + len(self.template) - 1
+        if len(self._buf) < span:
+            return
+        c = normalized_xcorr(self._buf[:span], self.template)
+        if c.max() >= self.min_corr:
+            peak = int(np.argmax(c))
+            self._frame = self._buf_start + peak + self.lead
+            self._misses = 0
+            self.metrics.locks += 1
+            self.metrics.last_corr = float(c[peak])
+        else:
+            # Keep enough history to catch a preamble straddling the next block
+            self._trim(self._buf_start + len(self._buf) - len(self.template))
+
+    def _track(self) -> bool:
+        ''' Re-centre the expected frame start on the preamble. False if it was missed. '''
+        a = self._frame - self.lead - self.search
+        c = normalized_xcorr(self._window(a, a + 2 * self.search + len(self.template)), self.template)
+        peak = int(np.argmax(c))
+        self.metrics.last_corr = float(c[peak])
+        if c[peak] < self.min_corr:
+            self._misses += 1
+            self.metrics.frames_missed += 1
+            return False
+        self._misses = 0
+        self.metrics.drift = peak - self.search
+        self._frame += peak - self.search
+        return True
+
+    def _slice(self) -> bytes:
+        ''' Decide the symbols of the frame at _frame and update the timing loop. '''
+        bounds = self._frame + self.pre_len + np.arange(self.num_symbols) * self.bit_len
+        symbols = self._decide(self._window(self._frame, self._frame + self.frame_len), self._frame, bounds)
+        return symbols_to_bytes(symbols, self.bits_per_symbol)
+
+    def _decide(self, x:np.ndarray, x_start:int, bounds:np.ndarray, track:bool=True) -> np.ndarray:
+        '''
+            Level index of the symbols starting at absolute indices bounds, x holds the
+            samples from absolute index x_start. Updates the timing loop if track.
+        '''
+        T = self.bit_len
+        centre = int(bounds[0]) - x_start + T // 2 + int(round(self._phase))
+        if self.decision == 'integrate':
+            # Integrate-and-dump the evenly spaced symbol windows, kept inside x
+            first = min(max(centre - self.width // 2, 0), len(x) - (len(bounds) - 1) * T - self.width)
+            soft = integrate_dump(x, first, len(bounds), T, self.width)
+        else:
+            soft = x[centre + (bounds - bounds[0]).astype(np.int64)]
+        if self.equalizer is not None:
+            # Only the final decode of a frame adapts the taps, header reads reuse them
+            symbols = self.equalizer.equalize(soft, *self._training(int(bounds[0])), adapt=track,
+                                              thresholds=self.thresholds)
+        else:
+            symbols = slice_levels(soft, self.thresholds)
+        if not track:
+            return symbols
+
+        # Edge timing error: delay of each crossing from its nominal boundary. The crossing
+        # level of a transition is the mean of the thresholds between its two levels.
+        top = len(self.thresholds)
+        prev = np.concatenate(([top], symbols[:-1])) # third init bit is the brightest level
+        edges = np.flatnonzero(symbols != prev)
+        if len(edges):
+            lo = np.minimum(prev[edges], symbols[edges])
+            hi = np.maximum(prev[edges], symbols[edges])
+            cs = np.concatenate(([0.0], np.cumsum(self.thresholds)))
+            level = (cs[hi] - cs[lo]) / (hi - lo)
+            start = bounds[edges] - T // 2 - x_start
+            rows = x[start[:, None] + np.arange(T)[None, :]] > level[:, None]
+            crossed = rows != (prev[edges] > symbols[edges])[:, None]
+            # Rows that start past the crossing (previous symbol still settling) carry no timing
+            found = crossed.any(axis=1) & ~crossed[:, 0]
+            if found.any():
+                delay = np.argmax(crossed[found], axis=1) - T // 2
+                self._phase += self.loop_gain * (float(np.mean(delay)) - self._phase)
+                self.metrics.phase = self._phase
+        return symbols
+
+    def _training(self, first:int):
+        '''
+            (soft values, known levels) of the preamble symbol windows before the data
+            symbol starting at absolute index first, back to the first init bit. Levels
+            are in level units. Only windows at least a quarter symbol clear of the init
+            bit edges are kept, nearer ones see the LC in transition.
+        '''
+        T, top = self.bit_len, len(self.thresholds)
+        width = self.width if self.decision == 'integrate' else 1
+        starts = first - T * np.arange((first - self._frame) // T, 0, -1)
+        lo = starts + T // 2 + int(round(self._phase)) - width // 2
+        lo = lo[(lo >= self._buf_start) & (lo + width <= self._buf_start + len(self._buf))]
+        # Span around each window that has to lie inside one init bit
+        reach = max(width, T // 2) // 2
+        n_ini = self.pre_len // 3
+        bit = (lo + width // 2 - self._frame) // n_ini
+        inside = (bit >= 0) & (bit < 3) \
+            & ((lo + width // 2 - reach - self._frame) // n_ini == bit) \
+            & ((lo + width // 2 + reach - self._frame) // n_ini == bit)
+        lo, bit = lo[inside], bit[inside]
+        if not len(lo):
+            return np.empty(0), np.empty(0)
+        soft = centred_means(self._buf, lo - self._buf_start + width // 2, width)
+        return soft, np.where(bit == 1, 0.0, float(top)) # bright, dark, bright
+
+    def _adapt(self, block:np.ndarray):
+        if self.slicer is not None:
+            self.thresholds = self.slicer.update(block).copy()
+
+    def _trim(self, keep_from:int):
+        drop = keep_from - self._buf_start
+        if drop > 0:
+            self._buf = self._buf[drop:]
+            self._buf_start = keep_from
+
+    def push(self, block:np.ndarray, start:int=None) -> bytes:
+        '''
+            Feed newly acquired samples.
+
+            Args:
+                block: Detector samples of one channel.
+                start: Absolute index of block[0], defaults to right after the last block.
+                    A gap drops the lock.
+
+            Return:
+                bytes of every frame completed by this block.
+        '''
+        end = self._buf_start + len(self._buf)
+        if start is not None and start != end:
+            self._buf, self._buf_start, self._frame = np.empty(0), start, None
+        self._buf = np.concatenate((self._buf, np.asarray(block, dtype=np.float64)))
+        self._adapt(block)
+
+        out = bytearray()
+        margin = self.search + len(self.template) # samples needed past a frame to track the next one
+        while True:
+            if self._frame is None:
+                self._acquire()
+                if self._frame is None:
+                    break
+            if self._buf_start + len(self._buf) < self._frame + self.frame_len + margin:
+                break
+            if self._frame - self.lead - self.search >= self._buf_start and not self._track():
+                if self._misses >= self.max_misses:
+                    self._frame = None
+                    continue
+            else:
+                out += self._slice()
+                self.metrics.frames += 1
+            self._frame += self.frame_len
+            self._trim(self._frame - self.lead - self.search)
+        return bytes(out)
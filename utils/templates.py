@@ -0,0 +1,60 @@
+"""
+    Precomputed AO count templates of the packet bursts.
+
+    Without pre-emphasis every burst sample is one of the link's drive levels
+    times the square carrier, and the carrier repeats every carrier_cycle
+    samples. The counts of every level over one carrier cycle are converted once
+    per link configuration, so building a burst becomes a single gather from that
+    table by level index (framing.packet_index) and carrier phase, instead of
+    generating the carrier and converting every sample.
+"""
+from utils.counts import CountConverter
+from utils.waves import carrier, carrier_cycle
+from collections import OrderedDict
+from typing import Tuple
+import numpy as np
+
+class TemplateCache():
+    '''
+        Bounded LRU of (levels, carrier cycle) uint16 count tables.
+
+        Args:
+            maxsize: Number of parameter sets kept in memory.
+    '''
+    def __init__(self, maxsize:int=4):
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+
+    def key(self, converter:CountConverter, volts, sample_rate:int, frequency:int) -> Tuple:
+        ''' Everything the table depends on, including the count transfer function. '''
+        return (
+            tuple(float(v) for v in volts), int(sample_rate), int(frequency), converter.board_num,
+            converter.ul_range.name, converter.resolution, converter.span, converter.rounding,
+        )
+
+    def table(self, converter:CountConverter, volts, sample_rate:int, frequency:int) -> np.ndarray:
+        '''
+            Count table for a parameter set, built on first use.
+
+            Args:
+                converter: Count converter of the AO board (counts.daq_converter).
+                volts: Drive amplitude of each symbol level, darkest first.
+                sample_rate, frequency: AO rate and carrier frequency (Hz).
+        '''
+        key = self.key(converter, volts, sample_rate, frequency)
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+
+        cycle = carrier(carrier_cycle(sample_rate, frequency), sample_rate, frequency)
+        table = converter.to_counts(np.outer(np.asarray(volts, dtype=float), cycle))
+        self._tables[key] = table
+        while len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return table
+
+    def counts(self, converter:CountConverter, volts, sample_rate:int, frequency:int, index:np.ndarray) -> np.ndarray:
+        ''' Counts of a frame from the level index of every sample (waves.frame_index). '''
+        table = self.table(converter, volts, sample_rate, frequency)
+        phase = np.arange(len(index)) % table.shape[1]
+        return table[index, phase]
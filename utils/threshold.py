@@ -0,0 +1,129 @@
+"""
+    Adaptive decision thresholds that follow the detector levels.
+
+    Alignment, ambient light and LC temperature move the bright and dark (or
+    PAM) intensity levels while the link runs. Each block of samples is split
+    into level clusters by the current thresholds, and every cluster mean and
+    variance is folded into an exponentially weighted estimate with np.bincount,
+    so an update is a few vectorized passes over the block. Samples close to a
+    threshold (transitions) are left out of the estimate.
+
+    Each threshold is the midpoint of its two neighbouring levels. The level
+    spreads are only reported (SNR, margin): LC transitions that outlast the
+    guard band widen the spread of a level without moving its mean much.
+"""
+from typing import Sequence
+import numpy as np
+
+class ThresholdMetrics():
+    ''' Current estimates reported by AdaptiveThreshold. '''
+    def __init__(self):
+        self.updates    = 0
+        self.levels     = [] # level means (V), darkest first
+        self.sigmas     = [] # level standard deviations (V)
+        self.thresholds = []
+        self.snr_db     = None # mean half level spacing over the rms level noise
+        self.margin     = None # smallest threshold to level distance in standard deviations
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+class AdaptiveThreshold():
+    '''
+        Exponentially weighted level clustering.
+
+        Args:
+            thresholds: Initial ascending thresholds (one for on/off), NaN ones are
+                seeded with the mean of the first block (levels of unknown scale).
+            levels: Initial level means, darkest first (len(thresholds) + 1). Levels
+                left out are learnt from the first samples that fall in their cluster,
+                a threshold only moves once both of its levels are known.
+            sample_rate: Sample rate of the pushed blocks (Hz).
+            tau: Time constant (s) of the level estimates.
+            guard: Fraction of the level spacing around each threshold ignored.
+            min_sigma: Noise floor (V) of the reported spreads.
+    '''
+    def __init__(
+            self,
+            thresholds,
+            levels:Sequence[float]=None,
+            sample_rate:int=1000,
+            tau:float=2.0,
+            guard:float=0.25,
+            min_sigma:float=1e-3):
+        self.thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float)).copy()
+        num_levels      = len(self.thresholds) + 1
+        self.levels     = np.full(num_levels, np.nan) if levels is None else np.asarray(levels, dtype=float).copy()
+        self.variances  = np.full(num_levels, np.nan)
+        self.alpha      = 1.0 / (tau * sample_rate) # per sample
+        self.guard      = guard
+        self.min_sigma  = min_sigma
+        self.metrics    = ThresholdMetrics()
+
+    @property
+    def threshold(self) -> float:
+        ''' On/off threshold. '''
+        return float(self.thresholds[0])
+
+    def _keep(self, x:np.ndarray, cluster:np.ndarray) -> np.ndarray:
+        ''' Samples farther than guard * level spacing from the thresholds around them. '''
+        known = self.levels[~np.isnan(self.levels)]
+        if len(known) < 2 or self.guard <= 0:
+            return np.ones(len(x), dtype=bool)
+        band = self.guard * float(np.min(np.diff(known)))
+        edges = np.concatenate(([-np.inf], self.thresholds, [np.inf]))
+        return (x - edges[cluster] > band) & (edges[cluster + 1] - x > band)
+
+    def update(self, block:np.ndarray) -> np.ndarray:
+        ''' Fold a block of samples into the level estimates and return the new thresholds. '''
+        x = np.asarray(block, dtype=np.float64)
+        if not len(x):
+            return self.thresholds
+        unset = np.isnan(self.thresholds)
+        if unset.any():
+            self.thresholds[unset] = np.mean(x)
+        n = len(self.levels)
+        cluster = np.searchsorted(self.thresholds, x)
+        keep = self._keep(x, cluster)
+        x, cluster = x[keep], cluster[keep]
+
+        counts = np.bincount(cluster, minlength=n)
+        seen = counts > 0
+        mean = np.bincount(cluster, weights=x, minlength=n)[seen] / counts[seen]
+        mean_sq = np.bincount(cluster, weights=x * x, minlength=n)[seen] / counts[seen]
+
+        # Weight of the block in each estimate: alpha per sample of the cluster
+        rate = 1.0 - (1.0 - self.alpha) ** counts[seen]
+        levels = self.levels[seen]
+        levels = np.where(np.isnan(levels), mean, levels + rate * (mean - levels))
+        # Spread of the block around the updated level
+        spread = np.maximum(mean_sq - 2 * levels * mean + levels * levels, 0.0)
+        variances = self.variances[seen]
+        variances = np.where(np.isnan(variances), spread, variances + rate * (spread - variances))
+        self.levels[seen], self.variances[seen] = levels, variances
+
+        lo, hi = self.levels[:-1], self.levels[1:]
+        ready = ~np.isnan(lo) & ~np.isnan(hi) & (hi > lo)
+        self.thresholds[ready] = (lo[ready] + hi[ready]) / 2
+        self._report(ready)
+        return self.thresholds
+
+    def _sigma(self) -> np.ndarray:
+        ''' Level standard deviations, min_sigma for the levels without samples yet. '''
+        return np.sqrt(np.fmax(self.variances, self.min_sigma ** 2))
+
+    def _report(self, ready:np.ndarray):
+        m = self.metrics
+        m.updates += 1
+        m.levels = self.levels.tolist()
+        m.sigmas = np.sqrt(self.variances).tolist()
+        m.thresholds = self.thresholds.tolist()
+        if not ready.all():
+            return
+        sigma = self._sigma()
+        spacing = np.diff(self.levels)
+        m.snr_db = float(10 * np.log10(np.mean((spacing / 2) ** 2) / np.mean(sigma ** 2)))
+        m.margin = float(min(
+            np.min((self.thresholds - self.levels[:-1]) / sigma[:-1]),
+            np.min((self.levels[1:] - self.thresholds) / sigma[1:])
+        ))
@@ -0,0 +1,299 @@
+"""
+    Link training: measure the LC cells and pick the symbol period and thresholds.
+
+    At start-up every AO channel sends the same training sequence: an idle
+    (bright) lead, then `repeats` dark/bright pairs held long enough for the cell
+    to settle. From the AI stream of each lane
+
+        levels:      settled dark and bright detector voltage (end of every hold)
+        noise:       standard deviation of the settled samples around their hold mean
+        rise, fall:  10-90 % transition times of the average of every edge
+
+    are extracted with vectorized edge detection (one window per edge). The
+    transitions are modelled as the first order response of sim.LcModel with
+    tau = t(10-90 %) / ln 9, a pseudo random pattern is passed through the model
+    at each candidate symbol period and the eye is opened with the receiver's
+    decision rule (utils/matched.py). The shortest period whose eye half-opening
+    is target_margin noise deviations wide is chosen, with the threshold in the
+    middle of the eye of every lane. Both ends adopt the result (link.py) and it
+    is saved so send.py and recv.py can load it.
+"""
+from utils import daq
+from utils.waves import BIT_INI_WIND, wave_symbols
+from utils.matched import integrate_dump, integration_width
+from utils.sim import LcModel
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import List
+import numpy as np
+import json, os
+
+LN9 = np.log(9.0) # 10-90 % time of a first order response in time constants
+
+def training_wave(
+        v_dark:float,
+        v_bright:float,
+        sample_rate:int,
+        frequency:int,
+        hold:float=0.3,
+        repeats:int=4) -> np.ndarray:
+    '''
+        Voltage samples of the training sequence: the init bits, then repeats
+        dark/bright holds of hold seconds and a bright hold to finish.
+    '''
+    amplitudes = np.tile([v_dark, v_bright], repeats)
+    return wave_symbols(
+        duration=3 * BIT_INI_WIND + (2 * repeats + 1) * hold,
+        sample_rate=sample_rate,
+        a_max=v_dark,
+        a_min=v_bright,
+        frequency=frequency,
+        mod_period=hold,
+        amplitudes=amplitudes
+    )
+
+def training_duration(hold:float=0.3, repeats:int=4) -> float:
+    return 3 * BIT_INI_WIND + (2 * repeats + 1) * hold
+
+class LaneMeasurement():
+    ''' Levels, noise and transition times of one LC cell. '''
+    def __init__(self, dark:float, bright:float, sigma:float, rise:float, fall:float, edges:int):
+        self.dark   = dark   # settled detector voltage (V) of the darkest level
+        self.bright = bright # settled detector voltage (V) of the brightest level
+        self.sigma  = sigma  # noise (V) of one sample
+        self.rise   = rise   # 10-90 % dark to bright (s)
+        self.fall   = fall   # 10-90 % bright to dark (s)
+        self.edges  = edges  # transitions the times were measured on
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+def _transition_time(u:np.ndarray) -> float:
+    '''
+        10-90 % time (samples, interpolated) of a transition rising from 0 to 1,
+        NaN if it does not span both levels.
+    '''
+    above = np.flatnonzero(u >= 0.9)
+    if not len(above) or above[0] == 0:
+        return np.nan
+    t90 = above[0] # first sample past 90 %
+    below = np.flatnonzero(u[:t90] < 0.1)
+    if not len(below):
+        return np.nan
+    t10 = below[-1] # last sample under 10 % before it
+    # Linear interpolation of both crossings between neighbouring samples
+    c10 = t10 + (0.1 - u[t10]) / max(u[t10 + 1] - u[t10], 1e-12)
+    c90 = t90 - 1 + (0.9 - u[t90 - 1]) / max(u[t90] - u[t90 - 1], 1e-12)
+    return float(c90 - c10)
+
+def measure_lane(x:np.ndarray, sample_rate:int, hold:float=0.3) -> LaneMeasurement:
+    '''
+        Levels, noise and 10-90 % transition times of the detector samples of one
+        lane covering the training sequence.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    n_hold = int(hold * sample_rate)
+    # Edges are searched on a tenth of a hold moving average, timed on a light 3 ms one
+    k = max(n_hold // 10, 1)
+    coarse = np.convolve(x, np.ones(k) / k, mode='same')
+    k = max(int(0.003 * sample_rate), 1)
+    y = np.convolve(x, np.ones(k) / k, mode='same')
+
+    low, high = np.percentile(coarse, [5, 95])
+    state = coarse > (low + high) / 2
+    crossings = np.flatnonzero(np.diff(state)) + 1
+    # Noise makes several crossings per transition: keep the first of every cluster
+    crossings = crossings[np.diff(crossings, prepend=-n_hold) > n_hold // 2]
+    # Only transitions with a full hold on both sides (the init bits are shorter)
+    crossings = crossings[(crossings >= n_hold) & (crossings + n_hold <= len(x))]
+    crossings = crossings[state[crossings + n_hold // 4] == state[crossings + 3 * n_hold // 4]]
+    if len(crossings) < 2:
+        raise Exception(f"[ERROR] Training found {len(crossings)} transitions, check the LC, V_ON/V_OFF and the AI channel.")
+    rising = state[crossings + n_hold // 2]
+
+    # Settled part of every hold: the last 40 % before the next transition
+    width = int(0.4 * n_hold)
+    settled = sliding_window_view(x, width)[crossings + n_hold - width - n_hold // 10]
+    means = settled.mean(axis=1)
+    bright, dark = float(np.median(means[rising])), float(np.median(means[~rising]))
+    sigma = float(np.sqrt(np.mean((settled - means[:, None]) ** 2)))
+
+    # One window per edge around its crossing, falls mirrored to rise from 0 to 1. The
+    # windows of each direction are averaged before timing, the noise drops by sqrt(edges).
+    half = n_hold // 2
+    u = (sliding_window_view(y, 2 * half)[crossings - half] - dark) / (bright - dark)
+    u = np.where(rising[:, None], u, 1.0 - u)
+    rise = _transition_time(u[rising].mean(axis=0)) / sample_rate
+    fall = _transition_time(u[~rising].mean(axis=0)) / sample_rate
+    if np.isnan(rise) or np.isnan(fall):
+        raise Exception("[ERROR] Training could not time the LC transitions, lengthen [Training] hold.")
+    return LaneMeasurement(dark, bright, sigma, rise, fall, len(crossings))
+
+def prbs7(length:int) -> np.ndarray:
+    ''' Bits of the x^7 + x^6 + 1 pseudo random sequence, every 7 bit pattern but zeros. '''
+    state, bits = 0x7F, np.empty(length, dtype=np.int64)
+    for i in range(length):
+        bit = ((state >> 6) ^ (state >> 5)) & 1
+        state = ((state << 1) | bit) & 0x7F
+        bits[i] = bit
+    return bits
+
+class EyeModel():
+    '''
+        Eye of a lane at a symbol period, from the first order model of its
+        measured transitions.
+
+        Args:
+            lane: LaneMeasurement of the cell.
+            sample_rate: AI sample rate (Hz) of the receiver.
+            decision: 'sample' or 'integrate' (see SyncDemodulator).
+            guard: Integration guard (see SyncDemodulator).
+    '''
+    PATTERN = np.concatenate((np.ones(8, dtype=np.int64), prbs7(127)))
+
+    def __init__(self, lane:LaneMeasurement, sample_rate:int, decision:str='sample', guard:float=0.25):
+        self.lane        = lane
+        self.sample_rate = sample_rate
+        self.decision    = decision
+        self.guard       = guard
+        self.lc = LcModel(
+            i_on=lane.bright, i_off=lane.dark, tau_rise=lane.rise / LN9, tau_fall=lane.fall / LN9, noise=0.0
+        )
+
+    def open(self, mod_period:float):
+        '''
+            (threshold, margin) at mod_period: the middle of the eye and its half
+            opening in standard deviations of the decision noise.
+        '''
+        T = int(round(mod_period * self.sample_rate))
+        levels = np.array([self.lane.dark, self.lane.bright])
+        target = np.repeat(levels[self.PATTERN], T)
+        response, _ = self.lc.respond(target, 1 / self.sample_rate, self.lane.bright)
+        if self.decision == 'integrate':
+            width = integration_width(T, self.guard)
+            soft = integrate_dump(response, T // 2 - width // 2, len(self.PATTERN), T, width)
+            sigma = self.lane.sigma / np.sqrt(width)
+        else:
+            soft = response[T // 2::T][:len(self.PATTERN)]
+            sigma = self.lane.sigma
+        # Skip the settled lead, the pattern starts from an arbitrary history on air
+        ones, zeros = soft[8:][self.PATTERN[8:] == 1], soft[8:][self.PATTERN[8:] == 0]
+        low_one, high_zero = ones.min(), zeros.max()
+        return float((low_one + high_zero) / 2), float((low_one - high_zero) / 2 / max(sigma, 1e-6))
+
+class TrainingResult():
+    '''
+        Symbol period and per lane thresholds chosen by link training.
+
+        Args:
+            mod_period: Seconds per symbol adopted by both ends.
+            thresholds: Decision threshold (V) of every lane.
+            margins: Eye half-opening of every lane in noise deviations at mod_period.
+            target_margin: Margin asked for, met is False when no period reached it.
+            lanes: LaneMeasurement of every lane.
+    '''
+    def __init__(self, mod_period:float, thresholds, margins, target_margin:float, lanes:List[LaneMeasurement]):
+        self.mod_period    = float(mod_period)
+        self.thresholds    = [float(t) for t in thresholds]
+        self.margins       = [float(m) for m in margins]
+        self.target_margin = float(target_margin)
+        self.lanes         = lanes
+
+    @property
+    def met(self) -> bool:
+        return min(self.margins) >= self.target_margin
+
+    def as_dict(self) -> dict:
+        return {
+            'mod_period':    self.mod_period,
+            'thresholds':    self.thresholds,
+            'margins':       self.margins,
+            'target_margin': self.target_margin,
+            'met':           self.met,
+            'lanes':         [lane.as_dict() for lane in self.lanes],
+        }
+
+    def save(self, path:str):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    @classmethod
+    def from_dict(cls, data:dict) -> 'TrainingResult':
+        lanes = [LaneMeasurement(**lane) for lane in data['lanes']]
+        return cls(data['mod_period'], data['thresholds'], data['margins'], data['target_margin'], lanes)
+
+    @classmethod
+    def load(cls, path:str) -> 'TrainingResult':
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def summary(self) -> str:
+        return (f"mod_period {self.mod_period * 1e3:g} ms, thresholds {np.round(self.thresholds, 3).tolist()} V, "
+                f"margins {np.round(self.margins, 1).tolist()} (target {self.target_margin:g})")
+
+def select_period(
+        lanes:List[LaneMeasurement],
+        sample_rate:int,
+        periods:np.ndarray,
+        target_margin:float=6.0,
+        decision:str='sample',
+        guard:float=0.25) -> TrainingResult:
+    '''
+        Shortest of periods (ascending) where every lane reaches target_margin,
+        the period with the widest worst lane eye if none does.
+    '''
+    eyes = [EyeModel(lane, sample_rate, decision, guard) for lane in lanes]
+    best = None
+    for period in periods:
+        opened = [eye.open(period) for eye in eyes]
+        result = TrainingResult(period, [t for t, _ in opened], [m for _, m in opened], target_margin, lanes)
+        if result.met:
+            return result
+        if best is None or min(result.margins) > min(best.margins):
+            best = result
+    return best
+
+def train(
+        lane_samples:List[np.ndarray],
+        sample_rate:int,
+        hold:float=0.3,
+        periods:np.ndarray=None,
+        target_margin:float=6.0,
+        decision:str='sample',
+        guard:float=0.25) -> TrainingResult:
+    '''
+        Measure every lane of a training capture and select the link parameters.
+
+        Args:
+            lane_samples: Detector samples of each lane covering the training sequence.
+            sample_rate: AI sample rate (Hz) per lane.
+            hold: Hold (s) of the training levels.
+            periods: Candidate symbol periods (s), ascending. Default 10 to 200 ms in 5 ms steps.
+            target_margin: Eye half-opening asked for, in noise deviations (6 ~ BER 1e-9).
+    '''
+    if periods is None:
+        periods = np.round(np.arange(0.010, 0.2001, 0.005), 3)
+    lanes = [measure_lane(x, sample_rate, hold) for x in lane_samples]
+    return select_period(lanes, sample_rate, periods, target_margin, decision, guard)
+
+def configured_periods() -> np.ndarray:
+    ''' Candidate symbol periods of [Training]. '''
+    return np.round(np.arange(
+        daq.Training.MIN_PERIOD.value,
+        daq.Training.MAX_PERIOD.value + daq.Training.PERIOD_STEP.value / 2,
+        daq.Training.PERIOD_STEP.value
+    ), 6)
+
+def configured_training() -> TrainingResult:
+    '''
+        Saved training result both ends adopt, None with [Training] mode = off.
+        Raises if the mode asks for a result that was never saved.
+    '''
+    mode = daq.Training.MODE.value
+    if mode == 'off':
+        return None
+    if mode not in ('startup', 'saved'):
+        raise Exception(f"[ERROR] Unknown training mode '{mode}', use off, startup or saved.")
+    path = daq.Training.RESULT.value
+    if not os.path.exists(path):
+        raise Exception(f"[ERROR] No link training result at {path}, run link.py with [Training] mode = startup.")
+    return TrainingResult.load(path)
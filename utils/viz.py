@@ -0,0 +1,76 @@
+"""
+    Plots of DAQ readings (BV curve, switching speed, AI buffers).
+
+    Kept out of utils/waves.py so the send/recv path never imports matplotlib,
+    import this module where a plot is wanted.
+"""
+from utils.daq import DaqAI
+import numpy as np
+
+import matplotlib.pyplot as plt
+
+def plot_bvCurve(title:str, voltages, intensity:list):
+    '''
+        Plots Birefringence vs Voltage curve.
+        NOTE: First collect AO and AI DAQ readings.
+
+        Args:
+            title: plot title
+            voltages: np.linspace voltage array
+            intensty: list of intensity values collected by AI
+    '''
+    plt.figure(figsize=(10, 4))
+    plt.plot(voltages, intensity, marker='o')
+    plt.title(title)
+    plt.xlabel('Voltage')
+    plt.ylabel('Intensity')
+    plt.grid(True)
+    plt.show()
+    plt.xticks()
+
+def plot_bvCurve_buffer(title:str, buffer:np.array):
+    ''' Make sure to adjust voltage to max amplitude from buffer creation. '''
+    v = np.arange(0, 6, 6/(len(buffer)), dtype=float)
+    print(f"Len v: {len(v)} | Len Buff: {len(buffer)}")
+    plt.figure(figsize=(10, 4))
+    plt.scatter(v, buffer)
+    plt.title(title)
+    plt.xlabel('Voltage')
+    plt.ylabel('Intensity')
+    plt.grid(True)
+    plt.show()
+    plt.xticks()
+
+
+def plot_switchSpeed(title:str, ao, ai):
+    '''
+    Args:
+        title: Plot title
+        ao: Analog output reading of a DAQ as measured by a ai channel of another DAQ
+        ai: Intensity reading mesured by the Analog Input channel of a DAQ
+    '''
+    plt.figure(figsize=(10, 4))
+    plt.plot(ao)
+    plt.plot(ai)
+    plt.title(title)
+    plt.xlabel('Voltage')
+    plt.ylabel('Intensity')
+    plt.legend(['AO', 'LC'])
+    plt.grid(True)
+    plt.show()
+    plt.xticks()
+
+def plot_ai_buffer(title, ai_buffer:np.array, window=10):
+    # rolling_avg = np.convolve(ai_buffer, np.ones(window), mode='valid') / window
+
+    # t = np.linspace(0, DaqAI.DURAION.value, len(rolling_avg) * DaqAI.DURAION.value)
+    t = np.linspace(0, DaqAI.DURAION.value, len(ai_buffer) * DaqAI.DURAION.value)
+
+    plt.figure(figsize=(10, 4))
+    plt.scatter(t, ai_buffer)
+    plt.title(title)
+    plt.xlabel('Time')
+    plt.ylabel('Buffer Output')
+    plt.grid(True)
+    plt.show()
+    plt.xticks()
@@ -1,12 +1,11 @@
 """ Handler file to generate AO waveoforms for USB DAQ MCCULW """
 from utils.daq import McculwUsbDaq
 import numpy as np
-from scipy.signal import square
-from mcculw.ul import from_eng_units
-from utils.daq import DaqAI
-import ctypes
+from math import gcd
+from utils.counts import write_waveform
 
-import matplotlib.pyplot as plt
+# Width (s) of each min/max/min initialization bit of waveform_single_char_2
+BIT_INI_WIND = 0.05
 
 def waveform(
         waveform_type:str,
@@ -26,13 +25,12 @@ def waveform(
     if waveform_type == "sine":
         wave = amplitude * np.sin(2 * np.pi * frequency * t)
     elif waveform_type == "square":
+        from scipy.signal import square # only this builder needs scipy, import it on demand
         wave = amplitude * square(2 * np.pi * frequency * t)
     else:
         raise "[ERROR] Waveform only supports string 'sine' and 'square'. \n"
 
-    for i, sample in enumerate(wave):
-        raw_value = from_eng_units(board_num=daq.daq_board_num, ul_range=daq.daq_ao_range, eng_units_value=sample)
-        buffer[i] = raw_value
+    write_waveform(daq, buffer, wave)
 
 def waveform_fast(
         daq:McculwUsbDaq,
@@ -56,11 +54,7 @@ def waveform_fast(
     # Apply the amplitude modulation to the square wave
     modulated_wave = square_wave * modulation_envelope
 
-    for i, sample in enumerate(modulated_wave):
-        raw_value = from_eng_units(board_num=daq.daq_board_num, 
-                                   ul_range=daq.daq_ao_range, 
-                                   eng_units_value=sample)
-        buffer[i] = raw_value
+    write_waveform(daq, buffer, modulated_wave)
 
 def waveform_single_char(
     daq:McculwUsbDaq,
@@ -108,11 +102,7 @@ def waveform_single_char(
         # Add start bit between characters
     square_wave[bit_window_start:] = (a_min/a_max) * square_wave[bit_window_start:]
 
-    for i, sample in enumerate(square_wave):
-        raw_value = from_eng_units(board_num=daq.daq_board_num, 
-                                ul_range=daq.daq_ao_range, 
-                                eng_units_value=sample)
-        buffer[i] = raw_value
+    write_waveform(daq, buffer, square_wave)
 
 def waveform_single_char_2(
     daq:McculwUsbDaq,
@@ -125,41 +115,79 @@ def waveform_single_char_2(
     mod_period:float,
     character:str):
     """ Builds a waveform in the AO buffer to represent a single character """
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    square_wave = np.sign(np.sin(2 * np.pi * frequency * t))
-
-    # Begin window
-    bit_ini_wind = 0.05
-    bit_ini = int(bit_ini_wind * sample_rate) # initialization bit
-    mod_period = int(sample_rate * mod_period)
-    square_wave[0:bit_ini] = a_min * square_wave[0:bit_ini]
-    square_wave[bit_ini:(bit_ini + int(bit_ini_wind * sample_rate))] = a_max * square_wave[bit_ini:(bit_ini + int(bit_ini_wind * sample_rate))]
-    bit_ini += int(bit_ini_wind * sample_rate)
-    square_wave[bit_ini:(bit_ini + int(bit_ini_wind * sample_rate))] = a_min * square_wave[bit_ini:(bit_ini + int(bit_ini_wind * sample_rate))]
-    
-    bit_ini += int(bit_ini_wind * sample_rate)
-    bit_start = bit_ini
-    bit_stop = bit_start + mod_period
+    square_wave = wave_single_char_2(duration, sample_rate, a_max, a_min, frequency, mod_period, character)
+    write_waveform(daq, buffer, square_wave)
 
+def wave_single_char_2(
+    duration:int,
+    sample_rate:int,
+    a_max:float,
+    a_min:float,
+    frequency:int,
+    mod_period:float,
+    character:str) -> np.ndarray:
+    """ Voltage samples of waveform_single_char_2, without writing to a buffer """
+    # Bit '1' is sent at a_min (bright), '0' at a_max (dark)
     b_msg = bin(ord(character))[2:].zfill(8)
-    for b in b_msg:
-        # print(bit_start , ' ', bit_stop)
-        if b == '1':
-            square_wave[bit_start:bit_stop] = a_min * square_wave[bit_start:bit_stop]
-        else:
-            square_wave[bit_start:bit_stop] = a_max * square_wave[bit_start:bit_stop]
-        
-        bit_start = bit_stop
-        bit_stop = bit_start + mod_period
+    amplitudes = [a_min if b == '1' else a_max for b in b_msg]
+    return wave_symbols(duration, sample_rate, a_max, a_min, frequency, mod_period, amplitudes)
 
-    # Add start bit between characters
-    square_wave[bit_start:] = a_min * square_wave[bit_start:]
+def carrier_cycle(sample_rate:int, frequency:int) -> int:
+    """ Samples after which the square carrier of carrier() repeats exactly """
+    return int(sample_rate) // gcd(int(sample_rate), int(frequency))
 
-    for i, sample in enumerate(square_wave):
-        raw_value = from_eng_units(board_num=daq.daq_board_num, 
-                                ul_range=daq.daq_ao_range, 
-                                eng_units_value=sample)
-        buffer[i] = raw_value
+def carrier(num_samples:int, sample_rate:int, frequency:int) -> np.ndarray:
+    """ Square carrier (+1 first half cycle, -1 second), phase counted in whole samples """
+    phase = np.arange(num_samples, dtype=np.int64) * int(frequency) % int(sample_rate)
+    return np.where(2 * phase < sample_rate, 1.0, -1.0)
+
+def frame_index(
+    num_samples:int,
+    sample_rate:int,
+    mod_period:float,
+    symbols,
+    dark:int,
+    bright:int) -> np.ndarray:
+    """
+        Level index of every sample of a frame: bright, dark, bright initialization
+        bits, symbols[k] for the k-th symbol of mod_period, then bright until the end.
+    """
+    # Begin window
+    bit_ini = int(BIT_INI_WIND * sample_rate) # initialization bit
+    index = np.full(num_samples, bright, dtype=np.intp)
+    index[bit_ini:2 * bit_ini] = dark
+
+    # Symbols start after the three initialization bits
+    bit_start = 3 * bit_ini
+    symbols = np.repeat(np.asarray(symbols, dtype=np.intp), int(sample_rate * mod_period))[:max(num_samples - bit_start, 0)]
+    index[bit_start:bit_start + len(symbols)] = symbols
+    return index
+
+def wave_symbols(
+    duration:int,
+    sample_rate:int,
+    a_max:float,
+    a_min:float,
+    frequency:int,
+    mod_period:float,
+    amplitudes,
+    emphasis=None) -> np.ndarray:
+    """
+        Voltage samples of a frame: min/max/min initialization bits, one carrier
+        amplitude per symbol of mod_period, then a_min until the end of the frame.
+        emphasis (preemphasis.PreEmphasis) overdrives the start of every level.
+    """
+    square_wave = carrier(int(sample_rate * duration), sample_rate, frequency)
+
+    # a_max, a_min, then one entry per symbol
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    levels = np.concatenate(([a_max, a_min], amplitudes))
+    index = frame_index(len(square_wave), sample_rate, mod_period, 2 + np.arange(len(amplitudes)), dark=0, bright=1)
+    envelope = levels[index]
+    if emphasis is not None:
+        envelope = emphasis.shape(envelope)
+
+    return envelope * square_wave
 
 def waveform_bvCurve(        
         daq:McculwUsbDaq,
@@ -186,76 +214,13 @@ def waveform_bvCurve(
         w_start = w_stop
         w_stop += m_period
 
-    for i, sample in enumerate(square_wave):
-        raw_value = from_eng_units(board_num=daq.daq_board_num, 
-                                ul_range=daq.daq_ao_range, 
-                                eng_units_value=sample)
-        buffer[i] = raw_value
-    # ctypes.memmove(buffer, square_wave.ctypes.data, square_wave.nbytes)
-
-
-def plot_bvCurve(title:str, voltages, intensity:list):
-    '''
-        Plots Birefringence vs Voltage curve.
-        NOTE: First collect AO and AI DAQ readings.
-
-        Args:
-            title: plot title
-            voltages: np.linspace voltage array
-            intensty: list of intensity values collected by AI
-    '''
-    plt.figure(figsize=(10, 4))
-    plt.plot(voltages, intensity, marker='o')
-    plt.title(title)
-    plt.xlabel('Voltage')
-    plt.ylabel('Intensity')
-    plt.grid(True)
-    plt.show()
-    plt.xticks()
-
-def plot_bvCurve_buffer(title:str, buffer:np.array):
-    ''' Make sure to adjust voltage to max amplitude from buffer creation. '''
-    v = np.arange(0, 6, 6/(len(buffer)), dtype=float)
-    print(f"Len v: {len(v)} | Len Buff: {len(buffer)}")
-    plt.figure(figsize=(10, 4))
-    plt.scatter(v, buffer)
-    plt.title(title)
-    plt.xlabel('Voltage')
-    plt.ylabel('Intensity')
-    plt.grid(True)
-    plt.show()
-    plt.xticks()
-
-
-def plot_switchSpeed(title:str, ao, ai):
-    '''
-    Args:
-        title: Plot title
-        ao: Analog output reading of a DAQ as measured by a ai channel of another DAQ
-        ai: Intensity reading mesured by the Analog Input channel of a DAQ
-    '''
-    plt.figure(figsize=(10, 4))
-    plt.plot(ao)
-    plt.plot(ai)
-    plt.title(title)
-    plt.xlabel('Voltage')
-    plt.ylabel('Intensity')
-    plt.legend(['AO', 'LC'])
-    plt.grid(True)
-    plt.show()
-    plt.xticks()
-
-def plot_ai_buffer(title, ai_buffer:np.array, window=10):
-    # rolling_avg = np.convolve(ai_buffer, np.ones(window), mode='valid') / window
+    write_waveform(daq, buffer, square_wave)
 
-    # t = np.linspace(0, DaqAI.DURAION.value, len(rolling_avg) * DaqAI.DURAION.value)
-    t = np.linspace(0, DaqAI.DURAION.value, len(ai_buffer) * DaqAI.DURAION.value)
+# Plots moved to utils/viz.py, matplotlib is imported only when one is used
+VIZ = ('plot_bvCurve', 'plot_bvCurve_buffer', 'plot_switchSpeed', 'plot_ai_buffer')
 
-    plt.figure(figsize=(10, 4))
-    plt.scatter(t, ai_buffer)
-    plt.title(title)
-    plt.xlabel('Time')
-    plt.ylabel('Buffer Output')
-    plt.grid(True)
-    plt.show()
-    plt.xticks()
\ No newline at end of file
+def __getattr__(name):
+    if name in VIZ:
+        from utils import viz
+        return getattr(viz, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")